@@ -1,17 +1,26 @@
-from flask import Flask, request, jsonify, render_template
-from model_bert_fine_tuned import predict, NumpyEncoder
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
+from serialization import NumpyEncoder, dumps, dumps_bytes
 import traceback
 import logging
 import os
 import sys
-import json
-from check_models import check_huggingface_models, create_model_placeholder
+import tempfile
+from batch_io import iter_records, iter_texts, chunked, parse_timestamp
+from prediction_cache import prediction_cache
+from result_store import result_store, parse_bound
+import readiness
+import metrics
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Mode de démarrage : 'background' charge et préchauffe les modèles dans un thread,
+# 'lazy' les charge à la première requête (torch et transformers ne sont alors
+# importés qu'à ce moment), 'check' conserve la vérification complète des modèles
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "background")
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
 
 # Configurer Flask pour utiliser notre encodeur JSON personnalisé
@@ -21,6 +30,68 @@ app.json_encoder = NumpyEncoder
 def index():
     return render_template('index.html')
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Indique que le processus répond"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Indique si les modèles sont chargés, avec l'état et la durée de chargement de chacun"""
+    ready = readiness.is_ready()
+    return jsonify({'ready': ready, 'models': readiness.snapshot()}), 200 if ready else 503
+
+# Options acceptées par l'extraction de relation par paire d'entités
+PAIR_OPTIONS = ('head_types', 'tail_types', 'max_distance', 'max_pairs')
+
+def run_prediction(text, model_type='sentiment', instruction=None, analyze_instruction=False, long_document=False,
+                   input_ids=None, pair_options=None, source_id=None, timestamp=None):
+    """Exécute la prédiction demandée par l'API (partagé par les serveurs WSGI et ASGI)
+    et l'enregistre dans la base des résultats si elle est activée"""
+    result = _run_prediction(text, model_type, instruction, analyze_instruction, long_document, input_ids,
+                             pair_options)
+    result_store.record(model_type, text, result, source_id, parse_timestamp(timestamp))
+    return result
+
+def _run_prediction(text, model_type, instruction, analyze_instruction, long_document, input_ids, pair_options):
+    from model_bert_fine_tuned import predict
+    
+    # Relation par paire avec des options propres à la requête : exécutée directement, sans cache
+    if model_type == 'relation_pairs' and pair_options:
+        from model_bert_fine_tuned import predict_relation_pairs
+        if not isinstance(pair_options, dict):
+            raise ValueError("pair_options doit être un objet JSON")
+        unknown = set(pair_options) - set(PAIR_OPTIONS)
+        if unknown:
+            raise ValueError(f"Options de paires inconnues: {', '.join(sorted(unknown))}")
+        return predict_relation_pairs(text, **pair_options)
+    
+    # Documents longs : découpage en fenêtres glissantes au lieu d'une troncature à 512 tokens
+    if long_document:
+        from long_documents import predict_long_document
+        return predict_long_document(text, instruction, model_type)
+    
+    # Extraction de relation avec analyse optionnelle de l'instruction
+    if model_type == 'relation' and analyze_instruction and instruction:
+        # Obtenir le résultat principal de l'extraction de relation
+        result = predict(text, instruction, 'relation', token_ids=input_ids)
+        
+        # Analyser l'instruction avec NER pour extraire les entités
+        try:
+            logger.info(f"Analyse NER de l'instruction: {instruction[:50]}...")
+            instruction_ner_result = predict(instruction, model_type='ner')
+            if instruction_ner_result and 'entities' in instruction_ner_result:
+                # Ajouter les entités de l'instruction au résultat
+                result['instruction_entities'] = instruction_ner_result['entities']
+                logger.info(f"Entités extraites de l'instruction: {len(instruction_ner_result['entities'])}")
+        except Exception as e:
+            logger.error(f"Erreur lors de l'analyse NER de l'instruction: {str(e)}")
+            # Ne pas interrompre le flux principal si l'analyse NER échoue
+        return result
+    
+    # Cas standard pour les autres types de modèles (IDs de tokens éventuellement fournis par l'appelant)
+    return predict(text, instruction, model_type, token_ids=input_ids)
+
 @app.route('/api/predict', methods=['POST'])
 def api_predict():
     data = request.json
@@ -28,6 +99,9 @@ def api_predict():
     model_type = data.get('model_type', 'sentiment')
     instruction = data.get('instruction', None)
     analyze_instruction = data.get('analyze_instruction', False)
+    long_document = data.get('long_document', False)
+    input_ids = data.get('input_ids', None)
+    pair_options = data.get('pair_options', None)
     
     if not text:
         return jsonify({'error': 'Texte manquant'}), 400
@@ -35,67 +109,211 @@ def api_predict():
     try:
         app.logger.info(f"Analyse demandée: model_type={model_type}, texte={text[:50]}...")
         
-        # Extraction de relation avec analyse optionnelle de l'instruction
-        if model_type == 'relation' and analyze_instruction and instruction:
-            from model_bert_fine_tuned import predict_ner, predict_relation
-            
-            # Obtenir le résultat principal de l'extraction de relation
-            result = predict_relation(text, instruction)
-            
-            # Analyser l'instruction avec NER pour extraire les entités
-            try:
-                app.logger.info(f"Analyse NER de l'instruction: {instruction[:50]}...")
-                instruction_ner_result = predict_ner(instruction)
-                if instruction_ner_result and 'entities' in instruction_ner_result:
-                    # Ajouter les entités de l'instruction au résultat
-                    result['instruction_entities'] = instruction_ner_result['entities']
-                    app.logger.info(f"Entités extraites de l'instruction: {len(instruction_ner_result['entities'])}")
-            except Exception as e:
-                app.logger.error(f"Erreur lors de l'analyse NER de l'instruction: {str(e)}")
-                # Ne pas interrompre le flux principal si l'analyse NER échoue
-        else:
-            # Cas standard pour les autres types de modèles
-            from model_bert_fine_tuned import predict
-            result = predict(text, instruction, model_type)
-        
-        # Vérifier la sérialisabilité
-        try:
-            # Essayer de sérialiser le résultat avant de le renvoyer
-            json.dumps(result)
-        except TypeError as e:
-            app.logger.error(f"Erreur de sérialisation JSON: {str(e)}")
-            # Si une erreur se produit, essayer de nettoyer le résultat
-            import numpy as np
-            
-            def clean_for_json(obj):
-                if isinstance(obj, (np.integer, np.floating)):
-                    return float(obj)
-                elif isinstance(obj, np.ndarray):
-                    return obj.tolist()
-                elif isinstance(obj, list):
-                    return [clean_for_json(item) for item in obj]
-                elif isinstance(obj, dict):
-                    return {key: clean_for_json(value) for key, value in obj.items()}
-                return obj
-            
-            result = clean_for_json(result)
+        result = run_prediction(text, model_type, instruction, analyze_instruction, long_document, input_ids,
+                                pair_options, data.get('id'), data.get('timestamp'))
         
-        return jsonify(result)
+        # Encodage en un seul passage (les types NumPy résiduels sont gérés par l'encodeur)
+        with metrics.span("json_encode", model_type, len(text)):
+            return Response(dumps_bytes(result), mimetype='application/json')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         app.logger.error(f"Erreur pendant la prédiction: {str(e)}")
         app.logger.error(traceback.format_exc())
         return jsonify({'error': str(e), 'details': traceback.format_exc()}), 500
 
-def startup_check():
-    """Vérifie que tout est correctement configuré au démarrage"""
-    logger.info("Vérification de la configuration au démarrage...")
+def parse_batch_request(data, upload=None):
+    """Lit les paramètres d'une prédiction par lot (partagé par les serveurs WSGI et ASGI).
+
+    `data` contient les champs du formulaire quand `upload` (flux binaire, nom du fichier) est
+    fourni, sinon le corps JSON. Renvoie les enregistrements, le type de modèle, la taille des
+    paquets et l'option `force` ; lève ValueError si la requête n'est pas valide.
+    """
+    from model_bert_fine_tuned import MODEL_TYPES
     
-    # Vérifier les modèles Hugging Face
+    model_type = data.get('model_type', 'sentiment')
+    instruction = data.get('instruction', None)
+    chunk_size = int(data.get('chunk_size', 64))
+    if upload is not None:
+        stream, filename = upload
+        force = str(data.get('force', '')).lower() in ('1', 'true', 'yes')
+        records = iter_records(stream, filename, instruction)
+    else:
+        texts = data.get('texts')
+        force = bool(data.get('force', False))
+        if not isinstance(texts, list) or not texts:
+            raise ValueError('Liste de textes manquante')
+        records = iter_texts(texts, instruction)
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Type de modèle non valide: {model_type}")
+    return records, model_type, chunk_size, force
+
+@app.route('/api/predict/batch', methods=['POST'])
+def api_predict_batch():
+    """Prédit une liste de textes ou un fichier JSONL/CSV et renvoie les résultats en NDJSON au fil de l'eau"""
+    spooled = None
     try:
-        logger.info("Vérification des modèles Hugging Face...")
-        check_huggingface_models()
-    except Exception as e:
-        logger.error(f"Erreur lors de la vérification des modèles Hugging Face: {str(e)}")
+        if 'file' in request.files:
+            # Fichier téléversé : copié dans un fichier temporaire (Flask ferme les fichiers
+            # de la requête avant la fin du streaming) puis lu ligne par ligne
+            upload = request.files['file']
+            spooled = tempfile.TemporaryFile()
+            upload.save(spooled)
+            spooled.seek(0)
+            records, model_type, chunk_size, force = parse_batch_request(request.form, (spooled, upload.filename))
+        else:
+            data = request.get_json(silent=True)
+            records, model_type, chunk_size, force = parse_batch_request(data if isinstance(data, dict) else {})
+    except ValueError as e:
+        if spooled is not None:
+            spooled.close()
+        return jsonify({'error': str(e)}), 400
+    
+    app.logger.info(f"Analyse par lot demandée: model_type={model_type}")
+    
+    def generate():
+        try:
+            yield from _stream_predictions(records, model_type, chunk_size, force)
+        finally:
+            if spooled is not None:
+                spooled.close()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def predict_chunk(chunk, model_type, force=False):
+    """Prédit un paquet d'enregistrements, une sortie par enregistrement (partagé par les serveurs WSGI et ASGI).
+
+    Un texte quasi identique à un texte déjà analysé reçoit le sentiment de ce dernier,
+    avec la clé 'near_duplicate' ; `force` l'analyse tout de même.
+    """
+    from model_bert_fine_tuned import predict_batch
+    
+    outputs = [{'error': record.get('error', 'Texte manquant')} for record in chunk]
+    valid = [i for i, record in enumerate(chunk) if record['text'] and 'error' not in record]
+    if valid:
+        token_ids = [chunk[i].get('input_ids') for i in valid]
+        results = predict_batch([chunk[i]['text'] for i in valid],
+                                [chunk[i]['instruction'] for i in valid],
+                                model_type,
+                                token_ids=token_ids if any(ids is not None for ids in token_ids) else None,
+                                ids=[chunk[i]['id'] for i in valid], near_duplicates=True, force=force)
+        for i, result in zip(valid, results):
+            outputs[i] = {'result': result}
+            result_store.record(model_type, chunk[i]['text'], result, chunk[i]['id'], chunk[i]['timestamp'])
+    return outputs
+
+def encode_chunk(chunk, outputs, model_type, index):
+    """Encode les sorties d'un paquet en lignes NDJSON numérotées à partir de `index`"""
+    lines = []
+    for record, output in zip(chunk, outputs):
+        line = {'index': index, 'id': record['id']}
+        line.update(output)
+        index += 1
+        with metrics.span("json_encode", model_type, len(record['text'] or '')):
+            lines.append(dumps(line) + '\n')
+    return lines
+
+def _stream_predictions(records, model_type, chunk_size, force=False):
+    """Prédit les textes par paquets et produit une ligne NDJSON par texte"""
+    index = 0
+    for chunk in chunked(records, max(1, chunk_size)):
+        try:
+            outputs = predict_chunk(chunk, model_type, force)
+        except Exception as e:
+            app.logger.error(f"Erreur pendant la prédiction par lot: {str(e)}")
+            outputs = [{'error': str(e)} for _ in chunk]
+        yield from encode_chunk(chunk, outputs, model_type, index)
+        index += len(chunk)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def api_cache_stats():
+    """Renvoie les compteurs du cache de prédictions (succès, échecs, évictions) et de l'index des quasi-doublons"""
+    from near_duplicates import near_duplicate_index
+    return jsonify(dict(prediction_cache.get_stats(), near_duplicates=near_duplicate_index.get_stats()))
+
+def _store_query(query):
+    """Exécute une requête sur la base des résultats avec les bornes temporelles `since` et `until` de l'URL"""
+    if not result_store.enabled:
+        return jsonify({'error': "Base des résultats désactivée : définissez RESULT_STORE_DB"}), 404
+    try:
+        return jsonify(query(parse_bound(request.args.get('since')), parse_bound(request.args.get('until'))))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/store/entities', methods=['GET'])
+def api_store_entities():
+    """Renvoie les entités les plus citées (filtre optionnel `type`) avec le sentiment moyen des documents"""
+    return _store_query(lambda since, until: {'entities': result_store.top_entities(
+        request.args.get('type'), since, until, request.args.get('limit', 20))})
+
+@app.route('/api/store/entities/<path:name>/sentiment', methods=['GET'])
+def api_store_entity_sentiment(name):
+    """Renvoie le sentiment des documents citant une entité, au total et par période (`interval`)"""
+    return _store_query(lambda since, until: result_store.entity_sentiment(
+        name, request.args.get('type'), since, until, request.args.get('interval', 'day')))
+
+@app.route('/api/store/entities/<path:name>/relations', methods=['GET'])
+def api_store_entity_relations(name):
+    """Renvoie les relations d'une entité (filtre optionnel `label`)"""
+    return _store_query(lambda since, until: result_store.relations(
+        name, request.args.get('label'), since, until, request.args.get('limit', 50)))
+
+@app.route('/api/store/stats', methods=['GET'])
+def api_store_stats():
+    """Renvoie les compteurs d'écriture et la taille de la base des résultats"""
+    return jsonify(result_store.get_stats())
+
+@app.route('/api/models', methods=['GET'])
+def api_models():
+    """Renvoie l'état du registre des modèles (budget mémoire, modèles chargés, chargements et déchargements)
+    et les créneaux d'exécution de la session d'inférence"""
+    from model_bert_fine_tuned import model_cache, session
+    return jsonify(dict(model_cache.snapshot(), session=session.snapshot()))
+
+@app.route('/api/tiers', methods=['GET'])
+def api_tiers():
+    """Renvoie la part des textes de sentiment servis par l'élève et par le modèle complet, et leur taux d'accord"""
+    from tiered_inference import stats
+    return jsonify(stats.snapshot())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose les métriques au format texte Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profile', methods=['GET'])
+def debug_profile():
+    """Échantillonne les piles de tous les threads pendant quelques secondes (PROFILER_ENABLED=1)"""
+    if not metrics.PROFILER_ENABLED:
+        return jsonify({'error': 'Profileur désactivé'}), 404
+    try:
+        seconds = float(request.args.get('seconds', 5))
+        interval_ms = float(request.args.get('interval_ms', 10))
+    except ValueError:
+        return jsonify({'error': 'Paramètres de profilage non valides'}), 400
+    try:
+        app.logger.info(f"Profilage demandé pour {seconds} s")
+        return Response(metrics.sample_profile(seconds, interval_ms), mimetype='text/plain')
+    except metrics.ProfilerBusyError as e:
+        return jsonify({'error': str(e)}), 409
+
+def startup_check():
+    """Prépare les modèles au démarrage selon STARTUP_MODE"""
+    logger.info(f"Vérification de la configuration au démarrage (mode {STARTUP_MODE})...")
+    
+    if STARTUP_MODE == 'lazy':
+        # Les modèles seront chargés à la première requête
+        return
+    
+    from check_models import check_huggingface_models, create_model_placeholder
+    
+    if STARTUP_MODE == 'check':
+        # Vérifier les modèles Hugging Face
+        try:
+            logger.info("Vérification des modèles Hugging Face...")
+            check_huggingface_models()
+        except Exception as e:
+            logger.error(f"Erreur lors de la vérification des modèles Hugging Face: {str(e)}")
     
     # Créer des placeholders pour les modèles locaux si nécessaire
     try:
@@ -103,11 +321,21 @@ def startup_check():
     except Exception as e:
         logger.error(f"Erreur lors de la création des placeholders de modèles: {str(e)}")
     
+    if int(os.environ.get('WORKER_PROCESSES', 0)) > 0:
+        # Charger les modèles une fois, puis les partager entre plusieurs processus d'inférence
+        from workers import start_worker_pool
+        start_worker_pool()
+    elif STARTUP_MODE == 'background':
+        # Charger chaque modèle une seule fois dans model_cache, sans bloquer le serveur
+        readiness.start_background_warmup()
+    
     logger.info("Vérification terminée.")
 
 if __name__ == '__main__':
-    # Effectuer les vérifications au démarrage
-    startup_check()
+    # Effectuer les vérifications au démarrage, uniquement dans le processus qui sert les
+    # requêtes (le rechargeur du mode debug relance l'application dans un processus fils)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        startup_check()
     
     # Démarrer l'application
     app.run(debug=True)
\ No newline at end of file
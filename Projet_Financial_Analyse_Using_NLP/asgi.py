@@ -0,0 +1,289 @@
+"""
+Point d'entrée ASGI de l'application.
+Les prédictions sont exécutées sur un pool de threads de taille bornée : quand la
+file d'attente est pleine, la requête est refusée immédiatement (429) au lieu de
+laisser la latence croître sans limite. Chaque requête a un délai maximal : à son
+échéance ou à la déconnexion du client, son travail est annulé s'il n'a pas commencé,
+et sinon la requête est retirée du micro-batcher et libère aussitôt sa place dans le pool.
+La prédiction par lot passe elle aussi par ce pool, paquet par paquet. Les autres
+routes (pages, fichiers statiques, statistiques) sont servies par l'application Flask
+montée en dessous.
+
+Usage :
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.middleware.wsgi import WSGIMiddleware
+
+import app as flask_app
+import metrics
+from serialization import dumps_bytes
+
+logger = logging.getLogger(__name__)
+
+# Taille maximale des micro-batches (mêmes variables et même défaut que BATCHING_CONFIG dans
+# model_bert_fine_tuned.py, lu ici sans importer torch)
+_MAX_BATCH_SIZE = max(int(os.environ.get(f"BATCH_{model_type.upper()}_MAX_SIZE", 16))
+                      for model_type in ("sentiment", "ner", "relation", "analyze", "relation_pairs"))
+
+# Paramètres du pool d'inférence (surchargeables par variables d'environnement). Chaque thread
+# attend le résultat d'une seule requête : par défaut, il y en a autant que de places dans un
+# micro-batch de chaque processus d'inférence, pour que les batches puissent se remplir
+INFERENCE_WORKERS = (int(os.environ.get("INFERENCE_WORKERS", 0))
+                     or _MAX_BATCH_SIZE * max(1, int(os.environ.get("WORKER_PROCESSES", 0))))
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", 64))
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", 30))
+
+# Intervalle de vérification de la déconnexion du client, en secondes
+_DISCONNECT_POLL_INTERVAL = 0.1
+
+class InferenceQueueFullError(RuntimeError):
+    """Levée lorsque le pool d'inférence n'accepte plus de nouvelles requêtes"""
+
+class BoundedExecutor:
+    """Pool de threads dont le nombre de tâches en cours ou en attente est borné"""
+
+    def __init__(self, max_workers, max_queue_size):
+        self.capacity = max_workers + max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference")
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise InferenceQueueFullError(f"File d'inférence pleine ({self.capacity} requêtes)")
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        # Libère la place à la fin de la tâche, ou dès son annulation si elle n'a pas démarré
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def pending(self):
+        return self._pending
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+if INFERENCE_WORKERS < _MAX_BATCH_SIZE:
+    logger.warning(f"INFERENCE_WORKERS={INFERENCE_WORKERS} est inférieur à la taille maximale des micro-batches "
+                   f"({_MAX_BATCH_SIZE}) : les batches ne regrouperont pas plus de {INFERENCE_WORKERS} requêtes")
+
+executor = BoundedExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+metrics.register_gauge("inference_executor_pending", "Requêtes en cours ou en attente dans le pool d'inférence",
+                       lambda: [({}, executor.pending())])
+
+async def _wait_for_disconnect(request):
+    while not await request.is_disconnected():
+        await asyncio.sleep(_DISCONNECT_POLL_INTERVAL)
+
+def _run_scoped(deadline, abandoned, fn, *args):
+    from model_bert_fine_tuned import request_scope
+
+    with request_scope(deadline, abandoned):
+        return fn(*args)
+
+async def run_in_executor(request, fn, *args):
+    """Exécute une prédiction sur le pool borné, avec délai maximal et annulation à la déconnexion"""
+    abandoned = threading.Event()
+    future = executor.submit(_run_scoped, time.monotonic() + INFERENCE_TIMEOUT, abandoned, fn, *args)
+    result = asyncio.wrap_future(future)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(request))
+
+    def abandon():
+        # Une tâche en attente est annulée ; une tâche démarrée cesse d'attendre son batch
+        future.cancel()
+        abandoned.set()
+        result.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    try:
+        done, _ = await asyncio.wait({result, disconnect}, timeout=INFERENCE_TIMEOUT,
+                                     return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # Réponse en streaming interrompue par la déconnexion du client
+        abandon()
+        raise
+    finally:
+        disconnect.cancel()
+    if result in done:
+        from model_bert_fine_tuned import RequestAbandonedError
+
+        try:
+            return result.result()
+        except RequestAbandonedError:
+            # Échéance atteinte par la tâche juste avant le délai d'attente de la requête
+            raise asyncio.TimeoutError()
+    abandon()
+    if disconnect in done:
+        raise ConnectionAbortedError("Client déconnecté")
+    raise asyncio.TimeoutError()
+
+@asynccontextmanager
+async def lifespan(_):
+    flask_app.startup_check()
+    yield
+    executor.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+async def _json_object(request):
+    """Lit le corps JSON de la requête ; lève ValueError s'il n'est pas un objet JSON valide"""
+    try:
+        data = await request.json()
+    except ValueError:
+        raise ValueError('Corps de requête JSON non valide')
+    if not isinstance(data, dict):
+        raise ValueError('Le corps de la requête doit être un objet JSON')
+    return data
+
+@app.post('/api/predict')
+async def api_predict(request: Request):
+    from model_bert_fine_tuned import BatchQueueFullError, MODEL_TYPES
+
+    try:
+        data = await _json_object(request)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    text = data.get('text', '')
+    model_type = data.get('model_type', 'sentiment')
+
+    if not text:
+        return JSONResponse({'error': 'Texte manquant'}, status_code=400)
+    if not isinstance(text, str):
+        return JSONResponse({'error': 'Le champ text doit être une chaîne'}, status_code=400)
+    if model_type not in MODEL_TYPES:
+        return JSONResponse({'error': f"Type de modèle non valide: {model_type}"}, status_code=400)
+
+    try:
+        logger.info(f"Analyse demandée: model_type={model_type}, texte={text[:50]}...")
+        result = await run_in_executor(request, flask_app.run_prediction, text, model_type,
+                                       data.get('instruction', None), data.get('analyze_instruction', False),
+                                       data.get('long_document', False), data.get('input_ids', None),
+                                       data.get('pair_options', None), data.get('id'), data.get('timestamp'))
+        with metrics.span("json_encode", model_type, len(text)):
+            return Response(dumps_bytes(result), media_type='application/json')
+    except (InferenceQueueFullError, BatchQueueFullError) as e:
+        logger.warning(f"Requête refusée, serveur saturé: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=429, headers={'Retry-After': '1'})
+    except asyncio.TimeoutError:
+        logger.warning(f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)")
+        return JSONResponse({'error': f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)"}, status_code=503)
+    except ConnectionAbortedError:
+        logger.info("Client déconnecté avant la fin de la prédiction")
+        return JSONResponse({'error': 'Client déconnecté'}, status_code=499)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        logger.error(f"Erreur pendant la prédiction: {str(e)}")
+        logger.error(traceback.format_exc())
+        return JSONResponse({'error': str(e), 'details': traceback.format_exc()}, status_code=500)
+
+async def _predict_chunk(request, chunk, model_type, force):
+    """Prédit un paquet sur le pool borné ; une erreur de prédiction devient une ligne d'erreur par texte"""
+    from model_bert_fine_tuned import BatchQueueFullError
+
+    try:
+        return await run_in_executor(request, flask_app.predict_chunk, chunk, model_type, force)
+    except (InferenceQueueFullError, BatchQueueFullError, asyncio.TimeoutError, ConnectionAbortedError):
+        raise
+    except Exception as e:
+        logger.error(f"Erreur pendant la prédiction par lot: {str(e)}")
+        return [{'error': str(e)} for _ in chunk]
+
+@app.post('/api/predict/batch')
+async def api_predict_batch(request: Request):
+    """Prédit une liste de textes ou un fichier JSONL/CSV et renvoie les résultats en NDJSON au fil de l'eau.
+
+    Chaque paquet passe par le pool borné. Le premier paquet est prédit avant l'envoi de la
+    réponse, ce qui permet encore de refuser la requête (429, 503) ; pour les paquets suivants,
+    un refus ou un délai dépassé produit une ligne d'erreur par texte du paquet.
+    """
+    from model_bert_fine_tuned import BatchQueueFullError
+    from batch_io import chunked
+
+    form = None
+    try:
+        if request.headers.get('content-type', '').startswith('multipart/form-data'):
+            form = await request.form()
+            upload = form.get('file')
+            if upload is None or isinstance(upload, str):
+                raise ValueError('Fichier manquant')
+            params = flask_app.parse_batch_request(form, (upload.file, upload.filename))
+        else:
+            params = flask_app.parse_batch_request(await _json_object(request))
+        records, model_type, chunk_size, force = params
+        logger.info(f"Analyse par lot demandée: model_type={model_type}")
+        chunks = chunked(records, max(1, chunk_size))
+        first = next(chunks, [])
+        outputs = await _predict_chunk(request, first, model_type, force) if first else []
+    except BaseException as e:
+        if form is not None:
+            await form.close()
+        if isinstance(e, ValueError):
+            return JSONResponse({'error': str(e)}, status_code=400)
+        if isinstance(e, (InferenceQueueFullError, BatchQueueFullError)):
+            logger.warning(f"Requête refusée, serveur saturé: {str(e)}")
+            return JSONResponse({'error': str(e)}, status_code=429, headers={'Retry-After': '1'})
+        if isinstance(e, asyncio.TimeoutError):
+            logger.warning(f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)")
+            return JSONResponse({'error': f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)"}, status_code=503)
+        if isinstance(e, ConnectionAbortedError):
+            logger.info("Client déconnecté avant la fin de la prédiction")
+            return JSONResponse({'error': 'Client déconnecté'}, status_code=499)
+        raise
+
+    async def generate():
+        chunk, chunk_outputs, index = first, outputs, 0
+        try:
+            while chunk:
+                for line in flask_app.encode_chunk(chunk, chunk_outputs, model_type, index):
+                    yield line
+                index += len(chunk)
+                chunk = next(chunks, [])
+                if not chunk:
+                    return
+                try:
+                    chunk_outputs = await _predict_chunk(request, chunk, model_type, force)
+                except (InferenceQueueFullError, BatchQueueFullError) as e:
+                    logger.warning(f"Paquet refusé, serveur saturé: {str(e)}")
+                    chunk_outputs = [{'error': str(e)} for _ in chunk]
+                except asyncio.TimeoutError:
+                    logger.warning(f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)")
+                    chunk_outputs = [{'error': f"Délai de prédiction dépassé ({INFERENCE_TIMEOUT} s)"}] * len(chunk)
+                except ConnectionAbortedError:
+                    logger.info("Client déconnecté pendant la prédiction par lot")
+                    return
+        finally:
+            if form is not None:
+                await form.close()
+
+    return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+@app.get('/api/inference/stats')
+async def api_inference_stats():
+    """Renvoie l'occupation du pool d'inférence"""
+    return {'pending': executor.pending(), 'capacity': executor.capacity, 'workers': INFERENCE_WORKERS}
+
+# Toutes les autres routes sont servies par l'application Flask
+app.mount('/', WSGIMiddleware(flask_app.app))
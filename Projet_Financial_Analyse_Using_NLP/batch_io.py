@@ -0,0 +1,105 @@
+"""
+Lecture de corpus pour le traitement par lots.
+Ce module lit des textes depuis une liste, un fichier JSONL ou un fichier CSV
+de façon paresseuse, afin que la mémoire reste constante quelle que soit la
+taille de l'entrée.
+"""
+
+import csv
+import io
+import json
+import logging
+from datetime import datetime, timezone
+from itertools import islice
+
+logger = logging.getLogger(__name__)
+
+# Champs acceptés pour l'horodatage de publication d'un texte
+_TIMESTAMP_FIELDS = ("timestamp", "published_at", "date", "time")
+
+def parse_timestamp(value):
+    """Convertit un horodatage (secondes ou millisecondes epoch, date ISO 8601) en secondes epoch"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) / 1000.0 if value > 1e11 else float(value)
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def _normalize_record(record, default_instruction=None):
+    """Convertit une ligne d'entrée (texte brut ou objet) en dictionnaire standard"""
+    if isinstance(record, str):
+        record = {"text": record}
+    elif not isinstance(record, dict):
+        raise ValueError(f"Entrée non valide: {record!r}")
+    for field in ("text", "instruction"):
+        if record.get(field) is not None and not isinstance(record[field], str):
+            raise ValueError(f"Le champ '{field}' doit être une chaîne: {record[field]!r}")
+    return {
+        "id": record.get("id"),
+        "text": record.get("text") or "",
+        "instruction": record.get("instruction") or default_instruction,
+        # IDs de tokens déjà calculés par l'appelant (optionnels)
+        "input_ids": record.get("input_ids"),
+        # Horodatage de publication (secondes epoch), s'il est fourni
+        "timestamp": next((t for t in (parse_timestamp(record.get(f)) for f in _TIMESTAMP_FIELDS)
+                           if t is not None), None)
+    }
+
+def iter_jsonl(stream, default_instruction=None):
+    """Parcourt un flux JSONL binaire ou texte, une ligne par texte"""
+    for line_number, line in enumerate(stream, start=1):
+        try:
+            # UnicodeDecodeError hérite de ValueError : une ligne mal encodée ne donne qu'une ligne d'erreur
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            line = line.strip()
+            if not line:
+                continue
+            yield _normalize_record(json.loads(line), default_instruction)
+        except ValueError as e:
+            logger.warning(f"Ligne JSONL {line_number} ignorée: {str(e)}")
+            yield {"id": None, "text": "", "instruction": None, "input_ids": None, "timestamp": None,
+                   "error": f"Ligne {line_number} non valide: {str(e)}"}
+
+def iter_csv(stream, default_instruction=None):
+    """Parcourt un flux CSV possédant une colonne 'text' (et optionnellement 'id', 'instruction')"""
+    if not isinstance(stream, io.TextIOBase):
+        stream = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    reader = csv.DictReader(stream)
+    if reader.fieldnames is None or "text" not in reader.fieldnames:
+        raise ValueError("Le fichier CSV doit contenir une colonne 'text'")
+    return (_normalize_record(row, default_instruction) for row in reader)
+
+def iter_records(stream, filename, default_instruction=None):
+    """Choisit le lecteur adapté selon l'extension du fichier"""
+    name = (filename or "").lower()
+    if name.endswith(".csv"):
+        return iter_csv(stream, default_instruction)
+    if name.endswith((".jsonl", ".ndjson", ".json")):
+        return iter_jsonl(stream, default_instruction)
+    raise ValueError(f"Format de fichier non pris en charge: {filename}. Utilisez .jsonl ou .csv")
+
+def iter_texts(texts, default_instruction=None):
+    """Parcourt une liste de textes (ou d'objets) reçue en JSON"""
+    for position, record in enumerate(texts):
+        try:
+            yield _normalize_record(record, default_instruction)
+        except ValueError as e:
+            logger.warning(f"Élément {position} de la liste ignoré: {str(e)}")
+            yield {"id": None, "text": "", "instruction": None, "input_ids": None, "timestamp": None,
+                   "error": f"Élément {position} non valide: {str(e)}"}
+
+def chunked(iterable, size):
+    """Découpe un itérable en listes de taille `size` sans le charger entièrement"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,494 @@
+"""
+Banc d'essai de latence et de débit pour chaque type de modèle.
+Le banc balaie des tailles de batch, des longueurs de séquence et des niveaux de
+concurrence, puis écrit les résultats en JSON : latences p50/p95/p99, textes par
+seconde, pic de mémoire résidente et répartition entre tokenisation et passage avant.
+Chaque configuration est mesurée dans un processus neuf, si bien que le pic de mémoire
+rapporté est propre à cette configuration.
+Deux exécutions peuvent ensuite être comparées pour signaler les régressions.
+Le test de charge `stress` augmente le nombre de clients simultanés à partir d'un
+cache de modèles vide et vérifie que le débit reste stable et qu'aucun modèle n'est
+chargé deux fois.
+
+Usage :
+    python benchmark.py run --stand-in --output resultats.json
+    python benchmark.py compare reference.json resultats.json --threshold 0.10
+    python benchmark.py stress --stand-in --clients 1 2 4 8 16 32
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+import metrics
+import model_bert_fine_tuned as models
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_MODEL_TYPES = ("sentiment", "ner", "relation")
+
+# Mots d'un seul token dans le vocabulaire bert-base-uncased, pour générer des textes de longueur donnée
+_WORDS = ("the company reported strong revenue growth while shares of the bank fell after the "
+          "market closed and investors sold stock as profit and price forecasts were cut").split()
+
+def make_text(tokens, seed=0):
+    """Génère un texte d'environ `tokens` tokens"""
+    rng = np.random.default_rng(seed)
+    return " ".join(rng.choice(_WORDS, size=max(1, tokens - 2)))
+
+def create_stand_in_models(directory):
+    """Crée de petits modèles BERT aléatoires pour exécuter le banc sans accès au Hub"""
+    from transformers import BertConfig, BertForSequenceClassification, BertForTokenClassification, BertTokenizerFast
+
+    tokenizer = BertTokenizerFast.from_pretrained(models.model_relation_extraction_path)
+
+    def config(**kwargs):
+        return BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=128, num_hidden_layers=2,
+                          num_attention_heads=2, intermediate_size=512, **kwargs)
+
+    sentiment_labels = ["Negative", "Neutral", "Positive"]
+    ner_labels = ["O"] + [f"{prefix}-{label}" for label in ("CORP", "CW", "DATE", "MONEY", "PERCENT", "PERSON", "PRODUCT")
+                          for prefix in ("B", "I")]
+    stand_ins = {
+        "sentiment": BertForSequenceClassification(config(num_labels=3, id2label=dict(enumerate(sentiment_labels)),
+                                                          label2id={l: i for i, l in enumerate(sentiment_labels)})),
+        "ner": BertForTokenClassification(config(num_labels=len(ner_labels), id2label=dict(enumerate(ner_labels)),
+                                                 label2id={l: i for i, l in enumerate(ner_labels)})),
+        "relation": BertForSequenceClassification(config(num_labels=29))
+    }
+    paths = {}
+    for name, model in stand_ins.items():
+        paths[name] = os.path.join(directory, name)
+        model.save_pretrained(paths[name])
+        tokenizer.save_pretrained(paths[name])
+    return paths
+
+def use_stand_in_models(directory):
+    """Redirige le module de modèles vers des modèles de substitution générés localement"""
+    paths = create_stand_in_models(directory)
+    models.sentiment_model_name = paths["sentiment"]
+    models.ner_model_name = paths["ner"]
+    models.model_relation_extraction_path = paths["relation"]
+    models.model_cache.clear()
+    return paths
+
+def _unload_models():
+    for key in [key for key in models.model_cache if not key.startswith("batcher_")]:
+        del models.model_cache[key]
+
+def use_backend(backend):
+    """Sélectionne le moteur d'exécution de tous les modèles et vide le cache des modèles chargés"""
+    for model_type in models.INFERENCE_BACKENDS:
+        models.INFERENCE_BACKENDS[model_type] = backend
+    _unload_models()
+
+def _batch_function(model_type):
+    return {
+        "sentiment": models.predict_sentiment_batch,
+        "ner": models.predict_ner_batch,
+        "relation": models.predict_relation_batch
+    }[model_type]
+
+def _percentiles(latencies):
+    values = np.asarray(latencies) * 1000
+    return {f"p{q}_ms": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+def _peak_rss_mb():
+    # Sous Linux, ru_maxrss conserve après fork + exec le pic du processus parent ; VmHWM ne
+    # concerne que l'espace mémoire du processus courant
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss est exprimé en kilo-octets sous Linux et en octets sous macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _span_totals():
+    """Durée cumulée de chaque étape chronométrée, tous types de modèles confondus"""
+    totals = {}
+    with metrics.span_seconds._lock:
+        for (name, _model_type, _bucket), (_counts, total, _count) in metrics.span_seconds._series.items():
+            totals[name] = totals.get(name, 0.0) + total
+    return totals
+
+def bench_batch(model_type, batch_size, seq_len, iterations):
+    """Mesure la latence d'un lot complet et sa répartition tokenisation / passage avant"""
+    batch_fn = _batch_function(model_type)
+    texts = [make_text(seq_len, seed=i) for i in range(batch_size)]
+
+    # La répartition est lue dans les étapes chronométrées pendant l'appel mesuré lui-même
+    metrics.METRICS_ENABLED = True
+    batch_fn(texts)  # préchauffage
+    latencies, tokenize_times, forward_times = [], [], []
+    for _ in range(iterations):
+        before = _span_totals()
+        start = time.perf_counter()
+        batch_fn(texts)
+        latencies.append(time.perf_counter() - start)
+        after = _span_totals()
+        tokenize_times.append(after.get("tokenize", 0.0) - before.get("tokenize", 0.0))
+        forward_times.append(after.get("forward", 0.0) - before.get("forward", 0.0))
+
+    return dict(_percentiles(latencies),
+                texts_per_sec=batch_size * iterations / sum(latencies),
+                tokenize_ms=float(np.mean(tokenize_times) * 1000),
+                forward_ms=float(np.mean(forward_times) * 1000))
+
+def bench_concurrency(model_type, concurrency, seq_len, requests):
+    """Mesure la latence par requête de clients concurrents passant par predict()"""
+    texts = [make_text(seq_len, seed=i) for i in range(requests)]
+
+    def call(text):
+        start = time.perf_counter()
+        models.predict(text, model_type=model_type)
+        return time.perf_counter() - start
+
+    models.predict(texts[0], model_type=model_type)  # préchauffage
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(call, texts))
+    elapsed = time.perf_counter() - start
+    return dict(_percentiles(latencies), texts_per_sec=requests / elapsed)
+
+def _call_function(model_type, mode):
+    """Appel d'un client : predict() passe par les micro-batchers, « direct » exécute les modèles depuis le thread du client"""
+    if mode == "direct":
+        return lambda text: models._predict_batch_uncached([text], None, model_type, None)
+    return lambda text: models.predict(text, model_type=model_type)
+
+def bench_clients(model_type, mode, clients, seq_len, requests):
+    """Mesure le débit et la latence de `clients` threads qui démarrent ensemble et se partagent `requests` requêtes"""
+    call = _call_function(model_type, mode)
+    texts = [make_text(seq_len, seed=i) for i in range(requests)]
+    barrier = threading.Barrier(clients + 1)
+    latencies = [[] for _ in range(clients)]
+
+    def client(index):
+        barrier.wait()
+        for text in texts[index::clients]:
+            start = time.perf_counter()
+            call(text)
+            latencies[index].append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [executor.submit(client, index) for index in range(clients)]
+        barrier.wait()
+        start = time.perf_counter()
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+    return dict(_percentiles([value for values in latencies for value in values]), texts_per_sec=requests / elapsed)
+
+def _stress_sweep(args):
+    """Pour chaque type de modèle et chaque mode, augmente le nombre de clients à partir d'un cache de modèles vide"""
+    results = []
+    for model_type in args.model_types:
+        for mode in args.modes:
+            _unload_models()
+            registry = models.model_cache
+            loads, evictions = registry.counters["loads"], registry.counters["evictions"]
+            # Démarrage à froid : tous les clients demandent en même temps des modèles non chargés
+            clients = max(args.clients)
+            start = time.perf_counter()
+            bench_clients(model_type, mode, clients, args.seq_len, clients)
+            cold_start = time.perf_counter() - start
+            peak = 0.0
+            for clients in args.clients:
+                entry = {"model_type": model_type, "mode": mode, "clients": clients, "seq_len": args.seq_len}
+                entry.update(bench_clients(model_type, mode, clients, args.seq_len, args.requests))
+                entry["relative_throughput"] = entry["texts_per_sec"] / peak if peak else 1.0
+                entry["stable"] = entry["relative_throughput"] >= 1 - args.tolerance
+                peak = max(peak, entry["texts_per_sec"])
+                results.append(entry)
+                logger.info(f"{entry}")
+            loaded = len([key for key in registry if not key.startswith("batcher_")])
+            new_loads = registry.counters["loads"] - loads
+            # Sans déchargement, chaque modèle présent dans le registre ne doit avoir été chargé qu'une fois
+            duplicates = new_loads - loaded if registry.counters["evictions"] == evictions else None
+            results.append({"model_type": model_type, "mode": mode, "cold_start_seconds": cold_start,
+                            "loads": new_loads, "models": loaded, "duplicate_loads": duplicates})
+    return results
+
+def stress(args):
+    """Test de charge : débit par nombre de clients simultanés et chargements en double"""
+    models.prediction_cache.max_entries = 0
+    models.prediction_cache._db = None
+
+    if args.stand_in:
+        with tempfile.TemporaryDirectory(prefix="benchmark-models-") as directory:
+            use_stand_in_models(directory)
+            results = _stress_sweep(args)
+    else:
+        results = _stress_sweep(args)
+
+    print(f"{'modèle':<10}{'mode':<9}{'clients':>8}{'p50 ms':>10}{'p95 ms':>10}{'textes/s':>11}{'relatif':>9}")
+    for entry in results:
+        if "clients" in entry:
+            print(f"{entry['model_type']:<10}{entry['mode']:<9}{entry['clients']:>8}{entry['p50_ms']:>10.2f}"
+                  f"{entry['p95_ms']:>10.2f}{entry['texts_per_sec']:>11.1f}{entry['relative_throughput']:>9.2f}"
+                  f"{'' if entry['stable'] else '  INSTABLE'}")
+        else:
+            print(f"{entry['model_type']:<10}{entry['mode']:<9}démarrage à froid {entry['cold_start_seconds']:.2f} s, "
+                  f"{entry['loads']} chargement(s) pour {entry['models']} modèle(s), "
+                  f"doublons: {entry['duplicate_loads']}")
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "torch": torch.__version__,
+            "cpu_count": os.cpu_count(),
+            "session": models.session.snapshot(),
+            "batching_enabled": models.BATCHING_ENABLED,
+            "stand_in": args.stand_in,
+            "tolerance": args.tolerance
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Résultats écrits dans {args.output}")
+    unstable = [entry for entry in results if entry.get("stable") is False]
+    duplicated = [entry for entry in results if entry.get("duplicate_loads")]
+    return 1 if unstable or duplicated else 0
+
+def _run_configuration(paths, onnx_dir, backend, bench, *bench_args):
+    """Exécute une configuration dans le processus courant et y ajoute son pic de mémoire résidente"""
+    models.prediction_cache.max_entries = 0
+    models.prediction_cache._db = None
+    if paths:
+        models.sentiment_model_name = paths["sentiment"]
+        models.ner_model_name = paths["ner"]
+        models.model_relation_extraction_path = paths["relation"]
+    if onnx_dir:
+        import onnx_backend
+        onnx_backend.ONNX_MODEL_DIR = onnx_dir
+    use_backend(backend)
+    return dict(bench(*bench_args), peak_rss_mb=_peak_rss_mb())
+
+def _measure(paths, onnx_dir, backend, bench, *bench_args):
+    """Mesure une configuration dans un processus neuf : le pic de mémoire ne redescend jamais au sein d'un processus"""
+    # spawn : un fork hériterait du pic de mémoire du processus parent
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(_run_configuration, paths, onnx_dir, backend, bench, *bench_args).result()
+
+def _sweep(args, paths=None, onnx_dir=None):
+    """Exécute toutes les combinaisons de paramètres demandées"""
+    results = []
+    for backend in args.backends:
+        for model_type in args.model_types:
+            for batch_size in args.batch_sizes:
+                for seq_len in args.seq_lens:
+                    entry = {"model_type": model_type, "backend": backend, "mode": "batch", "batch_size": batch_size,
+                             "seq_len": seq_len, "concurrency": 1}
+                    entry.update(_measure(paths, onnx_dir, backend, bench_batch, model_type, batch_size, seq_len,
+                                          args.iterations))
+                    results.append(entry)
+                    logger.info(f"{entry}")
+            for concurrency in args.concurrency:
+                entry = {"model_type": model_type, "backend": backend, "mode": "concurrent", "batch_size": 1,
+                         "seq_len": args.seq_lens[0], "concurrency": concurrency}
+                entry.update(_measure(paths, onnx_dir, backend, bench_concurrency, model_type, concurrency,
+                                      args.seq_lens[0], args.requests))
+                results.append(entry)
+                logger.info(f"{entry}")
+    if len(args.backends) > 1:
+        _print_backends(results, args.backends)
+    return results
+
+def _print_backends(results, backends):
+    """Affiche les latences p50 et débits des moteurs d'exécution côte à côte"""
+    rows = {}
+    for entry in results:
+        key = (entry["model_type"], entry["mode"], entry["batch_size"], entry["seq_len"], entry["concurrency"])
+        rows.setdefault(key, {})[entry["backend"]] = entry
+    header = "".join(f"{backend + ' p50 ms':>16}{backend + ' textes/s':>18}" for backend in backends)
+    print(f"{'modèle':<10}{'mode':<11}{'batch':>6}{'seq':>6}{'conc':>6}{header}")
+    for (model_type, mode, batch_size, seq_len, concurrency), entries in rows.items():
+        columns = "".join(f"{entries[b]['p50_ms']:>16.2f}{entries[b]['texts_per_sec']:>18.1f}" if b in entries
+                          else f"{'-':>16}{'-':>18}" for b in backends)
+        print(f"{model_type:<10}{mode:<11}{batch_size:>6}{seq_len:>6}{concurrency:>6}{columns}")
+
+def run(args):
+    # Le cache des prédictions et les modèles sont configurés dans le processus de chaque configuration
+    if args.stand_in:
+        with tempfile.TemporaryDirectory(prefix="benchmark-models-") as directory:
+            paths = create_stand_in_models(directory)
+            # Les graphes des modèles de substitution sont exportés à côté d'eux
+            onnx_dir = os.path.join(directory, "onnx") if "onnx" in args.backends else None
+            logger.info(f"Modèles de substitution créés dans {directory}")
+            results = _sweep(args, paths, onnx_dir)
+    else:
+        results = _sweep(args)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu_count": os.cpu_count(),
+            "stand_in": args.stand_in,
+            "batching_enabled": models.BATCHING_ENABLED,
+            "backends": args.backends,
+            "optimized_inference": models.OPTIMIZED_INFERENCE
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Résultats écrits dans {args.output}")
+    return 0
+
+def _legacy_sentiment(probabilities, id2label):
+    # Ancien chemin : conversion ligne par ligne, puis conversion récursive et double encodage JSON
+    results = [models._format_sentiment([{"label": id2label[i], "score": float(score)} for i, score in enumerate(row)])
+               for row in probabilities]
+    results = models.convert_to_serializable(results)
+    json.dumps(results)
+    return json.dumps(results, cls=models.NumpyEncoder)
+
+def _legacy_relation(texts, probabilities):
+    results = []
+    for text, row in zip(texts, probabilities):
+        predicted_class = int(row.argmax())
+        results.append({"class": predicted_class, "label": models.relation_map.get(predicted_class),
+                        "probabilities": [float(p) for p in row], "entities": [], "text": text})
+    results = models.convert_to_serializable(results)
+    json.dumps(results)
+    return json.dumps(results, cls=models.NumpyEncoder)
+
+def postprocess(args):
+    """Micro-banc du post-traitement et de la sérialisation, sans passage dans les modèles"""
+    from serialization import dumps_bytes, FAST_JSON
+
+    rng = np.random.default_rng(0)
+    texts = [make_text(32, seed=i) for i in range(args.items)]
+    sentiment = rng.dirichlet(np.ones(3), size=args.items).astype(np.float32)
+    relation = rng.dirichlet(np.ones(29), size=args.items).astype(np.float32)
+    id2label = {0: "Negative", 1: "Neutral", 2: "Positive"}
+
+    candidates = {
+        "sentiment": {
+            "legacy": lambda: _legacy_sentiment(sentiment, id2label),
+            "vectorized": lambda: dumps_bytes(models._format_sentiment_batch(sentiment, id2label))
+        },
+        "relation": {
+            "legacy": lambda: _legacy_relation(texts, relation),
+            "vectorized": lambda: dumps_bytes(models._format_relation_batch(texts, relation, [[]] * len(texts)))
+        }
+    }
+    print(f"Encodeur JSON rapide: {'orjson' if FAST_JSON else 'non (json standard)'}")
+    for model_type, variants in candidates.items():
+        for variant, fn in variants.items():
+            fn()  # préchauffage
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                fn()
+                timings.append(time.perf_counter() - start)
+            print(f"{model_type:<10} {variant:<11} {min(timings) / args.items * 1e6:8.2f} µs par texte")
+    return 0
+
+def _result_key(entry):
+    # Les entrées du test de charge sont identifiées par leur nombre de clients, celles du banc par batch et concurrence
+    return tuple(entry.get(k) for k in ("model_type", "mode", "batch_size", "seq_len", "concurrency", "clients",
+                                        "backend"))
+
+def _describe(entry):
+    if "clients" in entry:
+        return f"clients={entry['clients']:<3} seq={entry['seq_len']:<4}"
+    return f"batch={entry['batch_size']:<3} seq={entry['seq_len']:<4} conc={entry['concurrency']:<3}"
+
+def compare(args):
+    """Compare deux exécutions (banc ou test de charge) et signale les régressions au-delà du seuil"""
+    with open(args.reference) as f:
+        reference = {_result_key(entry): entry for entry in json.load(f)["results"]}
+    with open(args.candidate) as f:
+        candidate = json.load(f)["results"]
+
+    regressions = 0
+    for entry in candidate:
+        before = reference.get(_result_key(entry))
+        # Les bilans de démarrage à froid du test de charge n'ont pas de latence à comparer
+        if before is None or "p50_ms" not in entry or "p50_ms" not in before:
+            continue
+        latency_change = entry["p50_ms"] / before["p50_ms"] - 1
+        throughput_change = entry["texts_per_sec"] / before["texts_per_sec"] - 1
+        regression = latency_change > args.threshold or throughput_change < -args.threshold
+        regressions += regression
+        print(f"{'REGRESSION' if regression else 'ok':<10} {entry['model_type']:<9} {entry.get('backend', 'torch'):<6} "
+              f"{entry['mode']:<10} {_describe(entry)} "
+              f"p50 {before['p50_ms']:.1f} -> {entry['p50_ms']:.1f} ms ({latency_change:+.1%})  "
+              f"débit {before['texts_per_sec']:.1f} -> {entry['texts_per_sec']:.1f} textes/s ({throughput_change:+.1%})")
+    print(f"{regressions} régression(s) au-delà de {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Banc d'essai de latence et de débit des modèles")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Exécute le banc d'essai")
+    run_parser.add_argument("--model-types", nargs="+", default=list(BENCHMARK_MODEL_TYPES),
+                            choices=BENCHMARK_MODEL_TYPES)
+    run_parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    run_parser.add_argument("--seq-lens", nargs="+", type=int, default=[32, 128, 512])
+    run_parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    run_parser.add_argument("--iterations", type=int, default=10)
+    run_parser.add_argument("--requests", type=int, default=64, help="Nombre de requêtes par niveau de concurrence")
+    run_parser.add_argument("--backends", nargs="+", default=["torch"], choices=["torch", "onnx"],
+                            help="Moteurs d'exécution à comparer")
+    run_parser.add_argument("--stand-in", action="store_true",
+                            help="Utilise de petits modèles BERT générés localement (hors ligne)")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = subparsers.add_parser("compare", help="Compare deux fichiers de résultats (run ou stress)")
+    compare_parser.add_argument("reference")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="Variation relative tolérée avant de signaler une régression")
+    compare_parser.set_defaults(handler=compare)
+
+    postprocess_parser = subparsers.add_parser("postprocess", help="Micro-banc du post-traitement et de la sérialisation")
+    postprocess_parser.add_argument("--items", type=int, default=1000)
+    postprocess_parser.add_argument("--repeat", type=int, default=20)
+    postprocess_parser.set_defaults(handler=postprocess)
+
+    stress_parser = subparsers.add_parser("stress", help="Test de charge à nombre de clients croissant")
+    stress_parser.add_argument("--model-types", nargs="+", default=list(BENCHMARK_MODEL_TYPES),
+                               choices=BENCHMARK_MODEL_TYPES)
+    stress_parser.add_argument("--modes", nargs="+", default=["predict", "direct"], choices=["predict", "direct"],
+                               help="predict : via les micro-batchers ; direct : modèles appelés depuis chaque client")
+    stress_parser.add_argument("--clients", nargs="+", type=int, default=[1, 2, 4, 8, 16, 32])
+    stress_parser.add_argument("--requests", type=int, default=256, help="Nombre de requêtes par niveau")
+    stress_parser.add_argument("--seq-len", type=int, default=64)
+    stress_parser.add_argument("--tolerance", type=float, default=0.2,
+                               help="Baisse de débit tolérée par rapport au meilleur niveau précédent")
+    stress_parser.add_argument("--stand-in", action="store_true",
+                               help="Utilise de petits modèles BERT générés localement (hors ligne)")
+    stress_parser.add_argument("--output", default="stress_results.json")
+    stress_parser.set_defaults(handler=stress)
+
+    args = parser.parse_args()
+    return args.handler(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
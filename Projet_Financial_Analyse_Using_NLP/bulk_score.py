@@ -0,0 +1,425 @@
+"""
+Analyse hors ligne d'un gros fichier de titres financiers, avec reprise après interruption.
+Le fichier d'entrée (CSV, JSONL ou Parquet) est lu par blocs de lignes, projeté en
+mémoire lorsque le format le permet. Chaque bloc est découpé en batches de textes de
+longueurs voisines, répartis sur les processus d'inférence, puis écrit dans sa propre
+partie Parquet ou Arrow : probabilités en tableaux de flottants de largeur fixe,
+entités et triplets en listes imbriquées. Un fichier de progression est réécrit après
+chaque bloc : une exécution interrompue reprend au premier bloc non écrit.
+
+Usage :
+    python bulk_score.py titres.parquet --output scores/ --model-type analyze --workers 4
+    python bulk_score.py titres.csv --output scores/ --model-type sentiment --format arrow
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import model_bert_fine_tuned as models
+from streaming import _write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+# Lignes par bloc (une partie de sortie et une étape de progression par bloc) et textes par batch
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", 4096))
+BULK_BATCH_SIZE = int(os.environ.get("BULK_BATCH_SIZE", 32))
+# Taille des blocs d'octets lus par le lecteur CSV d'Arrow
+BULK_CSV_BLOCK_BYTES = int(os.environ.get("BULK_CSV_BLOCK_BYTES", 16 << 20))
+
+BULK_INPUT_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet", ".pq": "parquet"}
+BULK_OUTPUT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+PROGRESS_FILE = "_progress.json"
+
+# Schéma d'une entité nommée, commun à la NER, aux entités de relation et aux triplets
+ENTITY_TYPE = pa.struct([("type", pa.string()), ("text", pa.string()), ("start", pa.int32()),
+                         ("end", pa.int32()), ("score", pa.float32())])
+TRIPLE_TYPE = pa.struct([("head", ENTITY_TYPE), ("tail", ENTITY_TYPE), ("class", pa.int16()),
+                         ("label", pa.string()), ("score", pa.float32()), ("distance", pa.int32())])
+
+def input_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in BULK_INPUT_FORMATS:
+        raise ValueError(f"Format d'entrée non pris en charge: {extension}. "
+                         f"Extensions acceptées: {', '.join(sorted(BULK_INPUT_FORMATS))}")
+    return BULK_INPUT_FORMATS[extension]
+
+def _record(raw, columns):
+    """Extrait l'identifiant, le texte et l'instruction d'une ligne selon les colonnes choisies"""
+    text_column, id_column, instruction_column = columns
+    if not isinstance(raw, dict):
+        return {"id": None, "text": str(raw), "instruction": None}
+    record_id = raw.get(id_column)
+    return {
+        "id": None if record_id is None else str(record_id),
+        "text": raw.get(text_column),
+        "instruction": raw.get(instruction_column) or None
+    }
+
+def _iter_jsonl(path, columns, start_offset=0):
+    """Lit un fichier JSONL projeté en mémoire, à partir d'une position en octets.
+
+    Produit des couples (enregistrement, position après la ligne) : la position permet
+    de reprendre la lecture sans relire le début du fichier.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        mapped.seek(start_offset)
+        while True:
+            line = mapped.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                record = _record(json.loads(line), columns)
+            except ValueError as e:
+                record = {"id": None, "text": None, "instruction": None, "error": f"JSON invalide: {str(e)}"}
+                logger.warning(f"Ligne JSON invalide à l'octet {mapped.tell() - len(line)} de {path}")
+            yield record, mapped.tell()
+
+def _require_text_column(names, columns, path):
+    if columns[0] not in names:
+        raise ValueError(f"Colonne de texte '{columns[0]}' absente de {path}. Colonnes disponibles: {', '.join(names)}")
+
+def _iter_arrow_batches(batches, columns, skip_rows=0):
+    """Convertit des RecordBatch Arrow en enregistrements, en sautant les `skip_rows` premières lignes"""
+    for batch in batches:
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        if skip_rows:
+            batch, skip_rows = batch.slice(skip_rows), 0
+        for raw in batch.to_pylist():
+            yield _record(raw, columns), None
+
+def _iter_csv(path, columns, skip_rows=0):
+    text_column, id_column, instruction_column = columns
+    # Les colonnes lues sont toutes converties en chaînes, les identifiants numériques compris
+    read_options = pa_csv.ReadOptions(block_size=BULK_CSV_BLOCK_BYTES)
+    header = pa_csv.open_csv(path, read_options=read_options).schema.names
+    _require_text_column(header, columns, path)
+    wanted = [c for c in (text_column, id_column, instruction_column) if c in header]
+    convert_options = pa_csv.ConvertOptions(include_columns=wanted, column_types={c: pa.string() for c in wanted})
+    reader = pa_csv.open_csv(path, read_options=read_options, convert_options=convert_options)
+    yield from _iter_arrow_batches(reader, columns, skip_rows)
+
+def _iter_parquet(path, columns, skip_rows=0, batch_rows=BULK_CHUNK_SIZE):
+    """Lit un fichier Parquet projeté en mémoire ; les groupes de lignes déjà traités ne sont pas décodés"""
+    parquet_file = pq.ParquetFile(path, memory_map=True)
+    _require_text_column(parquet_file.schema_arrow.names, columns, path)
+    wanted = [c for c in columns if c in parquet_file.schema_arrow.names]
+    row_groups, first_row = [], 0
+    for index in range(parquet_file.num_row_groups):
+        rows = parquet_file.metadata.row_group(index).num_rows
+        if first_row + rows <= skip_rows and not row_groups:
+            first_row += rows
+            continue
+        row_groups.append(index)
+    if not row_groups:
+        return
+    batches = parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups, columns=wanted)
+    yield from _iter_arrow_batches(batches, columns, skip_rows - first_row)
+
+def iter_chunks(path, columns, chunk_size=BULK_CHUNK_SIZE, start_row=0, start_offset=0):
+    """Découpe le fichier d'entrée en blocs de `chunk_size` lignes à partir de la ligne `start_row`.
+
+    Produit des couples (liste d'enregistrements, position en octets après le bloc) ; la
+    position n'est connue que pour le JSONL.
+    """
+    fmt = input_format(path)
+    if fmt == "jsonl":
+        records = _iter_jsonl(path, columns, start_offset)
+    elif fmt == "csv":
+        records = _iter_csv(path, columns, start_row)
+    else:
+        records = _iter_parquet(path, columns, start_row)
+
+    chunk, offset = [], None
+    for record, offset in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk, offset
+            chunk = []
+    if chunk:
+        yield chunk, offset
+
+def count_rows(path):
+    """Nombre de lignes du fichier : exact pour le Parquet, estimé d'après les sauts de ligne sinon"""
+    fmt = input_format(path)
+    if fmt == "parquet":
+        return pq.ParquetFile(path, memory_map=True).metadata.num_rows
+    if os.path.getsize(path) == 0:
+        return 0
+    lines = 0
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for start in range(0, len(mapped), 64 << 20):
+            lines += mapped[start:start + (64 << 20)].count(b"\n")
+        if mapped[-1:] != b"\n":
+            lines += 1
+    return max(0, lines - 1) if fmt == "csv" else lines
+
+def _sentiment_labels():
+    config = models.get_sentiment_pipeline().model.config
+    return [config.id2label[i] for i in range(config.num_labels)]
+
+def output_schema(model_type, sentiment_labels=None, keep_text=False):
+    """Schéma des parties de sortie d'un type de modèle"""
+    fields = [pa.field("row", pa.int64(), nullable=False), pa.field("id", pa.string())]
+    if keep_text:
+        fields.append(pa.field("text", pa.string()))
+    if model_type in ("sentiment", "analyze"):
+        fields += [pa.field("sentiment_label", pa.string()),
+                   pa.field("sentiment_probabilities", pa.list_(pa.float32(), len(sentiment_labels)))]
+    if model_type in ("ner", "analyze"):
+        fields.append(pa.field("entities", pa.list_(ENTITY_TYPE)))
+    if model_type in ("relation", "analyze"):
+        fields += [pa.field("relation_class", pa.int16()), pa.field("relation_label", pa.string()),
+                   pa.field("relation_probabilities", pa.list_(pa.float32(), len(models.relation_map)))]
+    if model_type == "relation_pairs":
+        fields += [pa.field("entities", pa.list_(ENTITY_TYPE)), pa.field("triples", pa.list_(TRIPLE_TYPE)),
+                   pa.field("truncated", pa.bool_())]
+    fields.append(pa.field("error", pa.string()))
+    metadata = {"model_type": model_type, "model_revision": json.dumps(models.model_revision(model_type))}
+    if sentiment_labels:
+        # Ordre des probabilités de sentiment : celui des labels du modèle, pas celui des scores
+        metadata["sentiment_labels"] = json.dumps(sentiment_labels)
+    return pa.schema(fields, metadata=metadata)
+
+def _entities(ner_result):
+    return [{"type": e["entity_group"], "text": e["word"], "start": e["start"], "end": e["end"], "score": e["score"]}
+            for e in ner_result["entities"]]
+
+def _result_row(model_type, result, sentiment_labels):
+    """Aplatit le résultat d'un texte en colonnes du schéma de sortie"""
+    row = {}
+    sentiment = result["sentiment"] if model_type == "analyze" else result
+    relation = result["relation"] if model_type == "analyze" else result
+    if model_type in ("sentiment", "analyze"):
+        scores = {p["label"]: p["score"] for p in sentiment["predictions"]}
+        row["sentiment_label"] = sentiment["label"]
+        row["sentiment_probabilities"] = [scores[label] for label in sentiment_labels]
+    if model_type in ("ner", "analyze"):
+        row["entities"] = _entities(result["ner"] if model_type == "analyze" else result)
+    if model_type in ("relation", "analyze"):
+        row["relation_class"] = relation["class"]
+        row["relation_label"] = relation["label"]
+        row["relation_probabilities"] = relation["probabilities"]
+    if model_type == "relation_pairs":
+        row["entities"] = result["entities"]
+        row["triples"] = [{key: triple[key] for key in ("head", "tail", "class", "label", "score", "distance")}
+                          for triple in result["triples"]]
+        row["truncated"] = result["truncated"]
+    return row
+
+def score_chunk(records, model_type, batch_size=BULK_BATCH_SIZE, executor=None):
+    """Analyse un bloc : batches de textes de longueurs voisines, exécutés en parallèle sur les processus d'inférence.
+
+    Les lignes sans texte reçoivent un message d'erreur au lieu d'un résultat ; une erreur
+    de modèle interrompt le traitement, le bloc sera réanalysé à la reprise.
+    """
+    results = [None] * len(records)
+    valid = []
+    for i, record in enumerate(records):
+        if record.get("error"):
+            continue
+        if isinstance(record["text"], str) and record["text"].strip():
+            valid.append(i)
+        else:
+            record["error"] = "Texte manquant"
+
+    batches = [[valid[i] for i in batch]
+               for batch in models._length_sorted_batches([len(records[i]["text"]) for i in valid], batch_size)]
+
+    def run(batch):
+        texts = [records[i]["text"] for i in batch]
+        instructions = [records[i]["instruction"] for i in batch]
+        # Appel direct aux modèles : un traitement hors ligne ne doit pas remplir le cache des prédictions
+        return models._run_batch(texts, instructions, model_type, batch_size)
+
+    outputs = executor.map(run, batches) if executor is not None else map(run, batches)
+    for batch, batch_results in zip(batches, outputs):
+        for i, result in zip(batch, batch_results):
+            results[i] = result
+    return results
+
+def build_table(records, results, first_row, schema, keep_text=False):
+    """Construit la table Arrow d'un bloc à partir des enregistrements et de leurs résultats"""
+    model_type = schema.metadata[b"model_type"].decode()
+    sentiment_labels = json.loads(schema.metadata.get(b"sentiment_labels", b"null"))
+    columns = {field.name: [] for field in schema}
+    for offset, (record, result) in enumerate(zip(records, results)):
+        row = {"row": first_row + offset, "id": record["id"], "error": record.get("error")}
+        if keep_text:
+            row["text"] = record["text"]
+        if result is not None:
+            row.update(_result_row(model_type, result, sentiment_labels))
+        for name, values in columns.items():
+            values.append(row.get(name))
+    return pa.Table.from_pydict(columns, schema=schema)
+
+def write_part(table, path, output_format):
+    """Écrit une partie via un fichier temporaire renommé, pour ne jamais laisser de partie incomplète"""
+    temporary = f"{path}.tmp"
+    if output_format == "parquet":
+        pq.write_table(table, temporary)
+    else:
+        with pa.OSFile(temporary, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temporary, path)
+
+def _format_duration(seconds):
+    seconds = int(max(0, seconds))
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class Progress:
+    """Affiche le débit et le temps restant estimé après chaque bloc"""
+
+    def __init__(self, total_rows, done_rows=0, stream=None):
+        self.total_rows = total_rows
+        self.initial_rows = done_rows
+        self.stream = stream or sys.stderr
+        self.start = time.monotonic()
+
+    def update(self, done_rows):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        rate = (done_rows - self.initial_rows) / elapsed
+        remaining = max(0, self.total_rows - done_rows)
+        eta = _format_duration(remaining / rate) if rate > 0 else "?"
+        percent = 100.0 * done_rows / self.total_rows if self.total_rows else 100.0
+        line = f"{done_rows}/{self.total_rows} lignes ({percent:.1f} %), {rate:.1f} lignes/s, temps restant {eta}"
+        if self.stream.isatty():
+            self.stream.write(f"\r{line}")
+            self.stream.flush()
+        else:
+            logger.info(line)
+        return {"rows": done_rows, "rows_per_second": rate, "eta": eta}
+
+    def close(self):
+        if self.stream.isatty():
+            self.stream.write("\n")
+
+def _input_fingerprint(path):
+    stat = os.stat(path)
+    return {"input": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+def _part_path(output_dir, index, output_format):
+    return os.path.join(output_dir, f"part-{index:06d}{BULK_OUTPUT_FORMATS[output_format]}")
+
+def load_progress(output_dir, settings, restart=False):
+    """Relit la progression d'une exécution précédente, si elle porte sur le même fichier avec les mêmes options"""
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    empty = dict(settings, chunks=0, rows=0, offset=0, completed=False)
+    if restart or not os.path.exists(path):
+        return empty
+    with open(path, encoding="utf-8") as f:
+        progress = json.load(f)
+    changed = [key for key in settings if progress.get(key) != settings[key]]
+    if changed:
+        raise ValueError(f"Le dossier {output_dir} contient une exécution aux paramètres différents "
+                         f"({', '.join(changed)}). Utilisez --restart pour la recommencer")
+    logger.info(f"Reprise après {progress['chunks']} bloc(s) et {progress['rows']} ligne(s) déjà écrits")
+    return progress
+
+def _remove_parts(output_dir):
+    for name in os.listdir(output_dir):
+        if name.startswith("part-") and name.endswith(tuple(BULK_OUTPUT_FORMATS.values()) + (".tmp",)):
+            os.remove(os.path.join(output_dir, name))
+
+def run(input_path, output_dir, model_type="analyze", output_format="parquet", chunk_size=BULK_CHUNK_SIZE,
+        batch_size=BULK_BATCH_SIZE, workers=0, columns=("text", "id", "instruction"), keep_text=False,
+        restart=False):
+    """Analyse tout le fichier d'entrée et écrit une partie par bloc dans `output_dir`.
+
+    Renvoie la progression finale (blocs, lignes, fichier d'entrée et options).
+    """
+    if model_type not in models.MODEL_TYPES:
+        raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez parmi {', '.join(models.MODEL_TYPES)}")
+    if output_format not in BULK_OUTPUT_FORMATS:
+        raise ValueError(f"Format de sortie non valide: {output_format}. Choisissez 'parquet' ou 'arrow'")
+    input_format(input_path)
+    os.makedirs(output_dir, exist_ok=True)
+
+    settings = dict(_input_fingerprint(input_path), model_type=model_type, format=output_format,
+                    chunk_size=chunk_size, columns=list(columns), keep_text=keep_text)
+    progress = load_progress(output_dir, settings, restart)
+    if restart:
+        _remove_parts(output_dir)
+    if progress.get("completed"):
+        logger.info(f"Le fichier {input_path} a déjà été entièrement analysé dans {output_dir}")
+        return progress
+
+    sentiment_labels = _sentiment_labels() if model_type in ("sentiment", "analyze") else None
+    schema = output_schema(model_type, sentiment_labels, keep_text)
+    pool = None
+    if workers > 0:
+        from workers import start_worker_pool
+        pool = start_worker_pool(workers)
+    executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bulk-score")
+    tracker = Progress(count_rows(input_path), progress["rows"])
+    try:
+        chunks = iter_chunks(input_path, columns, chunk_size, progress["rows"], progress["offset"])
+        for records, offset in chunks:
+            step = time.perf_counter()
+            results = score_chunk(records, model_type, batch_size, executor if pool is not None else None)
+            table = build_table(records, results, progress["rows"], schema, keep_text)
+            write_part(table, _part_path(output_dir, progress["chunks"], output_format), output_format)
+            # La progression n'est enregistrée qu'une fois la partie écrite
+            progress.update(chunks=progress["chunks"] + 1, rows=progress["rows"] + len(records),
+                            offset=offset or 0)
+            _write_json_atomic(os.path.join(output_dir, PROGRESS_FILE), progress)
+            tracker.total_rows = max(tracker.total_rows, progress["rows"])
+            tracker.update(progress["rows"])
+            logger.debug("Bloc %d analysé en %.1f ms", progress["chunks"] - 1, (time.perf_counter() - step) * 1000)
+        progress["completed"] = True
+        _write_json_atomic(os.path.join(output_dir, PROGRESS_FILE), progress)
+        return progress
+    except Exception as e:
+        logger.error(f"Erreur pendant l'analyse du bloc {progress['chunks']} de {input_path}: {str(e)}")
+        raise
+    finally:
+        tracker.close()
+        executor.shutdown()
+        if pool is not None:
+            pool.stop()
+            models.worker_pool = None
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Analyse hors ligne d'un fichier CSV, JSONL ou Parquet")
+    parser.add_argument("input", help="Fichier .csv, .jsonl ou .parquet à analyser")
+    parser.add_argument("--output", required=True, help="Dossier des parties de sortie et de la progression")
+    parser.add_argument("--model-type", choices=models.MODEL_TYPES, default="analyze")
+    parser.add_argument("--format", choices=sorted(BULK_OUTPUT_FORMATS), default="parquet")
+    parser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE, help="Lignes par bloc et par partie")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Processus d'inférence (0 : analyse dans le processus courant)")
+    parser.add_argument("--text-column", default="text")
+    parser.add_argument("--id-column", default="id")
+    parser.add_argument("--instruction-column", default="instruction")
+    parser.add_argument("--keep-text", action="store_true", help="Recopier le texte dans la sortie")
+    parser.add_argument("--restart", action="store_true",
+                        help="Ignorer la progression enregistrée et supprimer les parties existantes")
+    args = parser.parse_args()
+
+    progress = run(args.input, args.output, args.model_type, args.format, args.chunk_size, args.batch_size,
+                   args.workers, (args.text_column, args.id_column, args.instruction_column), args.keep_text,
+                   args.restart)
+    print(json.dumps({key: progress[key] for key in ("input", "model_type", "chunks", "rows")}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Session d'inférence partagée par tous les threads d'un processus.
+La session détient le registre des modèles : un modèle chargé par son intermédiaire
+est figé (mode évaluation, sans gradients) et n'est chargé qu'une fois, même si des
+requêtes concurrentes le demandent en même temps. Elle fixe au démarrage le nombre de
+threads de torch et découpe les cœurs en créneaux d'exécution : au plus
+`INFERENCE_SLOTS` passages avant s'exécutent en même temps, chacun avec
+`TORCH_THREADS` threads, si bien que les threads du serveur ne se disputent plus les
+mêmes cœurs. Chaque passage avant s'exécute en mode inférence (`torch.inference_mode`).
+Les tokenizers rapides ne supportant pas les appels concurrents qui changent leurs
+réglages de troncature, la session prête à chaque appelant sa propre copie.
+"""
+
+import copy
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+
+from model_registry import module_of
+
+logger = logging.getLogger(__name__)
+
+# Passages avant simultanés (0 : un créneau par groupe de quatre cœurs)
+INFERENCE_SLOTS = int(os.environ.get("INFERENCE_SLOTS", 0))
+# Threads intra-opération de torch par passage avant (0 : cœurs disponibles / créneaux)
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0))
+TORCH_INTEROP_THREADS = int(os.environ.get("TORCH_INTEROP_THREADS", 1))
+
+_CORES_PER_SLOT = 4
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+class _FairSlots:
+    """Sémaphore équitable : un créneau libéré est remis directement au plus ancien thread en attente.
+
+    Avec `threading.Semaphore`, un thread qui libère un créneau puis le redemande aussitôt
+    peut le reprendre avant les threads réveillés, qui attendent alors indéfiniment.
+    """
+
+    def __init__(self, count):
+        self._free = count
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free and not self._waiters:
+                self._free -= 1
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        waiter.wait()
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._free += 1
+
+class InferenceSession:
+    """Modèles d'un processus, réglages des threads de torch et créneaux d'exécution"""
+
+    def __init__(self, registry, slots=INFERENCE_SLOTS, threads=TORCH_THREADS, interop_threads=TORCH_INTEROP_THREADS):
+        self.registry = registry
+        self.slots = slots
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self._semaphore = None
+        self._slot_count = None
+        self._configured_pid = None
+        self._configure_lock = threading.Lock()
+        self._local = threading.local()
+        self._counts_lock = threading.Lock()
+        self._tokenizers = {}
+        self._tokenizers_lock = threading.Lock()
+        self.active = 0
+        self.waiting = 0
+        self.wait_seconds = 0.0
+
+    def configure(self, slots=None, threads=None):
+        """Applique les réglages des threads de torch au processus courant.
+
+        Appelée automatiquement avant le premier passage avant ; un processus d'inférence
+        l'appelle explicitement avec les cœurs qui lui sont attribués.
+        """
+        with self._configure_lock:
+            if slots is not None:
+                self.slots = slots
+            if threads is not None:
+                self.threads = threads
+            cores = available_cores()
+            slots = self.slots or max(1, cores // _CORES_PER_SLOT)
+            threads = self.threads or max(1, cores // slots)
+            torch.set_num_threads(threads)
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:
+                # Le nombre de threads inter-opérations ne peut être fixé qu'avant le premier calcul parallèle
+                pass
+            self._semaphore = _FairSlots(slots)
+            self._slot_count = slots
+            self._configured_pid = os.getpid()
+            logger.info(f"Session d'inférence: {slots} créneau(x) d'exécution, {threads} thread(s) torch chacun, "
+                        f"{torch.get_num_interop_threads()} thread(s) inter-opérations, {cores} cœur(s)")
+
+    def _ensure_configured(self):
+        # Après un fork, les réglages et le sémaphore du processus parent ne s'appliquent plus
+        if self._configured_pid != os.getpid():
+            self.configure()
+
+    def model(self, key, loader):
+        """Renvoie le modèle `key`, chargé une seule fois par `loader()` puis figé pour l'inférence"""
+        def load():
+            value = loader()
+            module = module_of(value)
+            if module is not None:
+                module.eval()
+                module.requires_grad_(False)
+            return value
+        return self.registry.get_or_load(key, load)
+
+    def lease(self, key):
+        """Protège un modèle du déchargement pendant son utilisation"""
+        return self.registry.lease(key)
+
+    @contextmanager
+    def run(self):
+        """Réserve un créneau d'exécution et désactive l'autograd pour un passage avant.
+
+        Un thread qui détient déjà un créneau (appels imbriqués) ne le réserve pas une seconde fois.
+        """
+        if getattr(self._local, "depth", 0):
+            self._local.depth += 1
+            try:
+                with torch.inference_mode():
+                    yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        self._ensure_configured()
+        semaphore = self._semaphore
+        start = time.perf_counter()
+        with self._counts_lock:
+            self.waiting += 1
+        semaphore.acquire()
+        with self._counts_lock:
+            self.waiting -= 1
+            self.active += 1
+            self.wait_seconds += time.perf_counter() - start
+        self._local.depth = 1
+        try:
+            with torch.inference_mode():
+                yield
+        finally:
+            self._local.depth = 0
+            with self._counts_lock:
+                self.active -= 1
+            semaphore.release()
+
+    @contextmanager
+    def private_tokenizer(self, tokenizer):
+        """Prête une copie de `tokenizer` réservée à l'appelant, rendue ensuite pour d'autres appels.
+
+        Il existe au plus autant de copies que d'appels simultanés ; celles d'un tokenizer
+        déchargé avec son modèle sont libérées.
+        """
+        with self._tokenizers_lock:
+            entry = self._tokenizers.get(id(tokenizer))
+            if entry is None or entry[0]() is not tokenizer:
+                for key in [key for key, (ref, _) in self._tokenizers.items() if ref() is None]:
+                    del self._tokenizers[key]
+                entry = self._tokenizers[id(tokenizer)] = (weakref.ref(tokenizer), [])
+            free = entry[1]
+            clone = free.pop() if free else None
+        if clone is None:
+            clone = copy.deepcopy(tokenizer)
+        try:
+            yield clone
+        finally:
+            with self._tokenizers_lock:
+                free.append(clone)
+
+    def snapshot(self):
+        with self._counts_lock:
+            return {
+                "slots": self._slot_count,
+                "torch_threads": torch.get_num_threads(),
+                "interop_threads": torch.get_num_interop_threads(),
+                "active": self.active,
+                "waiting": self.waiting,
+                "wait_seconds": self.wait_seconds
+            }
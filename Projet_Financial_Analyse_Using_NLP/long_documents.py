@@ -0,0 +1,214 @@
+"""
+Analyse des documents longs par fenêtres glissantes.
+Au lieu de tronquer silencieusement à 512 tokens, le texte est découpé en fenêtres
+de tokens qui se chevauchent. Les fenêtres sont traitées par groupes de taille
+bornée, puis les résultats sont fusionnés au niveau du document : entités replacées
+dans le texte d'origine, sentiment et relation moyennés et détail par fenêtre.
+"""
+
+import logging
+import os
+
+import numpy as np
+
+from model_bert_fine_tuned import (
+    get_sentiment_pipeline, get_ner_pipeline, load_model_bert_base_uncased,
+    predict_sentiment_batch, predict_ner_batch, predict_relation_batch,
+    model_relation_extraction_path, relation_map, convert_to_serializable,
+    _build_relation_prompt, _format_sentiment
+)
+
+logger = logging.getLogger(__name__)
+
+# Paramètres du découpage (surchargeables par variables d'environnement)
+LONG_DOC_MAX_TOKENS = int(os.environ.get("LONG_DOC_MAX_TOKENS", 510))
+LONG_DOC_OVERLAP = int(os.environ.get("LONG_DOC_OVERLAP", 64))
+LONG_DOC_GROUP_SIZE = int(os.environ.get("LONG_DOC_GROUP_SIZE", 32))
+
+def split_windows(tokenizer, text, window_tokens=LONG_DOC_MAX_TOKENS, overlap=LONG_DOC_OVERLAP):
+    """Découpe un texte en fenêtres de tokens chevauchantes, décrites par leurs positions de caractères.
+
+    Chaque fenêtre « possède » la partie du texte comprise entre les milieux de ses
+    chevauchements avec ses voisines ; c'est ce qui permet de dédoublonner les entités.
+    """
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True,
+                        truncation=False, verbose=False)["offset_mapping"]
+    if not offsets:
+        return [{"start": 0, "end": len(text), "tokens": 0, "own_start": 0, "own_end": len(text)}]
+
+    window_tokens = max(1, int(window_tokens))
+    step = max(1, window_tokens - max(0, int(overlap)))
+    windows = []
+    for first in range(0, len(offsets), step):
+        last = min(first + window_tokens, len(offsets)) - 1
+        windows.append({"start": offsets[first][0], "end": offsets[last][1], "tokens": last - first + 1})
+        if last == len(offsets) - 1:
+            break
+
+    windows[0]["own_start"] = 0
+    windows[-1]["own_end"] = len(text)
+    for previous, following in zip(windows, windows[1:]):
+        boundary = (following["start"] + previous["end"]) // 2
+        previous["own_end"] = boundary
+        following["own_start"] = boundary
+    return windows
+
+def _in_groups(items, group_size):
+    group_size = max(1, int(group_size))
+    for i in range(0, len(items), group_size):
+        yield items[i:i + group_size]
+
+def _run_windows(batch_fn, text, windows, group_size):
+    """Exécute une fonction de prédiction par lot sur les fenêtres, groupe par groupe"""
+    results = []
+    for group in _in_groups(windows, group_size):
+        results.extend(batch_fn([text[w["start"]:w["end"]] for w in group]))
+    return results
+
+def _merge_spans(spans, group_key):
+    """Fusionne les entités qui se chevauchent : union si même type, sinon la plus probable"""
+    merged = []
+    for span in sorted(spans, key=lambda e: (e["start"], -e["score"])):
+        if merged and span["start"] < merged[-1]["end"]:
+            last = merged[-1]
+            if span[group_key] == last[group_key]:
+                last["end"] = max(last["end"], span["end"])
+                last["score"] = max(last["score"], span["score"])
+                last["merged"] = True
+            elif span["score"] > last["score"]:
+                merged[-1] = span
+            continue
+        merged.append(span)
+    return merged
+
+def _document_entities(text, windows, window_entities, group_key, word_key):
+    """Replace les entités de chaque fenêtre dans le document et fusionne celles des frontières"""
+    spans = []
+    for window, entities in zip(windows, window_entities):
+        for entity in entities:
+            entity = dict(entity, start=entity["start"] + window["start"], end=entity["end"] + window["start"])
+            # Ne garder que les entités dont le centre est dans la zone propre à la fenêtre
+            center = (entity["start"] + entity["end"]) / 2
+            if window["own_start"] <= center < window["own_end"]:
+                spans.append(entity)
+
+    entities = _merge_spans(spans, group_key)
+    for entity in entities:
+        if entity.pop("merged", False):
+            entity[word_key] = text[entity["start"]:entity["end"]]
+    return entities
+
+def _weighted_mean(rows, windows):
+    weights = np.array([max(1, w["tokens"]) for w in windows], dtype=np.float64)
+    return (np.asarray(rows, dtype=np.float64) * weights[:, None]).sum(axis=0) / weights.sum()
+
+def long_document_sentiment(text, window_tokens=None, overlap=LONG_DOC_OVERLAP, group_size=LONG_DOC_GROUP_SIZE):
+    """Sentiment d'un document long : moyenne des fenêtres pondérée par leur nombre de tokens"""
+    tokenizer = get_sentiment_pipeline().tokenizer
+    windows = split_windows(tokenizer, text, window_tokens or LONG_DOC_MAX_TOKENS, overlap)
+    window_results = _run_windows(predict_sentiment_batch, text, windows, group_size)
+
+    labels = [item["label"] for item in window_results[0]["predictions"]]
+    rows = [[{p["label"]: p["score"] for p in result["predictions"]}[label] for label in labels]
+            for result in window_results]
+    document_scores = _weighted_mean(rows, windows)
+    result = _format_sentiment([{"label": label, "score": float(score)} for label, score in zip(labels, document_scores)])
+    result["windows"] = [{"start": w["start"], "end": w["end"], "label": r["label"], "probabilities": r["probabilities"],
+                          "predictions": r["predictions"]} for w, r in zip(windows, window_results)]
+    result["num_windows"] = len(windows)
+    return result
+
+def _ner_document(text, windows, window_results):
+    """Résultat NER du document à partir des résultats de chaque fenêtre"""
+    entities = _document_entities(text, windows, [r["entities"] for r in window_results], "entity_group", "word")
+    entity_stats = {}
+    for entity in entities:
+        entity_stats[entity["entity_group"]] = entity_stats.get(entity["entity_group"], 0) + 1
+    return {
+        "entities": entities,
+        "entity_stats": entity_stats,
+        "text": text,
+        "windows": [{"start": w["start"], "end": w["end"], "entities": len(r["entities"])}
+                    for w, r in zip(windows, window_results)],
+        "num_windows": len(windows)
+    }
+
+def long_document_ner(text, window_tokens=None, overlap=LONG_DOC_OVERLAP, group_size=LONG_DOC_GROUP_SIZE):
+    """Entités d'un document long, avec positions de caractères dans le texte complet"""
+    tokenizer = get_ner_pipeline().tokenizer
+    windows = split_windows(tokenizer, text, window_tokens or LONG_DOC_MAX_TOKENS, overlap)
+    return _ner_document(text, windows, _run_windows(predict_ner_batch, text, windows, group_size))
+
+def _relation_windows(text, instruction, window_tokens, overlap):
+    """Fenêtres de l'extraction de relation, en réservant la place de l'instruction dans chacune"""
+    _, tokenizer = load_model_bert_base_uncased(model_relation_extraction_path, num_labels=29)
+    if window_tokens is None:
+        prompt_tokens = len(tokenizer(_build_relation_prompt("", instruction), add_special_tokens=False)["input_ids"])
+        window_tokens = max(32, LONG_DOC_MAX_TOKENS - prompt_tokens)
+    return split_windows(tokenizer, text, window_tokens, overlap)
+
+def _relation_document(text, windows, window_results):
+    """Relation du document : moyenne des fenêtres pondérée par leur nombre de tokens"""
+    probabilities = _weighted_mean([r["probabilities"] for r in window_results], windows)
+    predicted_class = int(probabilities.argmax())
+    return {
+        "class": predicted_class,
+        "label": relation_map.get(predicted_class, f"Relation inconnue ({predicted_class})"),
+        "probabilities": probabilities.tolist(),
+        "entities": _document_entities(text, windows, [r["entities"] for r in window_results], "type", "text"),
+        "text": text,
+        "windows": [{"start": w["start"], "end": w["end"], "class": r["class"], "label": r["label"],
+                     "score": max(r["probabilities"])} for w, r in zip(windows, window_results)],
+        "num_windows": len(windows)
+    }
+
+def long_document_relation(text, instruction=None, window_tokens=None, overlap=LONG_DOC_OVERLAP,
+                           group_size=LONG_DOC_GROUP_SIZE):
+    """Relation d'un document long : moyenne des fenêtres pondérée par leur nombre de tokens"""
+    windows = _relation_windows(text, instruction, window_tokens, overlap)
+    window_results = _run_windows(lambda texts: predict_relation_batch(texts, [instruction] * len(texts)),
+                                  text, windows, group_size)
+    return _relation_document(text, windows, window_results)
+
+def long_document_analyze(text, instruction=None, window_tokens=None, overlap=LONG_DOC_OVERLAP,
+                          group_size=LONG_DOC_GROUP_SIZE):
+    """Analyse complète d'un document long.
+
+    Comme predict_analyze_batch pour les textes courts, la NER n'est exécutée qu'une fois :
+    sur les fenêtres de la relation (les plus courtes, l'instruction y ayant sa place), et ses
+    entités sont transmises à l'extraction de relation.
+    """
+    windows = _relation_windows(text, instruction, window_tokens, overlap)
+    ner_results = _run_windows(predict_ner_batch, text, windows, group_size)
+    relation_results = []
+    for group in _in_groups(list(range(len(windows))), group_size):
+        relation_results.extend(predict_relation_batch([text[windows[i]["start"]:windows[i]["end"]] for i in group],
+                                                       [instruction] * len(group),
+                                                       ner_results=[ner_results[i]["entities"] for i in group]))
+    return {
+        "sentiment": long_document_sentiment(text, window_tokens, overlap, group_size),
+        "ner": _ner_document(text, windows, ner_results),
+        "relation": _relation_document(text, windows, relation_results),
+        "text": text
+    }
+
+def predict_long_document(text, instruction=None, model_type="sentiment", window_tokens=None,
+                          overlap=LONG_DOC_OVERLAP, group_size=LONG_DOC_GROUP_SIZE):
+    """Prédiction au niveau document pour les textes dépassant la longueur maximale des modèles"""
+    logger.info(f"Analyse de document long demandée: type={model_type}, {len(text)} caractères")
+    try:
+        if model_type == "sentiment":
+            result = long_document_sentiment(text, window_tokens, overlap, group_size)
+        elif model_type == "ner":
+            result = long_document_ner(text, window_tokens, overlap, group_size)
+        elif model_type == "relation":
+            result = long_document_relation(text, instruction, window_tokens, overlap, group_size)
+        elif model_type == "analyze":
+            result = long_document_analyze(text, instruction, window_tokens, overlap, group_size)
+        else:
+            raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation', 'ner' ou 'analyze'")
+
+        return convert_to_serializable(result)
+    except Exception as e:
+        logger.error(f"Erreur pendant l'analyse du document long: {str(e)}")
+        raise
@@ -0,0 +1,220 @@
+"""
+Instrumentation du chemin de prédiction et exposition des métriques au format Prometheus.
+Chaque étape (tokenisation, passage avant, softmax, agrégation NER, conversion,
+encodage JSON) est chronométrée dans un histogramme étiqueté par type de modèle et
+par tranche de longueur d'entrée (en caractères). Les jauges (profondeur des files,
+mémoire des modèles) sont calculées au moment de la collecte.
+Un profileur par échantillonnage peut être activé à chaud pendant quelques secondes.
+Ce module ne dépend ni de torch ni de transformers.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation activée par défaut ; METRICS_ENABLED=0 la rend sans effet
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Tranches de longueur d'entrée (en caractères) utilisées comme étiquette
+LENGTH_BUCKETS = tuple(int(n) for n in os.environ.get("METRICS_LENGTH_BUCKETS", "128,256,512,1024,2048").split(",") if n)
+
+# Bornes des histogrammes de durée (secondes) et de taille de batch
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Profileur par échantillonnage : désactivé par défaut, durée maximale d'une session
+PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", 30))
+
+_context = threading.local()
+
+def length_bucket(length):
+    """Renvoie l'étiquette de la tranche contenant une longueur donnée"""
+    if length is None:
+        return "unknown"
+    for bound in LENGTH_BUCKETS:
+        if length <= bound:
+            return f"le_{bound}"
+    return f"gt_{LENGTH_BUCKETS[-1]}" if LENGTH_BUCKETS else "all"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+class Histogram:
+    """Histogramme cumulatif à étiquettes, au format d'exposition Prometheus"""
+
+    def __init__(self, name, documentation, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: ([*counts], total, count) for labels, (counts, total, count) in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            named = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(named + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(named)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(named)} {count}")
+        return lines
+
+span_seconds = Histogram("inference_span_seconds", "Durée de chaque étape de la prédiction",
+                         ("span", "model_type", "length_bucket"))
+request_seconds = Histogram("inference_request_seconds", "Durée totale d'une prédiction",
+                            ("model_type", "length_bucket"))
+batch_size = Histogram("inference_batch_size", "Nombre de requêtes regroupées par micro-batch",
+                       ("batcher",), BATCH_SIZE_BUCKETS)
+forward_batch_size = Histogram("inference_forward_batch_size", "Nombre de textes par passage avant",
+                               ("model_type",), BATCH_SIZE_BUCKETS)
+
+_histograms = [span_seconds, request_seconds, batch_size, forward_batch_size]
+_gauges = {}
+
+def register_gauge(name, documentation, collect):
+    """Déclare une jauge calculée à la collecte : `collect()` renvoie des couples (étiquettes, valeur)"""
+    _gauges[name] = (documentation, collect)
+
+@contextmanager
+def batch_context(model_type, length):
+    """Définit le type de modèle et la longueur utilisés par les étapes chronométrées du thread courant"""
+    previous = getattr(_context, "labels", None)
+    _context.labels = (model_type, length)
+    try:
+        yield
+    finally:
+        _context.labels = previous
+
+@contextmanager
+def span(name, model_type=None, length=None):
+    """Chronomètre une étape ; sans étiquettes explicites, utilise celles du batch en cours"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    if model_type is None:
+        model_type, length = getattr(_context, "labels", None) or ("unknown", None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span_seconds.observe(time.perf_counter() - start, name, model_type, length_bucket(length))
+
+def observe_request(model_type, length, seconds):
+    if METRICS_ENABLED:
+        request_seconds.observe(seconds, model_type, length_bucket(length))
+
+def observe_batch(batcher, size):
+    if METRICS_ENABLED:
+        batch_size.observe(size, batcher)
+
+def observe_forward_batch(size):
+    """Enregistre la taille d'un passage avant pour le type de modèle du batch en cours"""
+    if METRICS_ENABLED:
+        model_type = (getattr(_context, "labels", None) or ("unknown", None))[0]
+        forward_batch_size.observe(size, model_type)
+
+def instrument_pipeline(pipeline, stages):
+    """Chronomètre les méthodes d'un pipeline transformers (ex. {"postprocess": "ner_aggregation"})"""
+    for method_name, span_name in stages.items():
+        method = getattr(pipeline, method_name, None)
+        if method is None:
+            continue
+
+        def timed(*args, _method=method, _span=span_name, **kwargs):
+            with span(_span):
+                return _method(*args, **kwargs)
+
+        setattr(pipeline, method_name, timed)
+    return pipeline
+
+def _resident_memory_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def render():
+    """Renvoie toutes les métriques au format texte d'exposition Prometheus"""
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for name, (documentation, collect) in sorted(_gauges.items()):
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} gauge")
+        try:
+            samples = list(collect())
+        except Exception:
+            samples = []
+        for labels, value in samples:
+            lines.append(f"{name}{_format_labels(sorted(labels.items()))} {value}")
+    rss = _resident_memory_bytes()
+    if rss is not None:
+        lines += ["# HELP process_resident_memory_bytes Mémoire résidente du processus",
+                  "# TYPE process_resident_memory_bytes gauge",
+                  f"process_resident_memory_bytes {rss}"]
+    return "\n".join(lines) + "\n"
+
+class ProfilerBusyError(RuntimeError):
+    """Levée lorsqu'une session de profilage est déjà en cours"""
+
+_profiler_lock = threading.Lock()
+
+def sample_profile(seconds, interval_ms=10.0):
+    """Échantillonne les piles de tous les threads pendant `seconds` secondes.
+
+    Renvoie les piles au format « replié » (une ligne par pile, fonctions séparées
+    par « ; » suivies du nombre d'échantillons), lisible par flamegraph.pl ou speedscope.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        raise ProfilerBusyError("Une session de profilage est déjà en cours")
+    try:
+        seconds = min(max(0.0, float(seconds)), PROFILER_MAX_SECONDS)
+        interval = max(0.001, float(interval_ms) / 1000.0)
+        own_thread = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks[";".join([names.get(thread_id, str(thread_id))] + calls[::-1])] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    finally:
+        _profiler_lock.release()
@@ -3,7 +3,23 @@ from transformers import AutoTokenizer, AutoModelForSequenceClassification, pipe
 import numpy as np
 import logging
 import os
-import json
+import copy
+import queue
+import threading
+import time
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache
+from prediction_cache import prediction_cache, make_key
+from serialization import NumpyEncoder, convert_to_serializable
+from model_registry import ModelRegistry, SHARED_LORA_BASE, load_lora_classifier
+from inference_session import InferenceSession
+from near_duplicates import (NEAR_DUP_ENABLED, NearDuplicateIndex, near_duplicate_index,
+                             signature as near_duplicate_signature)
+import readiness
+import metrics
 
 # Configuration du logging
 logging.basicConfig(level=logging.INFO, 
@@ -14,234 +30,529 @@ logger = logging.getLogger(__name__)
 model_analysis_sentiment_path = './Fine-tuned-model_Bert-base-uncased-110M-sentiment_analysis'
 model_relation_extraction_path = './Fine-tuned-Bert-base-uncased-lora-financial-Relation-Extraction-cls'
 
-# Cache pour les modèles et pipelines
-model_cache = {}
-
-# Classe pour rendre les objets NumPy sérialisables en JSON
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NumpyEncoder, self).default(obj)
-
-def convert_to_serializable(obj):
-    """Convertit les types NumPy en types Python standards pour la sérialisation JSON"""
-    if isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return [convert_to_serializable(x) for x in obj]
-    elif isinstance(obj, list):
-        return [convert_to_serializable(x) for x in obj]
-    elif isinstance(obj, dict):
-        return {k: convert_to_serializable(v) for k, v in obj.items()}
-    elif hasattr(obj, 'item') and callable(getattr(obj, 'item')):
-        # Pour les types torch qui ont une méthode item()
-        return obj.item()
-    else:
-        return obj
+# Modèles Hugging Face
+sentiment_model_name = "Wilbiz/financial-sentiment"
+ner_model_name = "Wilbiz/financial-ner"
+
+# Types de modèles exposés par l'API
+MODEL_TYPES = ("sentiment", "ner", "relation", "analyze", "relation_pairs")
+
+# Cache pour les modèles et pipelines, borné par un budget mémoire (voir model_registry.py)
+model_cache = ModelRegistry()
+# Session d'inférence : chargement unique des modèles, threads de torch et créneaux d'exécution (voir inference_session.py)
+session = InferenceSession(model_cache)
+
+# Pool de processus d'inférence (voir workers.py), utilisé à la place des modèles locaux s'il est démarré
+worker_pool = None
+_batchers_lock = threading.Lock()
+
+def _env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def _env_float(name, default):
+    return float(os.environ.get(name, default))
+
+# Paramètres du micro-batching par modèle (surchargeables par variables d'environnement) :
+# une fenêtre d'attente plus longue ou des batches plus grands augmentent le débit au prix de la latence
+BATCHING_ENABLED = os.environ.get("BATCHING_ENABLED", "1") == "1"
+BATCHING_CONFIG = {
+    model_type: {
+        "max_batch_size": _env_int(f"BATCH_{model_type.upper()}_MAX_SIZE", 16),
+        "max_wait_ms": _env_float(f"BATCH_{model_type.upper()}_MAX_WAIT_MS", 5.0),
+        "max_queue_size": _env_int(f"BATCH_{model_type.upper()}_MAX_QUEUE", 256)
+    }
+    for model_type in MODEL_TYPES
+}
+
+# Chargement optimisé des modèles locaux pour le CPU (fusion LoRA + quantification int8)
+OPTIMIZED_INFERENCE = os.environ.get("OPTIMIZED_INFERENCE", "0") == "1"
+
+# Sentiment à deux niveaux : un modèle élève distillé ne laisse au modèle complet que les textes incertains
+# (voir tiered_inference.py)
+TIERED_SENTIMENT = os.environ.get("TIERED_SENTIMENT", "0") == "1"
+
+# Moteur d'exécution de chaque modèle : 'torch' (défaut) ou 'onnx' (ONNX Runtime sur CPU, voir onnx_backend.py)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+INFERENCE_BACKENDS = {
+    model_type: os.environ.get(f"INFERENCE_BACKEND_{model_type.upper()}", INFERENCE_BACKEND)
+    for model_type in ("sentiment", "ner", "relation")
+}
+
+@lru_cache(maxsize=None)
+def checkpoint_digest(model_path):
+    """Empreinte d'un checkpoint local calculée à partir du nom, de la taille et de la date de ses fichiers"""
+    digest = hashlib.sha1()
+    if os.path.isdir(model_path):
+        for name in sorted(os.listdir(model_path)):
+            file_path = os.path.join(model_path, name)
+            if os.path.isfile(file_path):
+                stat = os.stat(file_path)
+                digest.update(f"{name}:{stat.st_size}:{int(stat.st_mtime)}".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+def backend_source(model_type):
+    """Identifiant du modèle d'origine d'un type de modèle (vérifié au chargement d'un graphe exporté)"""
+    if model_type == "relation":
+        return f"{model_relation_extraction_path}@{checkpoint_digest(model_relation_extraction_path)}"
+    return sentiment_model_name if model_type == "sentiment" else ner_model_name
+
+def model_revision(model_type):
+    """Identifiant des versions de modèles utilisées par un type de prédiction (clé du cache)"""
+    def suffix(name):
+        return "-onnx" if INFERENCE_BACKENDS[name] == "onnx" else ""
+    
+    relation_revision = (f"{checkpoint_digest(model_relation_extraction_path)}"
+                         f"{'-int8' if OPTIMIZED_INFERENCE and not suffix('relation') else ''}{suffix('relation')}")
+    sentiment_revision = f"{sentiment_model_name}{suffix('sentiment')}"
+    if TIERED_SENTIMENT:
+        from tiered_inference import student_revision
+        sentiment_revision += student_revision()
+    ner_revision = f"{ner_model_name}{suffix('ner')}"
+    revisions = {
+        "sentiment": [sentiment_revision],
+        "ner": [ner_revision],
+        "relation": [relation_revision, ner_revision],
+        "analyze": [sentiment_revision, ner_revision, relation_revision],
+        # Les paramètres de sélection des paires modifient les résultats
+        "relation_pairs": [relation_revision, ner_revision,
+                           f"pairs:{','.join(RELATION_PAIR_HEAD_TYPES)}:{','.join(RELATION_PAIR_TAIL_TYPES)}:"
+                           f"{RELATION_PAIR_MAX_DISTANCE}:{RELATION_PAIR_MAX_PAIRS}:{RELATION_PAIR_TOP_K}"]
+    }
+    return "|".join(revisions[model_type] + [os.environ.get("MODEL_REVISION", "")])
+
+def _cache_key(model_type, text, instruction=None):
+    # L'instruction n'influence que l'extraction de relation
+    if model_type not in ("relation", "analyze"):
+        instruction = None
+    return make_key(model_type, model_revision(model_type), text, instruction)
+
+def _onnx_pipeline_model(model_type, model_pipeline):
+    """Remplace le modèle PyTorch d'un pipeline par son graphe ONNX (exporté au besoin)"""
+    from onnx_backend import load_onnx_model
+    return load_onnx_model(model_type, backend_source(model_type),
+                           export_from=lambda: (model_pipeline.model, model_pipeline.tokenizer))
+
+def _load_sentiment_pipeline():
+    try:
+        logger.info("Initialisation du pipeline d'analyse de sentiment")
+        start = time.perf_counter()
+        sentiment_pipeline = pipeline(
+            "text-classification",
+            model=sentiment_model_name,
+            tokenizer=sentiment_model_name,
+            return_all_scores=True
+        )
+        if INFERENCE_BACKENDS["sentiment"] == "onnx":
+            sentiment_pipeline.model = _onnx_pipeline_model("sentiment", sentiment_pipeline)
+        readiness.record_load("sentiment", time.perf_counter() - start)
+        return sentiment_pipeline
+    except Exception as e:
+        logger.error(f"Erreur lors de l'initialisation du pipeline de sentiment: {str(e)}")
+        raise
 
 def get_sentiment_pipeline():
     """Obtient ou crée un pipeline de sentiment avec mise en cache"""
-    if 'sentiment_pipeline' not in model_cache:
-        try:
-            logger.info("Initialisation du pipeline d'analyse de sentiment")
-            sentiment_pipeline = pipeline(
-                "text-classification",
-                model="Wilbiz/financial-sentiment",
-                tokenizer="Wilbiz/financial-sentiment",
-                return_all_scores=True
-            )
-            model_cache['sentiment_pipeline'] = sentiment_pipeline
-        except Exception as e:
-            logger.error(f"Erreur lors de l'initialisation du pipeline de sentiment: {str(e)}")
-            raise
-    return model_cache['sentiment_pipeline']
+    return session.model('sentiment_pipeline', _load_sentiment_pipeline)
+
+_NER_STAGES = {"preprocess": "tokenize", "_forward": "forward", "postprocess": "ner_aggregation"}
+
+def _load_ner_pipeline():
+    try:
+        logger.info("Initialisation du pipeline NER")
+        start = time.perf_counter()
+        ner_pipeline = pipeline(
+            "ner",
+            model=ner_model_name,
+            tokenizer=ner_model_name,
+            aggregation_strategy="simple",
+            ignore_labels=["O"]
+        )
+        if INFERENCE_BACKENDS["ner"] == "onnx":
+            ner_pipeline.model = _onnx_pipeline_model("ner", ner_pipeline)
+        # Chronométrer séparément la tokenisation, le passage avant et l'agrégation des entités
+        metrics.instrument_pipeline(ner_pipeline, _NER_STAGES)
+        readiness.record_load("ner", time.perf_counter() - start)
+        return ner_pipeline
+    except Exception as e:
+        logger.error(f"Erreur lors de l'initialisation du pipeline NER: {str(e)}")
+        raise
 
 def get_ner_pipeline():
     """Obtient ou crée un pipeline NER avec mise en cache"""
-    if 'ner_pipeline' not in model_cache:
-        try:
-            logger.info("Initialisation du pipeline NER")
-            ner_pipeline = pipeline(
-                "ner",
-                model="Wilbiz/financial-ner",
-                tokenizer="Wilbiz/financial-ner",
-                aggregation_strategy="simple",
-                ignore_labels=["O"]
-            )
-            model_cache['ner_pipeline'] = ner_pipeline
-        except Exception as e:
-            logger.error(f"Erreur lors de l'initialisation du pipeline NER: {str(e)}")
-            raise
-    return model_cache['ner_pipeline']
+    return session.model('ner_pipeline', _load_ner_pipeline)
 
-def load_model_bert_base_uncased(model_path: str, num_labels: int):
-    """Charge un modèle BERT et son tokenizer avec mise en cache"""
-    cache_key = f"model_{model_path}"
-    if cache_key not in model_cache:
-        try:
-            logger.info(f"Chargement du modèle depuis {model_path}")
+def _load_model_bert_base_uncased(model_path, num_labels):
+    try:
+        logger.info(f"Chargement du modèle depuis {model_path}")
+        start = time.perf_counter()
+        
+        # Vérifier si le chemin existe
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Le chemin du modèle n'existe pas: {model_path}")
             
-            # Vérifier si le chemin existe
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"Le chemin du modèle n'existe pas: {model_path}")
-                
-            model = AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=num_labels)
+        if model_path == model_relation_extraction_path and INFERENCE_BACKENDS["relation"] == "onnx":
+            # Graphe ONNX du modèle aux adaptateurs LoRA fusionnés, exécuté par ONNX Runtime
+            from onnx_backend import load_onnx_model, relation_export_source
+            model = load_onnx_model("relation", backend_source("relation"), export_from=relation_export_source)
             tokenizer = AutoTokenizer.from_pretrained(model_path)
-            model_cache[cache_key] = (model, tokenizer)
-        except Exception as e:
-            logger.error(f"Erreur lors du chargement du modèle {model_path}: {str(e)}")
-            raise
-    return model_cache[cache_key]
+        elif OPTIMIZED_INFERENCE:
+            from model_optimization import load_optimized_model
+            model, tokenizer = load_optimized_model(model_path, num_labels)
+        else:
+            # Un adaptateur LoRA réutilise l'encodeur de base déjà chargé pour un autre checkpoint
+            model = load_lora_classifier(model_cache, model_path, num_labels) if SHARED_LORA_BASE else None
+            if model is None:
+                model = AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=num_labels)
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if model_path == model_relation_extraction_path:
+            readiness.record_load("relation", time.perf_counter() - start)
+        return model, tokenizer
+    except Exception as e:
+        logger.error(f"Erreur lors du chargement du modèle {model_path}: {str(e)}")
+        raise
 
-def predict_sentiment(text):
-    logger.info("Analyse de sentiment demandée")
+def _model_key(model_path):
+    return f"model_{model_path}"
+
+def load_model_bert_base_uncased(model_path: str, num_labels: int):
+    """Charge un modèle BERT et son tokenizer avec mise en cache"""
+    return session.model(_model_key(model_path), lambda: _load_model_bert_base_uncased(model_path, num_labels))
+
+def _length_sorted_batches(lengths, batch_size):
+    """Regroupe les indices par longueur croissante pour limiter le padding de chaque batch"""
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batch_size = max(1, int(batch_size))
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+def _pad_encodings(encodings, indices, pad_token_id):
+    """Construit les tenseurs d'entrée d'un batch à partir d'encodages non paddés"""
+    sequences = [encodings["input_ids"][i] for i in indices]
+    max_length = max(len(ids) for ids in sequences)
+    input_ids = np.full((len(indices), max_length), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(indices), max_length), dtype=np.int64)
+    token_type_ids = np.zeros((len(indices), max_length), dtype=np.int64)
+    for row, i in enumerate(indices):
+        length = len(encodings["input_ids"][i])
+        input_ids[row, :length] = encodings["input_ids"][i]
+        attention_mask[row, :length] = 1
+        if "token_type_ids" in encodings:
+            token_type_ids[row, :length] = encodings["token_type_ids"][i]
+    return {
+        "input_ids": torch.from_numpy(input_ids),
+        "attention_mask": torch.from_numpy(attention_mask),
+        "token_type_ids": torch.from_numpy(token_type_ids)
+    }
+
+def tokenizer_fingerprint(tokenizer):
+    """Empreinte du vocabulaire et de la normalisation d'un tokenizer.
+    
+    Deux tokenizers de même empreinte (ex. les checkpoints dérivés de bert-base-uncased)
+    produisent les mêmes IDs : les encodages d'un texte peuvent alors être réutilisés.
+    """
+    fingerprint = getattr(tokenizer, "_vocab_fingerprint", None)
+    if fingerprint is None:
+        digest = hashlib.sha1(type(tokenizer).__name__.encode("utf-8"))
+        digest.update(str(getattr(tokenizer, "do_lower_case", None)).encode("utf-8"))
+        for token, index in sorted(tokenizer.get_vocab().items(), key=lambda item: item[1]):
+            digest.update(f"{index}:{token}\n".encode("utf-8"))
+        fingerprint = digest.hexdigest()[:12]
+        tokenizer._vocab_fingerprint = fingerprint
+    return fingerprint
+
+def _text_token_ids(tokenizer, texts, token_ids=None):
+    """IDs des tokens de chaque texte, sans tokens spéciaux.
+    
+    Les IDs fournis par l'appelant (entrée pré-tokenisée) sont utilisés tels quels ;
+    les autres textes sont tokenisés en un seul appel.
+    """
+    ids = list(token_ids) if token_ids is not None else [None] * len(texts)
+    vocab_size = len(tokenizer)
+    for i, value in enumerate(ids):
+        if value is not None and not all(isinstance(t, int) and 0 <= t < vocab_size for t in value):
+            raise ValueError(f"IDs de tokens non valides pour le texte {i} (vocabulaire de {vocab_size} tokens)")
+    missing = [i for i, value in enumerate(ids) if value is None]
+    if missing:
+        with metrics.span("tokenize"):
+            encoded = tokenizer([texts[i] for i in missing], add_special_tokens=False, verbose=False)["input_ids"]
+        for i, value in zip(missing, encoded):
+            ids[i] = value
+    return ids
+
+def _join_token_ids(tokenizer, text_ids, prefix_ids=(), suffix_ids=(), max_length=512):
+    """Assemble préfixe, texte et suffixe au niveau des IDs, avec les tokens spéciaux.
+    
+    Seule la partie texte est tronquée pour respecter la longueur maximale.
+    """
+    available = max_length - tokenizer.num_special_tokens_to_add()
+    budget = max(0, available - len(prefix_ids) - len(suffix_ids))
+    sequence = (list(prefix_ids) + list(text_ids[:budget]) + list(suffix_ids))[:available]
+    return tokenizer.build_inputs_with_special_tokens(sequence)
+
+def _classify_batches(model, tokenizer, encodings, batch_size):
+    """Exécute un classifieur de séquences par batches triés par longueur.
+    
+    Renvoie une matrice NumPy (textes x labels) des probabilités, dans l'ordre des encodages.
+    """
+    lengths = [len(ids) for ids in encodings["input_ids"]]
+    if not lengths:
+        return np.zeros((0, model.config.num_labels), dtype=np.float32)
+    probabilities = None
+    for indices in _length_sorted_batches(lengths, batch_size):
+        inputs = _pad_encodings(encodings, indices, tokenizer.pad_token_id or 0)
+        # Vérifier si le modèle a un attribut 'device'
+        if hasattr(model, 'device'):
+            inputs = {k: v.to(model.device) for k, v in inputs.items()}
+        metrics.observe_forward_batch(len(indices))
+        with metrics.span("forward"), session.run():
+            logits = model(**inputs).logits
+        with metrics.span("softmax"):
+            batch_probabilities = torch.nn.functional.softmax(logits, dim=-1).cpu().numpy()
+        if probabilities is None:
+            probabilities = np.empty((len(lengths), batch_probabilities.shape[1]), dtype=batch_probabilities.dtype)
+        probabilities[indices] = batch_probabilities
+    return probabilities
+
+def _max_length(texts):
+    """Longueur en caractères du plus long texte, utilisée pour étiqueter les métriques"""
+    return max((len(text) for text in texts if text), default=0)
+
+# Traduction des labels de sentiment
+sentiment_label_mapping = {
+    "Negative": "Négatif",
+    "Positive": "Positif",
+    "Neutral": "Neutre"
+}
+
+def _format_sentiment(scores_with_labels):
+    """Met en forme les scores d'un texte au format attendu par le frontend"""
+    # Trier par score pour trouver le label avec le score le plus élevé
+    scores_with_labels.sort(key=lambda x: x["score"], reverse=True)
+    top_prediction = scores_with_labels[0]
+    
+    # Extraire les probabilités dans le même ordre
+    probabilities = [item["score"] for item in scores_with_labels]
+    
+    # Traduire le label prédit
+    predicted_label = top_prediction["label"]
+    translated_label = sentiment_label_mapping.get(predicted_label, predicted_label)
+    
+    return {
+        "class": 0,
+        "label": translated_label,
+        "probabilities": probabilities,
+        "predictions": scores_with_labels  # Inclure les prédictions complètes pour référence
+    }
+
+def _format_sentiment_batch(probabilities, id2label):
+    """Met en forme les probabilités d'un batch : tri et conversion en types Python faits en NumPy"""
+    labels = [id2label[i] for i in range(probabilities.shape[1])]
+    order = np.argsort(-probabilities, axis=1, kind="stable")
+    sorted_scores = np.take_along_axis(probabilities, order, axis=1).tolist()
+    results = []
+    for row_order, row_scores in zip(order.tolist(), sorted_scores):
+        top_label = labels[row_order[0]]
+        results.append({
+            "class": 0,
+            "label": sentiment_label_mapping.get(top_label, top_label),
+            "probabilities": row_scores,
+            "predictions": [{"label": labels[i], "score": score} for i, score in zip(row_order, row_scores)]
+        })
+    return results
+
+def predict_sentiment_batch(texts, batch_size=None, token_ids=None):
+    """Analyse le sentiment d'une liste de textes en batches paddés.
+    
+    `token_ids` peut fournir, pour chaque texte, ses IDs de tokens déjà calculés
+    (sans tokens spéciaux) ; les textes correspondants ne sont pas retokenisés.
+    """
+    logger.debug("Analyse de sentiment demandée pour %d texte(s)", len(texts))
     try:
-        # Utiliser le pipeline Hugging Face avec le modèle financier spécifié
-        sentiment_pipeline = get_sentiment_pipeline()
-        
-        # Faire la prédiction
-        predictions = sentiment_pipeline(text)
-        
-        # Créer un mapping des labels
-        label_mapping = {
-            "Negative": "Négatif",
-            "Positive": "Positif",
-            "Neutral": "Neutre"
-        }
-        
-        # Extraire les scores et les labels
-        scores_with_labels = predictions[0]
-        
-        # S'assurer que les scores sont des floats standards, pas des float32
-        for item in scores_with_labels:
-            item["score"] = float(item["score"])
-        
-        # Trier par score pour trouver le label avec le score le plus élevé
-        scores_with_labels.sort(key=lambda x: x["score"], reverse=True)
-        top_prediction = scores_with_labels[0]
-        
-        # Extraire les probabilités dans le même ordre
-        probabilities = [float(item["score"]) for item in scores_with_labels]  # Conversion en float standard
-        
-        # Traduire le label prédit
-        predicted_label = top_prediction["label"]
-        translated_label = label_mapping.get(predicted_label, predicted_label)
-        
-        # Retourner au format attendu par le frontend
-        result = {
-            "class": scores_with_labels.index(top_prediction),
-            "label": translated_label,
-            "probabilities": probabilities,
-            "predictions": scores_with_labels  # Inclure les prédictions complètes pour référence
-        }
+        with metrics.batch_context("sentiment", _max_length(texts)), model_cache.lease("sentiment_pipeline"):
+            # Utiliser le modèle Hugging Face du pipeline financier, sans passer par sa boucle interne
+            sentiment_pipeline = get_sentiment_pipeline()
+            model, tokenizer = sentiment_pipeline.model, sentiment_pipeline.tokenizer
+            id2label = model.config.id2label
+            
+            text_ids = _text_token_ids(tokenizer, texts, token_ids)
+            encodings = {"input_ids": [_join_token_ids(tokenizer, ids) for ids in text_ids]}
+            batch_size = batch_size or BATCHING_CONFIG["sentiment"]["max_batch_size"]
+            if TIERED_SENTIMENT:
+                import tiered_inference
+                probabilities = tiered_inference.classify(
+                    encodings, tokenizer, model.config, batch_size,
+                    lambda subset: _classify_batches(model, tokenizer, subset, batch_size))
+            else:
+                probabilities = _classify_batches(model, tokenizer, encodings, batch_size)
+            
+            with metrics.span("postprocess"):
+                results = _format_sentiment_batch(probabilities, id2label)
         
-        logger.info(f"Analyse de sentiment terminée: {translated_label}")
-        return result
+        logger.debug("Analyse de sentiment terminée pour %d texte(s)", len(texts))
+        return results
     except Exception as e:
         logger.error(f"Erreur pendant l'analyse de sentiment: {str(e)}")
         raise
 
-def predict_ner(text):
-    logger.info("Reconnaissance d'entités demandée")
+def predict_sentiment(text):
+    return predict_sentiment_batch([text])[0]
+
+# Mapping en français pour les types d'entités
+entity_type_mapping = {
+    "CORP": "Entreprise",
+    "CW": "Crypto-monnaie",
+    "DATE": "Date",
+    "MONEY": "Montant",
+    "PERCENT": "Pourcentage",
+    "PERSON": "Personne",
+    "PRODUCT": "Produit"
+}
+
+def _format_ner(entities, text):
+    """Met en forme les entités d'un texte au format attendu par le frontend"""
+    # Conversion des valeurs numpy, traduction des types et statistiques en un seul passage
+    entity_stats = {}
+    for entity in entities:
+        entity["score"] = float(entity["score"])
+        entity["start"] = int(entity["start"])
+        entity["end"] = int(entity["end"])
+        entity_type = entity["entity_group"]
+        entity["entity_group_fr"] = entity_type_mapping.get(entity_type, entity_type)
+        entity_stats[entity_type] = entity_stats.get(entity_type, 0) + 1
+    
+    return {
+        "entities": entities,
+        "entity_stats": entity_stats,
+        "text": text
+    }
+
+def _run_ner_pipeline(texts, batch_size=None):
+    """Exécute le pipeline NER sur une liste de textes, triés par longueur en tokens"""
+    with model_cache.lease("ner_pipeline"):
+        return _run_ner_batches(get_ner_pipeline(), texts, batch_size)
+
+def _pipeline_replica(model_pipeline, tokenizer, stages):
+    """Copie d'un pipeline qui partage le modèle mais utilise son propre tokenizer"""
+    replica = copy.copy(model_pipeline)
+    # Les méthodes chronométrées sont liées au pipeline d'origine : les chronométrer à nouveau sur la copie
+    for method_name in stages:
+        replica.__dict__.pop(method_name, None)
+    replica.tokenizer = tokenizer
+    return metrics.instrument_pipeline(replica, stages)
+
+def _run_ner_batches(ner_pipeline, texts, batch_size):
+    batch_size = batch_size or BATCHING_CONFIG["ner"]["max_batch_size"]
+    # Le pipeline modifie les réglages de troncature de son tokenizer : chaque appel utilise sa propre copie
+    with session.run(), session.private_tokenizer(ner_pipeline.tokenizer) as tokenizer:
+        ner_pipeline = _pipeline_replica(ner_pipeline, tokenizer, _NER_STAGES)
+        with metrics.span("tokenize"):
+            lengths = [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+        entities = [None] * len(texts)
+        for indices in _length_sorted_batches(lengths, batch_size):
+            metrics.observe_forward_batch(len(indices))
+            outputs = ner_pipeline([texts[i] for i in indices], batch_size=len(indices))
+            for i, output in zip(indices, outputs):
+                entities[i] = output
+    return entities
+
+def predict_ner_batch(texts, batch_size=None):
+    """Reconnaît les entités d'une liste de textes en batches paddés"""
+    logger.debug("Reconnaissance d'entités demandée pour %d texte(s)", len(texts))
     try:
-        # Obtenir le pipeline NER
-        ner_pipeline = get_ner_pipeline()
-        
-        # Mapping en français pour les types d'entités
-        entity_type_mapping = {
-            "CORP": "Entreprise",
-            "CW": "Crypto-monnaie",
-            "DATE": "Date",
-            "MONEY": "Montant",
-            "PERCENT": "Pourcentage",
-            "PERSON": "Personne",
-            "PRODUCT": "Produit"
-        }
-        
-        # Faire la prédiction
-        entities = ner_pipeline(text)
-        
-        # Conversion des valeurs numpy en types Python standards
-        for entity in entities:
-            entity["score"] = float(entity["score"])
-            entity["start"] = int(entity["start"])
-            entity["end"] = int(entity["end"])
-        
-        # Traduire les types d'entités
-        for entity in entities:
-            entity_type = entity["entity_group"]
-            entity["entity_group_fr"] = entity_type_mapping.get(entity_type, entity_type)
-        
-        # Créer des statistiques sur les entités trouvées
-        entity_stats = {}
-        for entity in entities:
-            entity_type = entity["entity_group"]
-            if entity_type not in entity_stats:
-                entity_stats[entity_type] = 0
-            entity_stats[entity_type] += 1
-        
-        # Retourner les résultats
-        result = {
-            "entities": entities,
-            "entity_stats": entity_stats,
-            "text": text
-        }
-        
-        logger.info(f"Reconnaissance d'entités terminée: {len(entities)} entités trouvées")
-        return result
+        with metrics.batch_context("ner", _max_length(texts)):
+            all_entities = _run_ner_pipeline(texts, batch_size)
+            with metrics.span("postprocess"):
+                results = [_format_ner(entities, text) for entities, text in zip(all_entities, texts)]
+        logger.debug("Reconnaissance d'entités terminée pour %d texte(s)", len(texts))
+        return results
     except Exception as e:
         logger.error(f"Erreur pendant la reconnaissance d'entités: {str(e)}")
         raise
 
-def predict_relation(text, instruction=None):
-    logger.info("Extraction de relation demandée")
-    try:
-        relation_map = {
-            0: 'owner of', 1: 'product/material produced', 2: 'headquarters location', 
-            3: 'location of formation', 4: 'industry', 5: 'stock exchange', 6: 'manufacturer',
-            7: 'chairperson', 8: 'owned by', 9: 'brand', 10: 'employer', 
-            11: 'developer', 12: 'subsidiary', 13: 'parent organization',
-            14: 'position held', 15: 'founded by', 16: 'original broadcaster', 17: 'legal form', 
-            18: 'currency', 19: 'operator', 20: 'platform', 21: 'distribution format', 22: 'business division',
-            23: 'chief executive officer', 24: 'creator', 25: 'distributed by', 26: 'director/manager',
-            27: 'member of', 28: 'publisher'
-        }
-        
-        # Vérifier si le modèle existe
-        if not os.path.exists(model_relation_extraction_path):
-            raise FileNotFoundError(f"Le modèle d'extraction de relation n'existe pas: {model_relation_extraction_path}")
-        
-        model, tokenizer = load_model_bert_base_uncased(model_relation_extraction_path, num_labels=29)
-        
-        # Utiliser l'instruction fournie par l'utilisateur ou une instruction par défaut
-        if instruction is None or instruction.strip() == "":
-            instruction = "Utilize the input text as a context reference, choose the right relationship between"
-        
-        prompt = f"""
+def predict_ner(text):
+    return predict_ner_batch([text])[0]
+
+relation_map = {
+    0: 'owner of', 1: 'product/material produced', 2: 'headquarters location', 
+    3: 'location of formation', 4: 'industry', 5: 'stock exchange', 6: 'manufacturer',
+    7: 'chairperson', 8: 'owned by', 9: 'brand', 10: 'employer', 
+    11: 'developer', 12: 'subsidiary', 13: 'parent organization',
+    14: 'position held', 15: 'founded by', 16: 'original broadcaster', 17: 'legal form', 
+    18: 'currency', 19: 'operator', 20: 'platform', 21: 'distribution format', 22: 'business division',
+    23: 'chief executive officer', 24: 'creator', 25: 'distributed by', 26: 'director/manager',
+    27: 'member of', 28: 'publisher'
+}
+
+default_relation_instruction = "Utilize the input text as a context reference, choose the right relationship between"
+
+def _build_relation_prompt(text, instruction=None):
+    # Utiliser l'instruction fournie par l'utilisateur ou une instruction par défaut
+    if instruction is None or instruction.strip() == "":
+        instruction = default_relation_instruction
+    
+    return f"""
                     {instruction}
 
                     [{text}]
 
                 """.strip()
-        
-        inputs = tokenizer(prompt, return_tensors="pt", max_length=512,
-                        padding=True, truncation=True)
-        
-        # Vérifier si le modèle a un attribut 'device'
-        if hasattr(model, 'device'):
-            inputs = inputs.to(model.device)
-        
-        predictions = model(**inputs)
 
-        predicted_class = predictions.logits.argmax().item()
-        
+# Marqueur remplacé par le texte pour découper le prompt en préfixe et suffixe
+_PROMPT_PLACEHOLDER = "\x00"
+
+# Préfixes et suffixes de prompt déjà tokenisés, par empreinte de vocabulaire et instruction
+_PROMPT_AFFIXES_MAX_ENTRIES = 1024
+_prompt_affixes = OrderedDict()
+_prompt_affixes_lock = threading.Lock()
+
+def _relation_prompt_affixes(tokenizer, instruction):
+    """IDs du préfixe (instruction) et du suffixe du prompt de relation, tokenisés une fois par instruction.
+    
+    Le cache est indexé par l'empreinte du vocabulaire et non par le tokenizer lui-même : il
+    ne retient pas un tokenizer déchargé par le registre des modèles.
+    """
+    key = (tokenizer_fingerprint(tokenizer), instruction)
+    with _prompt_affixes_lock:
+        affixes = _prompt_affixes.get(key)
+        if affixes is not None:
+            _prompt_affixes.move_to_end(key)
+            return affixes
+    before, after = _build_relation_prompt(_PROMPT_PLACEHOLDER, instruction).split(_PROMPT_PLACEHOLDER)
+    encoded = tokenizer([before, after], add_special_tokens=False)["input_ids"]
+    affixes = (tuple(encoded[0]), tuple(encoded[1]))
+    with _prompt_affixes_lock:
+        _prompt_affixes[key] = affixes
+        while len(_prompt_affixes) > _PROMPT_AFFIXES_MAX_ENTRIES:
+            _prompt_affixes.popitem(last=False)
+    return affixes
+
+def _relation_entities(texts, batch_size=None, all_ner_results=None):
+    """Extrait les entités potentielles des textes pour la visualisation des relations"""
+    try:
+        # Essayer d'utiliser le modèle NER pour identifier les entités potentielles,
+        # sauf si ses résultats ont déjà été calculés par l'appelant
+        if all_ner_results is None:
+            all_ner_results = _run_ner_pipeline(texts, batch_size)
+        all_entities = []
+        for ner_results in all_ner_results:
+            # Convertir les résultats en format standard
+            all_entities.append([{
+                "type": entity["entity_group"],
+                "text": entity["word"],
+                "start": int(entity["start"]),
+                "end": int(entity["end"]),
+                "score": float(entity["score"])
+            } for entity in ner_results])
+        logger.debug("Extraction d'entités pour la relation: %d entités trouvées", sum(len(e) for e in all_entities))
+        return all_entities
+    except Exception as e:
+        logger.warning(f"Impossible d'extraire les entités pour la relation: {str(e)}")
+        return [[] for _ in texts]
+
+def _format_relation_batch(texts, probabilities, all_entities):
+    """Met en forme les probabilités d'un batch : argmax et conversion en types Python faits en NumPy"""
+    classes = probabilities.argmax(axis=1).tolist()
+    results = []
+    for text, predicted_class, row, entities in zip(texts, classes, probabilities.tolist(), all_entities):
         # S'assurer que la classe prédite est dans le mappage
         if predicted_class not in relation_map:
             logger.warning(f"Classe prédite {predicted_class} non trouvée dans relation_map")
@@ -249,75 +560,631 @@ def predict_relation(text, instruction=None):
         else:
             relation_label = relation_map[predicted_class]
         
-        # Récupérer les logits et les convertir en probabilités avec la fonction softmax
-        logits = predictions.logits
-        probabilities = torch.nn.functional.softmax(logits, dim=-1)
-        
-        # Convertir les probabilités en liste Python standard (pas numpy)
-        probabilities_list = [float(p) for p in probabilities[0].tolist()]
-        
-        # Extraire les entités potentielles pour la visualisation
-        entities = []
-        try:
-            # Essayer d'utiliser le modèle NER pour identifier les entités potentielles
-            ner_pipeline = get_ner_pipeline()
-            ner_results = ner_pipeline(text)
-            
-            # Convertir les résultats en format standard
-            for entity in ner_results:
-                entity_type = entity["entity_group"]
-                entity_text = entity["word"]
-                entities.append({
-                    "type": entity_type,
-                    "text": entity_text,
-                    "start": int(entity["start"]),
-                    "end": int(entity["end"]),
-                    "score": float(entity["score"])
-                })
-            
-            logger.info(f"Extraction d'entités pour la relation: {len(entities)} entités trouvées")
-        except Exception as e:
-            logger.warning(f"Impossible d'extraire les entités pour la relation: {str(e)}")
-        
         # Retourner au format attendu par le frontend
-        result = {
-            "class": int(predicted_class),  # Convertir en int Python standard
+        results.append({
+            "class": predicted_class,
             "label": relation_label,
-            "probabilities": probabilities_list,
+            "probabilities": row,
             "entities": entities,
             "text": text,
             # instruction_entities sera ajouté par app.py si analyze_instruction est vrai
-        }
+        })
+    return results
+
+def predict_relation_batch(texts, instructions=None, batch_size=None, ner_results=None, token_ids=None):
+    """Extrait la relation d'une liste de textes en batches paddés.
+    
+    L'instruction n'est tokenisée qu'une fois par valeur distincte : seul le texte est
+    tokenisé à chaque requête, puis joint à l'instruction au niveau des IDs.
+    `token_ids` peut fournir les IDs déjà calculés de la partie texte.
+    """
+    logger.debug("Extraction de relation demandée pour %d texte(s)", len(texts))
+    try:
+        # Vérifier si le modèle existe
+        if not os.path.exists(model_relation_extraction_path):
+            raise FileNotFoundError(f"Le modèle d'extraction de relation n'existe pas: {model_relation_extraction_path}")
         
-        logger.info(f"Extraction de relation terminée: {relation_label}")
-        return result
+        model, tokenizer = load_model_bert_base_uncased(model_relation_extraction_path, num_labels=29)
+        batch_size = batch_size or BATCHING_CONFIG["relation"]["max_batch_size"]
+        
+        if instructions is None:
+            instructions = [None] * len(texts)
+        relation_key = _model_key(model_relation_extraction_path)
+        with metrics.batch_context("relation", _max_length(texts)), model_cache.lease(relation_key):
+            text_ids = _text_token_ids(tokenizer, texts, token_ids)
+            encodings = {"input_ids": []}
+            for ids, instruction in zip(text_ids, instructions):
+                prefix_ids, suffix_ids = _relation_prompt_affixes(
+                    tokenizer, instruction if instruction and instruction.strip() else None)
+                encodings["input_ids"].append(_join_token_ids(tokenizer, ids, prefix_ids, suffix_ids))
+            probabilities = _classify_batches(model, tokenizer, encodings, batch_size)
+            all_entities = _relation_entities(texts, batch_size, ner_results)
+            
+            with metrics.span("postprocess"):
+                results = _format_relation_batch(texts, probabilities, all_entities)
+        
+        logger.debug("Extraction de relation terminée pour %d texte(s)", len(texts))
+        return results
     except Exception as e:
         logger.error(f"Erreur pendant l'extraction de relation: {str(e)}")
         raise
 
-def predict(text: str, instruction: str = None, model_type: str = "sentiment"):
-    logger.info(f"Prédiction demandée: type={model_type}, texte={text[:50]}...")
+def predict_relation(text, instruction=None):
+    return predict_relation_batch([text], [instruction])[0]
+
+# Extraction de relation par paire d'entités (surchargeable par variables d'environnement) :
+# types retenus en tête et en queue (vide : tous), distance maximale en caractères entre
+# les deux entités, nombre maximal de paires classées par texte et nombre de labels renvoyés
+RELATION_PAIR_HEAD_TYPES = tuple(t for t in os.environ.get("RELATION_PAIR_HEAD_TYPES", "").split(",") if t)
+RELATION_PAIR_TAIL_TYPES = tuple(t for t in os.environ.get("RELATION_PAIR_TAIL_TYPES", "").split(",") if t)
+RELATION_PAIR_MAX_DISTANCE = _env_int("RELATION_PAIR_MAX_DISTANCE", 200)
+RELATION_PAIR_MAX_PAIRS = _env_int("RELATION_PAIR_MAX_PAIRS", 32)
+RELATION_PAIR_TOP_K = _env_int("RELATION_PAIR_TOP_K", 3)
+
+# Instruction nommant les deux entités, formulée comme dans les données d'entraînement du modèle
+relation_pair_instruction = "What is the relationship between '{head}' and '{tail}' in the context of the input sentence."
+
+def _candidate_pairs(entities, head_types=None, tail_types=None, max_distance=None, max_pairs=None):
+    """Liste les paires orientées (tête, queue) d'entités distinctes d'un texte, les plus proches d'abord.
+
+    Une entité citée plusieurs fois ne forme qu'une paire avec chaque autre entité ; la
+    distance retenue est l'écart en caractères entre leurs mentions les plus proches.
+    Renvoie les paires retenues, sous forme de (distance, tête, queue), et le nombre de candidates.
+    """
+    mentions = {}
+    for entity in entities:
+        mentions.setdefault((entity["type"], entity["text"].lower()), []).append(entity)
+    candidates = []
+    for head_key, head_mentions in mentions.items():
+        if head_types and head_key[0] not in head_types:
+            continue
+        for tail_key, tail_mentions in mentions.items():
+            if tail_key[1] == head_key[1] or (tail_types and tail_key[0] not in tail_types):
+                continue
+            distance, head, tail = min(
+                ((max(0, max(h["start"], t["start"]) - min(h["end"], t["end"])), h, t)
+                 for h in head_mentions for t in tail_mentions),
+                key=lambda candidate: candidate[0])
+            if max_distance is None or distance <= max_distance:
+                candidates.append((distance, head, tail))
+    candidates.sort(key=lambda candidate: (candidate[0], candidate[1]["start"], candidate[2]["start"]))
+    return candidates[:max_pairs] if max_pairs is not None else candidates, len(candidates)
+
+def _relation_label(predicted_class):
+    return relation_map.get(predicted_class, f"Relation inconnue ({predicted_class})")
+
+def _format_relation_pairs(text, entities, pairs, candidate_count, probabilities, top_k):
+    """Met en forme les triplets (tête, relation, queue) d'un texte, avec les `top_k` labels les plus probables"""
+    order = np.argsort(-probabilities, axis=1, kind="stable")[:, :max(1, top_k)]
+    scores = np.take_along_axis(probabilities, order, axis=1).tolist()
+    triples = []
+    for (distance, head, tail), classes, row in zip(pairs, order.tolist(), scores):
+        triples.append({
+            "head": head,
+            "tail": tail,
+            "class": classes[0],
+            "label": _relation_label(classes[0]),
+            "score": row[0],
+            "distance": distance,
+            "predictions": [{"label": _relation_label(c), "score": score} for c, score in zip(classes, row)]
+        })
+    return {
+        "triples": triples,
+        "entities": entities,
+        "candidate_pairs": candidate_count,
+        # Vrai si des paires candidates ont été écartées par la limite max_pairs
+        "truncated": candidate_count > len(pairs),
+        "text": text
+    }
+
+def predict_relation_pairs_batch(texts, batch_size=None, head_types=None, tail_types=None, max_distance=None,
+                                 max_pairs=None, ner_results=None):
+    """Extrait une relation pour chaque paire candidate d'entités de chaque texte.
+
+    La NER n'est exécutée qu'une fois par texte. Chaque paire est nommée dans
+    l'instruction du prompt, et les paires de tous les textes sont classées ensemble en
+    batches paddés ; un texte n'est tokenisé qu'une fois, quel que soit son nombre de paires.
+    """
+    logger.debug("Extraction de relation par paire demandée pour %d texte(s)", len(texts))
+    try:
+        if not os.path.exists(model_relation_extraction_path):
+            raise FileNotFoundError(f"Le modèle d'extraction de relation n'existe pas: {model_relation_extraction_path}")
+
+        model, tokenizer = load_model_bert_base_uncased(model_relation_extraction_path, num_labels=29)
+        batch_size = batch_size or BATCHING_CONFIG["relation_pairs"]["max_batch_size"]
+        head_types = RELATION_PAIR_HEAD_TYPES if head_types is None else tuple(head_types)
+        tail_types = RELATION_PAIR_TAIL_TYPES if tail_types is None else tuple(tail_types)
+        max_distance = RELATION_PAIR_MAX_DISTANCE if max_distance is None else int(max_distance)
+        max_pairs = RELATION_PAIR_MAX_PAIRS if max_pairs is None else max(0, int(max_pairs))
+        if not texts:
+            return []
+
+        relation_key = _model_key(model_relation_extraction_path)
+        with metrics.batch_context("relation_pairs", _max_length(texts)), model_cache.lease(relation_key):
+            all_entities = _relation_entities(texts, batch_size, ner_results)
+            all_pairs = [_candidate_pairs(entities, head_types, tail_types, max_distance, max_pairs)
+                         for entities in all_entities]
+
+            # Instructions de toutes les paires tokenisées en un seul appel ; le suffixe ne dépend pas de l'instruction
+            text_ids = _text_token_ids(tokenizer, texts)
+            owners, instructions = [], []
+            for i, (text, (pairs, _)) in enumerate(zip(texts, all_pairs)):
+                for _, head, tail in pairs:
+                    owners.append(i)
+                    instructions.append(relation_pair_instruction.format(head=text[head["start"]:head["end"]],
+                                                                         tail=text[tail["start"]:tail["end"]]))
+            suffix_ids = _relation_prompt_affixes(tokenizer, None)[1]
+            encodings = {"input_ids": []}
+            if instructions:
+                with metrics.span("tokenize"):
+                    prefixes = [_build_relation_prompt(_PROMPT_PLACEHOLDER, instruction).split(_PROMPT_PLACEHOLDER)[0]
+                                for instruction in instructions]
+                    prefix_ids = tokenizer(prefixes, add_special_tokens=False)["input_ids"]
+                encodings["input_ids"] = [_join_token_ids(tokenizer, text_ids[i], prefix, suffix_ids)
+                                          for i, prefix in zip(owners, prefix_ids)]
+            probabilities = _classify_batches(model, tokenizer, encodings, batch_size)
+
+            with metrics.span("postprocess"):
+                results = []
+                start = 0
+                for text, entities, (pairs, candidate_count) in zip(texts, all_entities, all_pairs):
+                    results.append(_format_relation_pairs(text, entities, pairs, candidate_count,
+                                                          probabilities[start:start + len(pairs)], RELATION_PAIR_TOP_K))
+                    start += len(pairs)
+
+        logger.debug("Extraction de relation par paire terminée: %d paire(s) classée(s)", len(instructions))
+        return results
+    except Exception as e:
+        logger.error(f"Erreur pendant l'extraction de relation par paire: {str(e)}")
+        raise
+
+def predict_relation_pairs(text, **options):
+    return predict_relation_pairs_batch([text], **options)[0]
+
+def predict_analyze_batch(texts, instructions=None, batch_size=None, token_ids=None, sentiments=None):
+    """Analyse complète (sentiment, entités, relation) d'une liste de textes.
+    
+    Le modèle NER n'est exécuté qu'une fois, sur les textes et les instructions réunis
+    dans un même batch, et ses résultats sont réutilisés par l'extraction de relation.
+    Les modèles de sentiment et de NER étant des fine-tunings complets distincts, leurs
+    encodeurs ne peuvent pas être partagés ; chaque étape est donc chronométrée.
+    Les textes ne sont tokenisés qu'une fois lorsque les modèles de sentiment et de
+    relation partagent le même vocabulaire. `sentiments` fournit éventuellement un résultat
+    de sentiment déjà connu pour certains textes (ou None) : le modèle de sentiment n'est
+    exécuté que pour les autres.
+    """
+    logger.debug("Analyse complète demandée pour %d texte(s)", len(texts))
+    try:
+        start = time.perf_counter()
+        timings = {}
+        if instructions is None:
+            instructions = [None] * len(texts)
+        
+        # NER des textes et des instructions non vides en un seul passage
+        instruction_indices = [i for i, instruction in enumerate(instructions) if instruction and instruction.strip()]
+        step = time.perf_counter()
+        with metrics.batch_context("analyze", _max_length(texts)):
+            ner_results = _run_ner_pipeline(list(texts) + [instructions[i] for i in instruction_indices], batch_size)
+        timings["ner"] = (time.perf_counter() - step) * 1000
+        text_ner_results = ner_results[:len(texts)]
+        instruction_ner_results = dict(zip(instruction_indices, ner_results[len(texts):]))
+        
+        # Tokenisation unique des textes, réutilisée par les modèles de même vocabulaire
+        step = time.perf_counter()
+        relation_tokenizer = load_model_bert_base_uncased(model_relation_extraction_path, num_labels=29)[1]
+        sentiment_tokenizer = get_sentiment_pipeline().tokenizer
+        with metrics.batch_context("analyze", _max_length(texts)):
+            relation_ids = _text_token_ids(relation_tokenizer, texts, token_ids)
+        if tokenizer_fingerprint(sentiment_tokenizer) == tokenizer_fingerprint(relation_tokenizer):
+            sentiment_ids = relation_ids
+        elif token_ids is None:
+            sentiment_ids = None
+        else:
+            raise ValueError("Les modèles de sentiment et de relation n'ont pas le même vocabulaire : "
+                             "les IDs pré-tokenisés ne peuvent pas être partagés")
+        timings["tokenize"] = (time.perf_counter() - step) * 1000
+        
+        step = time.perf_counter()
+        if sentiments is None:
+            sentiments = predict_sentiment_batch(texts, batch_size, token_ids=sentiment_ids)
+        else:
+            sentiments = list(sentiments)
+            missing = [i for i, sentiment in enumerate(sentiments) if sentiment is None]
+            if missing:
+                computed = predict_sentiment_batch([texts[i] for i in missing], batch_size,
+                                                   token_ids=None if sentiment_ids is None
+                                                   else [sentiment_ids[i] for i in missing])
+                for i, sentiment in zip(missing, computed):
+                    sentiments[i] = sentiment
+        timings["sentiment"] = (time.perf_counter() - step) * 1000
+        
+        step = time.perf_counter()
+        relations = predict_relation_batch(texts, instructions, batch_size, ner_results=text_ner_results,
+                                           token_ids=relation_ids)
+        timings["relation"] = (time.perf_counter() - step) * 1000
+        timings["total"] = (time.perf_counter() - start) * 1000
+        
+        results = []
+        for i, text in enumerate(texts):
+            relation = relations[i]
+            if i in instruction_ner_results:
+                relation["instruction_entities"] = _format_ner(instruction_ner_results[i], instructions[i])["entities"]
+            results.append({
+                "sentiment": sentiments[i],
+                "ner": _format_ner(text_ner_results[i], text),
+                "relation": relation,
+                "text": text,
+                # Durées en millisecondes de chaque étape pour l'ensemble du batch
+                "timings_ms": dict(timings, batch_size=len(texts))
+            })
+        
+        logger.debug("Analyse complète terminée en %.1f ms", timings["total"])
+        return results
+    except Exception as e:
+        logger.error(f"Erreur pendant l'analyse complète: {str(e)}")
+        raise
+
+def predict_analyze(text, instruction=None):
+    return predict_analyze_batch([text], [instruction])[0]
+
+class BatchQueueFullError(RuntimeError):
+    """Levée lorsque la file d'attente d'un modèle a atteint sa profondeur maximale"""
+
+class RequestAbandonedError(RuntimeError):
+    """Levée lorsque l'appelant a abandonné la requête (délai dépassé ou client déconnecté)"""
+
+# Intervalle de vérification de l'abandon d'une requête en attente de son résultat, en secondes
+_ABANDON_POLL_SECONDS = 0.05
+_request_scope = threading.local()
+
+@contextmanager
+def request_scope(deadline=None, abandoned=None):
+    """Rattache au thread courant l'échéance (horloge time.monotonic) et l'événement d'abandon d'une requête.
+
+    Les attentes de résultats des micro-batchers et des processus d'inférence s'arrêtent à
+    l'échéance ou à l'abandon, et retirent la requête de la file si son batch n'a pas commencé.
+    """
+    previous = getattr(_request_scope, "value", None)
+    _request_scope.value = (deadline, abandoned)
+    try:
+        yield
+    finally:
+        _request_scope.value = previous
+
+def await_result(future):
+    """Attend le résultat d'un Future en respectant l'échéance et l'abandon de la requête courante"""
+    scope = getattr(_request_scope, "value", None)
+    if scope is None:
+        return future.result()
+    deadline, abandoned = scope
+    while True:
+        timeout = _ABANDON_POLL_SECONDS
+        if deadline is not None:
+            timeout = min(timeout, max(0.0, deadline - time.monotonic()))
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            expired = deadline is not None and time.monotonic() >= deadline
+            if expired or (abandoned is not None and abandoned.is_set()):
+                # Un batch déjà démarré se termine, mais son résultat n'est plus attendu
+                future.cancel()
+                raise RequestAbandonedError("Délai dépassé" if expired else "Requête abandonnée par le client")
+
+class MicroBatcher:
+    """Regroupe les requêtes concurrentes d'un même modèle en un seul passage avant.
+    
+    Un thread dédié attend la première requête, puis collecte les suivantes pendant
+    au plus `max_wait_ms` millisecondes ou jusqu'à `max_batch_size` requêtes, appelle
+    `batch_fn` sur l'ensemble et renvoie à chaque appelant son propre résultat.
+    """
+    
+    def __init__(self, name, batch_fn, max_batch_size=16, max_wait_ms=5.0, max_queue_size=256):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue(maxsize=max(0, int(max_queue_size)))
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def submit(self, *payload):
+        """Ajoute une requête à la file et renvoie un Future portant son résultat"""
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((payload, future))
+        except queue.Full:
+            raise BatchQueueFullError(f"File d'attente du modèle {self.name} pleine ({self._queue.maxsize} requêtes)")
+        return future
+    
+    def __call__(self, *payload):
+        return await_result(self.submit(*payload))
+    
+    def qsize(self):
+        return self._queue.qsize()
+    
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name=f"batcher-{self.name}", daemon=True)
+                    self._thread.start()
+    
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while True:
+            # Ignorer les requêtes annulées par leur appelant pendant l'attente
+            batch = [(payload, future) for payload, future in self._collect()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            metrics.observe_batch(self.name, len(batch))
+            try:
+                results = self.batch_fn([payload for payload, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+def get_batcher(model_type):
+    """Obtient ou crée le micro-batcher d'un type de modèle"""
+    cache_key = f"batcher_{model_type}"
+    if cache_key not in model_cache:
+        with _batchers_lock:
+            if cache_key not in model_cache:
+                batch_functions = {
+                    "sentiment": lambda payloads: predict_sentiment_batch([p[0] for p in payloads]),
+                    "ner": lambda payloads: predict_ner_batch([p[0] for p in payloads]),
+                    "relation": lambda payloads: predict_relation_batch([p[0] for p in payloads],
+                                                                        [p[1] for p in payloads]),
+                    "analyze": lambda payloads: predict_analyze_batch([p[0] for p in payloads],
+                                                                      [p[1] for p in payloads]),
+                    "relation_pairs": lambda payloads: predict_relation_pairs_batch([p[0] for p in payloads])
+                }
+                if model_type not in batch_functions:
+                    raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation', 'ner', 'analyze' ou 'relation_pairs'")
+                model_cache[cache_key] = MicroBatcher(model_type, batch_functions[model_type], **BATCHING_CONFIG[model_type])
+    return model_cache[cache_key]
+
+# Seul le sentiment est réutilisé pour un quasi-doublon : les résultats NER et de relation
+# contiennent des positions de caractères et des extraits propres au texte analysé
+NEAR_DUP_MODEL_TYPES = ("sentiment", "analyze")
+
+def _near_duplicate_namespace():
+    return ("sentiment", model_revision("sentiment"))
+
+def _sentiment_part(model_type, result):
+    return result.get("sentiment") if model_type == "analyze" else result
+
+def _reused_sentiment(sentiment, similarity, source_id, source_text):
+    return dict(copy.deepcopy(sentiment), near_duplicate={"similarity": round(similarity, 4),
+                                                          "source_id": source_id, "source_text": source_text})
+
+def _reuse_near_duplicates(texts, model_type, ids, results, force):
+    """Cherche, pour chaque texte à analyser, le sentiment d'un quasi-doublon déjà analysé.
+
+    Renvoie les sentiments réutilisés par indice, les signatures des textes à indexer une
+    fois analysés et, pour le sentiment seul, les textes quasi identiques à un autre texte
+    du lot associés à l'indice de ce texte : il ne sera analysé qu'une fois.
+    """
+    namespace = _near_duplicate_namespace()
+    reused, signatures, followers = {}, {}, {}
+    batch_index = NearDuplicateIndex(max_entries=len(texts), ttl_seconds=0)
+    for i, text in enumerate(texts):
+        sig = near_duplicate_signature(text)
+        if results[i] is not None:
+            # Un texte servi par le cache devient la source de ses reprises s'il n'en a pas déjà une
+            sentiment = _sentiment_part(model_type, results[i])
+            if sentiment and near_duplicate_index.lookup(namespace, sig, count=False)[0] is None:
+                near_duplicate_index.add(namespace, sig, sentiment, ids[i] if ids else None, text)
+            continue
+        if not force:
+            entry, score = near_duplicate_index.lookup(namespace, sig)
+            if entry is not None:
+                reused[i] = _reused_sentiment(entry.result, score, entry.source_id, entry.text)
+                continue
+            if model_type == "sentiment":
+                entry, score = batch_index.lookup(namespace, sig)
+                if entry is not None:
+                    followers[i] = (entry.result, score)
+                    continue
+        signatures[i] = sig
+        batch_index.add(namespace, sig, i, ids[i] if ids else None, text)
+    return reused, signatures, followers
+
+def predict_batch(texts, instructions=None, model_type: str = "sentiment", batch_size=None, token_ids=None,
+                  ids=None, near_duplicates=False, force=False):
+    """Prédit une liste de textes en batches paddés et renvoie des résultats sérialisables.
+    
+    Les textes déjà présents dans le cache de prédictions ne sont pas recalculés.
+    `token_ids` fournit éventuellement les IDs pré-tokenisés de chaque texte (ou None),
+    dans le vocabulaire bert-base-uncased ; ces lots ne passent pas par le cache.
+    Avec `near_duplicates`, un texte quasi identique à un texte déjà analysé (voir
+    near_duplicates.py) reçoit le sentiment de ce dernier, complété par la clé
+    'near_duplicate' (similarité, identifiant `ids` et texte de la source) ; pour
+    l'analyse complète, les entités et la relation sont tout de même calculées sur le
+    texte. `force` analyse tout de même ces textes.
+    """
+    logger.debug("Prédiction par lot demandée: type=%s, %d texte(s)", model_type, len(texts))
+    
+    try:
+        if model_type not in MODEL_TYPES:
+            raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation', 'ner', 'analyze' ou 'relation_pairs'")
+        if instructions is None:
+            instructions = [None] * len(texts)
+        if token_ids is not None and all(ids is None for ids in token_ids):
+            token_ids = None
+        if token_ids is not None:
+            if model_type in ("ner", "relation_pairs"):
+                raise ValueError("La NER a besoin des positions de caractères : les IDs pré-tokenisés ne sont pas acceptés")
+            # Les IDs fournis déterminent le résultat : pas de mise en cache sur la clé du texte
+            return _run_batch(texts, instructions, model_type, batch_size, token_ids)
+        near_duplicates = near_duplicates and NEAR_DUP_ENABLED and model_type in NEAR_DUP_MODEL_TYPES
+        if not prediction_cache.enabled and not near_duplicates:
+            return _run_batch(texts, instructions, model_type, batch_size)
+        
+        if prediction_cache.enabled:
+            keys = [_cache_key(model_type, text, instruction) for text, instruction in zip(texts, instructions)]
+            results = [prediction_cache.get(key) for key in keys]
+        else:
+            keys = list(zip(texts, instructions))
+            results = [None] * len(texts)
+        reused, signatures, followers = {}, {}, {}
+        if near_duplicates:
+            reused, signatures, followers = _reuse_near_duplicates(texts, model_type, ids, results, force)
+            if model_type == "sentiment":
+                for i, sentiment in reused.items():
+                    results[i] = sentiment
+        # Les doublons au sein du lot ne sont calculés qu'une fois
+        missing = {}
+        for i, result in enumerate(results):
+            if result is None and i not in followers:
+                missing.setdefault(keys[i], i)
+        if missing:
+            indices = list(missing.values())
+            sentiments = None
+            if reused and model_type == "analyze":
+                sentiments = [reused.get(i) for i in indices]
+            computed = _run_batch([texts[i] for i in indices], [instructions[i] for i in indices],
+                                  model_type, batch_size, sentiments=sentiments)
+            # Un sentiment réutilisé n'est pas mis en cache sous la clé d'un autre texte
+            cacheable = [(key, result) for (key, i), result in zip(missing.items(), computed) if i not in reused]
+            if prediction_cache.enabled and cacheable:
+                prediction_cache.set_many(cacheable)
+            for i, result in zip(indices, computed):
+                if i in signatures:
+                    near_duplicate_index.add(_near_duplicate_namespace(), signatures[i],
+                                             _sentiment_part(model_type, result), ids[i] if ids else None, texts[i])
+            computed_by_index = dict(zip(indices, computed))
+            computed = dict(zip(missing.keys(), computed))
+            for i, (source, score) in followers.items():
+                results[i] = _reused_sentiment(computed_by_index[source], score, ids[source] if ids else None,
+                                               texts[source])
+            # Un résultat est rendu tel quel à son premier demandeur ; les doublons du lot en reçoivent une copie
+            handed_out = set()
+            for i, (key, result) in enumerate(zip(keys, results)):
+                if result is None:
+                    results[i] = copy.deepcopy(computed[key]) if key in handed_out else computed[key]
+                    handed_out.add(key)
+        return results
+    except Exception as e:
+        logger.error(f"Erreur pendant la prédiction par lot: {str(e)}")
+        raise
+
+def _run_batch(texts, instructions, model_type, batch_size, token_ids=None, sentiments=None):
+    # Répartir le lot sur les processus d'inférence s'ils sont démarrés
+    if worker_pool is not None:
+        return worker_pool.run_batch(model_type, texts, instructions, token_ids, sentiments)
+    return _predict_batch_uncached(texts, instructions, model_type, batch_size, token_ids, sentiments)
+
+def _predict_batch_uncached(texts, instructions, model_type, batch_size, token_ids=None, sentiments=None):
+    """Exécute les modèles sur une liste de textes, sans passer par le cache.
     
+    Les fonctions de prédiction produisent directement des types Python sérialisables.
+    `sentiments` (analyse complète seulement) fournit les sentiments déjà connus.
+    """
     try:
         if model_type == "sentiment":
+            results = predict_sentiment_batch(texts, batch_size, token_ids=token_ids)
+        elif model_type == "relation":
+            results = predict_relation_batch(texts, instructions, batch_size, token_ids=token_ids)
+        elif model_type == "ner":
+            results = predict_ner_batch(texts, batch_size)
+        elif model_type == "analyze":
+            results = predict_analyze_batch(texts, instructions, batch_size, token_ids=token_ids,
+                                            sentiments=sentiments)
+        elif model_type == "relation_pairs":
+            results = predict_relation_pairs_batch(texts, batch_size)
+        else:
+            raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation', 'ner', 'analyze' ou 'relation_pairs'")
+        
+        return results
+    except Exception as e:
+        logger.error(f"Erreur pendant la prédiction par lot: {str(e)}")
+        raise
+
+def predict(text: str, instruction: str = None, model_type: str = "sentiment", token_ids=None):
+    logger.debug("Prédiction demandée: type=%s, texte=%.50s...", model_type, text)
+    start = time.perf_counter()
+    
+    try:
+        if model_type not in MODEL_TYPES:
+            raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation', 'ner', 'analyze' ou 'relation_pairs'")
+        
+        # Entrée pré-tokenisée : exécutée directement comme un lot d'un texte
+        if token_ids is not None:
+            result = predict_batch([text], [instruction], model_type, token_ids=[token_ids])[0]
+            metrics.observe_request(model_type, len(text), time.perf_counter() - start)
+            return result
+        
+        # Renvoyer directement un résultat déjà calculé pour la même requête
+        cache_key = None
+        if prediction_cache.enabled:
+            cache_key = _cache_key(model_type, text, instruction)
+            cached = prediction_cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Résultat trouvé dans le cache: type=%s", model_type)
+                metrics.observe_request(model_type, len(text), time.perf_counter() - start)
+                return cached
+        
+        if worker_pool is not None:
+            # Envoyer la requête au processus d'inférence le moins chargé
+            result = await_result(worker_pool.submit(model_type, text, instruction))
+        elif BATCHING_ENABLED:
+            # Passer par le micro-batcher pour regrouper les requêtes concurrentes
+            result = get_batcher(model_type)(text, instruction)
+        elif model_type == "sentiment":
             result = predict_sentiment(text)
         elif model_type == "relation":
             result = predict_relation(text, instruction)
         elif model_type == "ner":
             result = predict_ner(text)
+        elif model_type == "relation_pairs":
+            result = predict_relation_pairs(text)
         else:
-            raise ValueError(f"Type de modèle non valide: {model_type}. Choisissez 'sentiment', 'relation' ou 'ner'")
+            result = predict_analyze(text, instruction)
         
-        # S'assurer que tous les résultats sont sérialisables en JSON
-        result = convert_to_serializable(result)
+        if cache_key is not None:
+            prediction_cache.set(cache_key, result)
+        metrics.observe_request(model_type, len(text), time.perf_counter() - start)
         return result
     except Exception as e:
         logger.error(f"Erreur pendant la prédiction: {str(e)}")
         # Relancer l'exception pour la gestion d'erreur de niveau supérieur
         raise
 
+def _queue_depths():
+    """Profondeur des files des micro-batchers, locaux ou rattachés aux processus d'inférence"""
+    batchers = [value for key, value in list(model_cache.items()) if key.startswith("batcher_")]
+    if worker_pool is not None:
+        batchers += [batcher for worker in worker_pool.workers for batcher in worker.batchers.values()]
+    for batcher in batchers:
+        yield {"batcher": batcher.name}, batcher.qsize()
 
+def _model_memory():
+    """Taille en octets des poids de chaque modèle chargé"""
+    for key, size in model_cache.memory():
+        yield {"model": key}, size
 
+metrics.register_gauge("inference_queue_depth", "Requêtes en attente dans chaque micro-batcher", _queue_depths)
+metrics.register_gauge("inference_model_memory_bytes", "Taille des poids des modèles chargés", _model_memory)
 
+def _session_slots():
+    """Passages avant en cours et en attente d'un créneau d'exécution"""
+    snapshot = session.snapshot()
+    yield {"state": "active"}, snapshot["active"]
+    yield {"state": "waiting"}, snapshot["waiting"]
 
-
+metrics.register_gauge("inference_session_slots", "Passages avant en cours ou en attente d'un créneau", _session_slots)
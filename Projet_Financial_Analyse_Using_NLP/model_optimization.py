@@ -0,0 +1,163 @@
+"""
+Chargement optimisé des modèles locaux pour l'inférence sur CPU.
+Les poids LoRA sont fusionnés dans les poids de base, puis les couches linéaires
+sont quantifiées dynamiquement en int8. Le modèle converti peut être mis en cache
+sur disque pour que les démarrages suivants évitent la conversion.
+
+Usage pour mesurer la dérive des logits par rapport au modèle fp32 non fusionné :
+    python model_optimization.py --model relation
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForSequenceClassification
+
+from model_bert_fine_tuned import (checkpoint_digest, model_analysis_sentiment_path, model_relation_extraction_path,
+                                   _build_relation_prompt)
+
+# Configuration du logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Dossier de cache des modèles convertis (désactivé si vide)
+OPTIMIZED_CACHE_DIR = os.environ.get("OPTIMIZED_MODEL_CACHE_DIR", "")
+QUANTIZED_WEIGHTS_NAME = "model_int8.pt"
+
+# Phrases d'exemple pour le contrôle de précision
+SAMPLE_TEXTS = [
+    "Apple Inc. announced record quarterly revenue of $123.9 billion, up 11% year over year.",
+    "Tesla bought $1.5 billion of Bitcoin in February 2021.",
+    "Microsoft acquires Activision Blizzard for $68.7 billion in an all-cash transaction.",
+    "Shares of Nvidia fell 5% after the company warned of weaker demand in China.",
+    "Tim Cook is the chief executive officer of Apple.",
+    "The European Central Bank kept interest rates unchanged on Thursday.",
+    "Amazon Web Services is a subsidiary of Amazon headquartered in Seattle.",
+    "Ethereum rose 8% to $3,200 as trading volumes surged."
+]
+
+def is_lora_checkpoint(model_path):
+    """Indique si le dossier contient un adaptateur LoRA (PEFT) plutôt qu'un modèle complet"""
+    return os.path.exists(os.path.join(model_path, "adapter_config.json"))
+
+def load_unmerged_model(model_path, num_labels):
+    """Charge le modèle fp32 tel qu'il est entraîné, avec ses adaptateurs LoRA non fusionnés"""
+    if not is_lora_checkpoint(model_path):
+        model = AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=num_labels)
+        return model.eval()
+
+    from peft import PeftConfig, PeftModel
+    peft_config = PeftConfig.from_pretrained(model_path)
+    base_model = AutoModelForSequenceClassification.from_pretrained(peft_config.base_model_name_or_path,
+                                                                    num_labels=num_labels)
+    return PeftModel.from_pretrained(base_model, model_path).eval()
+
+def merge_lora(model):
+    """Fusionne les poids LoRA dans les poids de base et retire les couches d'adaptation"""
+    if hasattr(model, "merge_and_unload"):
+        model = model.merge_and_unload()
+    return model
+
+def quantize_model(model):
+    """Applique une quantification dynamique int8 aux couches linéaires"""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _freeze(model):
+    """Passe le modèle en mode inférence, sans calcul de gradients"""
+    model.eval()
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    return model
+
+def _artifact_dir(model_path, cache_dir):
+    """Dossier de cache propre au checkpoint, invalidé si ses fichiers changent"""
+    model_name = os.path.basename(os.path.normpath(model_path))
+    return os.path.join(cache_dir, f"{model_name}-{checkpoint_digest(model_path)}")
+
+def _load_cached(artifact_dir):
+    """Recharge un modèle quantifié depuis le cache disque"""
+    config = AutoConfig.from_pretrained(artifact_dir)
+    model = quantize_model(AutoModelForSequenceClassification.from_config(config).eval())
+    # Artefact produit localement par save_optimized_model : chargement complet autorisé
+    state_dict = torch.load(os.path.join(artifact_dir, QUANTIZED_WEIGHTS_NAME), map_location="cpu",
+                            weights_only=False)
+    model.load_state_dict(state_dict)
+    return _freeze(model)
+
+def save_optimized_model(model, tokenizer, artifact_dir):
+    """Enregistre un modèle quantifié et son tokenizer dans le cache disque"""
+    os.makedirs(artifact_dir, exist_ok=True)
+    model.config.save_pretrained(artifact_dir)
+    tokenizer.save_pretrained(artifact_dir)
+    torch.save(model.state_dict(), os.path.join(artifact_dir, QUANTIZED_WEIGHTS_NAME))
+    logger.info(f"Modèle optimisé enregistré dans {artifact_dir}")
+
+def load_optimized_model(model_path, num_labels, cache_dir=None):
+    """Charge un modèle fusionné et quantifié int8, depuis le cache disque si possible"""
+    cache_dir = OPTIMIZED_CACHE_DIR if cache_dir is None else cache_dir
+    artifact_dir = _artifact_dir(model_path, cache_dir) if cache_dir else None
+
+    if artifact_dir and os.path.exists(os.path.join(artifact_dir, QUANTIZED_WEIGHTS_NAME)):
+        try:
+            logger.info(f"Chargement du modèle optimisé depuis le cache {artifact_dir}")
+            return _load_cached(artifact_dir), AutoTokenizer.from_pretrained(artifact_dir)
+        except Exception as e:
+            logger.warning(f"Cache du modèle optimisé inutilisable, conversion à nouveau: {str(e)}")
+
+    logger.info(f"Conversion du modèle {model_path} (fusion LoRA + quantification int8)")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = _freeze(quantize_model(merge_lora(load_unmerged_model(model_path, num_labels))))
+
+    if artifact_dir:
+        try:
+            save_optimized_model(model, tokenizer, artifact_dir)
+        except Exception as e:
+            logger.warning(f"Impossible d'enregistrer le modèle optimisé: {str(e)}")
+    return model, tokenizer
+
+def _logits(model, tokenizer, texts):
+    inputs = tokenizer(texts, return_tensors="pt", max_length=512, padding=True, truncation=True)
+    with torch.inference_mode():
+        return model(**inputs).logits.float().numpy()
+
+def check_logits_drift(model_path, num_labels, texts=None, optimized=None):
+    """Compare les logits du modèle optimisé à ceux du modèle fp32 non fusionné"""
+    texts = texts or SAMPLE_TEXTS
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    reference = _logits(load_unmerged_model(model_path, num_labels), tokenizer, texts)
+    if optimized is None:
+        optimized, _ = load_optimized_model(model_path, num_labels, cache_dir="")
+    candidate = _logits(optimized, tokenizer, texts)
+
+    difference = np.abs(reference - candidate)
+    report = {
+        "samples": len(texts),
+        "max_abs_diff": float(difference.max()),
+        "mean_abs_diff": float(difference.mean()),
+        "top1_agreement": float((reference.argmax(axis=-1) == candidate.argmax(axis=-1)).mean())
+    }
+    logger.info(f"Dérive des logits pour {model_path}: {report}")
+    return report
+
+def main():
+    """Fonction principale"""
+    parser = argparse.ArgumentParser(description="Contrôle de précision du modèle fusionné et quantifié")
+    parser.add_argument("--model", choices=["relation", "sentiment"], default="relation")
+    args = parser.parse_args()
+
+    if args.model == "relation":
+        report = check_logits_drift(model_relation_extraction_path, 29,
+                                    [_build_relation_prompt(text) for text in SAMPLE_TEXTS])
+    else:
+        report = check_logits_drift(model_analysis_sentiment_path, 3)
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,424 @@
+"""
+Registre des modèles chargés en mémoire.
+`ModelRegistry` remplace le dictionnaire `model_cache` et s'utilise comme lui, mais
+connaît la taille en mémoire et la date de dernière utilisation de chaque modèle.
+Lorsque le budget mémoire est dépassé, les modèles inactifs les moins récemment
+utilisés sont déchargés, puis rechargés à la demande. Un verrou propre à chaque clé
+garantit que des premières requêtes concurrentes ne chargent un modèle qu'une fois.
+Les checkpoints LoRA partagent un même encodeur de base (bert-base-uncased) chargé une
+seule fois : chacun n'apporte que ses matrices d'adaptation et sa tête de classification.
+"""
+
+import gc
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+import torch
+from transformers.modeling_outputs import SequenceClassifierOutput
+
+logger = logging.getLogger(__name__)
+
+# Budget mémoire des modèles chargés en Mo (0 : pas de limite)
+MODEL_MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", 0))
+# Durée minimale sans utilisation avant qu'un modèle puisse être déchargé pour respecter le budget
+MODEL_MIN_IDLE_SECONDS = float(os.environ.get("MODEL_MIN_IDLE_SECONDS", 30))
+# Déchargement des modèles inutilisés depuis cette durée, même sous le budget (0 : jamais)
+MODEL_IDLE_TTL_SECONDS = float(os.environ.get("MODEL_IDLE_TTL_SECONDS", 0))
+# Partage de l'encodeur de base entre les checkpoints LoRA
+SHARED_LORA_BASE = os.environ.get("SHARED_LORA_BASE", "1") == "1"
+
+def module_of(value):
+    """Module PyTorch porté par une entrée du registre : pipeline, couple (modèle, tokenizer) ou module"""
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if not isinstance(value, torch.nn.Module):
+        value = getattr(value, "model", None)
+    return value if isinstance(value, torch.nn.Module) else None
+
+def memory_bytes(value):
+    """Taille en octets des poids d'une entrée (0 pour les entrées qui ne portent pas de modèle)"""
+    module = module_of(value)
+    if module is None:
+        return 0
+    if hasattr(module, "memory_bytes"):
+        return module.memory_bytes()
+    # Les poids liés (ex. embeddings partagés) ne sont comptés qu'une fois
+    storages = {}
+    for tensor in module.state_dict().values():
+        if isinstance(tensor, torch.Tensor):
+            storages[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+    return sum(storages.values())
+
+class _Entry:
+    __slots__ = ("value", "size", "last_used", "dependencies", "dependents")
+
+    def __init__(self, value, size, dependencies):
+        self.value = value
+        self.size = size
+        self.last_used = time.monotonic()
+        self.dependencies = dependencies
+        self.dependents = 0
+
+class ModelRegistry(MutableMapping):
+    """Cache des modèles borné en mémoire, utilisable comme un dictionnaire.
+
+    Une entrée n'est déchargée que si elle porte un modèle, n'est pas en cours
+    d'utilisation (`lease`), n'est inutilisée que depuis `min_idle_seconds` au moins
+    et ne sert de base à aucune autre entrée. Si aucune entrée ne peut être déchargée,
+    le budget est dépassé et un avertissement est émis.
+    """
+
+    def __init__(self, budget_mb=MODEL_MEMORY_BUDGET_MB, min_idle_seconds=MODEL_MIN_IDLE_SECONDS,
+                 idle_ttl_seconds=MODEL_IDLE_TTL_SECONDS):
+        self.budget_bytes = int(max(0.0, float(budget_mb)) * 1024 * 1024)
+        self.min_idle_seconds = max(0.0, float(min_idle_seconds))
+        self.idle_ttl_seconds = max(0.0, float(idle_ttl_seconds))
+        self._entries = {}
+        self._leases = {}
+        self._load_locks = {}
+        self._lock = threading.RLock()
+        self._sweeper = None
+        self._sweeper_deferred = False
+        self.counters = {"loads": 0, "evictions": 0}
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._entries[key]
+            entry.last_used = time.monotonic()
+            return entry.value
+
+    def __setitem__(self, key, value):
+        size = memory_bytes(value)
+        dependencies = tuple(getattr(module_of(value), "registry_dependencies", ()))
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._detach(previous)
+            entry = self._entries[key] = _Entry(value, size, dependencies)
+            for dependency in dependencies:
+                if dependency in self._entries:
+                    self._entries[dependency].dependents += 1
+            evicted = self._enforce_budget(exclude=key)
+        if evicted:
+            gc.collect()
+        if self.idle_ttl_seconds and self._sweeper is None and not self._sweeper_deferred:
+            self._start_sweeper()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._detach(self._entries.pop(key))
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _detach(self, entry):
+        for dependency in entry.dependencies:
+            if dependency in self._entries:
+                self._entries[dependency].dependents -= 1
+
+    def get_or_load(self, key, loader):
+        """Renvoie l'entrée `key`, en la chargeant avec `loader()` si besoin.
+
+        Les appels concurrents pour une même clé attendent le premier chargement au lieu
+        de charger le modèle une seconde fois.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            pass
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            try:
+                return self[key]
+            except KeyError:
+                pass
+            start = time.perf_counter()
+            value = loader()
+            self[key] = value
+            with self._lock:
+                self.counters["loads"] += 1
+            logger.info(f"Modèle {key} chargé en {time.perf_counter() - start:.1f} s "
+                        f"({memory_bytes(value) / 1024 / 1024:.0f} Mo)")
+            return value
+
+    @contextmanager
+    def lease(self, key):
+        """Protège une entrée du déchargement pendant son utilisation, même si elle n'est pas encore chargée"""
+        with self._lock:
+            self._leases[key] = self._leases.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._leases[key] -= 1
+                if not self._leases[key]:
+                    del self._leases[key]
+                if key in self._entries:
+                    self._entries[key].last_used = time.monotonic()
+
+    def _evictable(self, key, entry, now, min_idle):
+        return (entry.size > 0 and not self._leases.get(key) and not entry.dependents
+                and now - entry.last_used >= min_idle)
+
+    def _evict(self, key, reason):
+        entry = self._entries.pop(key)
+        self._detach(entry)
+        self.counters["evictions"] += 1
+        logger.info(f"Modèle {key} déchargé ({reason}, {entry.size / 1024 / 1024:.0f} Mo)")
+        return entry.size
+
+    def _enforce_budget(self, exclude=None):
+        """Décharge les entrées inactives les moins récemment utilisées jusqu'à respecter le budget"""
+        if not self.budget_bytes:
+            return 0
+        total = sum(entry.size for entry in self._entries.values())
+        evicted = 0
+        while total > self.budget_bytes:
+            now = time.monotonic()
+            candidates = [(entry.last_used, key) for key, entry in self._entries.items()
+                          if key != exclude and self._evictable(key, entry, now, self.min_idle_seconds)]
+            if not candidates:
+                logger.warning(f"Budget mémoire des modèles dépassé ({total / 1024 / 1024:.0f} Mo pour "
+                               f"{self.budget_bytes / 1024 / 1024:.0f} Mo) : aucun modèle inactif à décharger")
+                break
+            total -= self._evict(min(candidates)[1], "budget mémoire")
+            evicted += 1
+        return evicted
+
+    def evict_idle(self, idle_seconds=None):
+        """Décharge les entrées inutilisées depuis au moins `idle_seconds` secondes"""
+        idle_seconds = self.idle_ttl_seconds if idle_seconds is None else idle_seconds
+        with self._lock:
+            now = time.monotonic()
+            # Plusieurs passes : décharger un adaptateur peut rendre son modèle de base déchargeable
+            evicted = 0
+            while True:
+                keys = [key for key, entry in self._entries.items()
+                        if self._evictable(key, entry, now, idle_seconds)]
+                if not keys:
+                    break
+                for key in keys:
+                    self._evict(key, f"inactif depuis {idle_seconds:.0f} s")
+                evicted += len(keys)
+        if evicted:
+            gc.collect()
+        return evicted
+
+    @contextmanager
+    def sweeper_deferred(self):
+        """Retarde le démarrage du thread de déchargement, par exemple jusqu'à la création des processus par fork"""
+        self._sweeper_deferred = True
+        try:
+            yield
+        finally:
+            self._sweeper_deferred = False
+            if self.idle_ttl_seconds and self._sweeper is None and self._entries:
+                self._start_sweeper()
+
+    def _start_sweeper(self):
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            interval = max(1.0, min(self.idle_ttl_seconds / 2, 60.0))
+
+            def sweep():
+                while True:
+                    time.sleep(interval)
+                    try:
+                        self.evict_idle()
+                    except Exception as e:
+                        logger.error(f"Erreur pendant le déchargement des modèles inactifs: {str(e)}")
+
+            self._sweeper = threading.Thread(target=sweep, name="model-registry-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def memory(self):
+        """Couples (clé, taille en octets) des entrées qui portent un modèle"""
+        with self._lock:
+            return [(key, entry.size) for key, entry in self._entries.items() if entry.size]
+
+    def snapshot(self):
+        """État du registre : budget, occupation, compteurs et détail de chaque modèle chargé"""
+        with self._lock:
+            now = time.monotonic()
+            models = {
+                key: {
+                    "size_mb": round(entry.size / 1024 / 1024, 1),
+                    "idle_seconds": round(now - entry.last_used, 1),
+                    "in_use": self._leases.get(key, 0),
+                    "dependents": entry.dependents
+                }
+                for key, entry in self._entries.items() if entry.size
+            }
+            return {
+                "budget_mb": round(self.budget_bytes / 1024 / 1024, 1) or None,
+                "used_mb": round(sum(entry.size for entry in self._entries.values()) / 1024 / 1024, 1),
+                "loads": self.counters["loads"],
+                "evictions": self.counters["evictions"],
+                "models": models
+            }
+
+class SharedLoraBase(torch.nn.Module):
+    """Encodeur de base partagé par plusieurs adaptateurs LoRA.
+
+    Les adaptateurs ne modifient pas ses poids : la contribution LoRA de l'adaptateur
+    actif dans le thread courant est ajoutée à la sortie des couches ciblées par des
+    hooks, si bien que des adaptateurs différents peuvent l'utiliser en parallèle.
+    """
+
+    def __init__(self, base_name):
+        super().__init__()
+        from transformers import AutoModel
+
+        logger.info(f"Chargement de l'encodeur de base partagé {base_name}")
+        self.encoder = AutoModel.from_pretrained(base_name).eval()
+        self.encoder.requires_grad_(False)
+        self._active = threading.local()
+        self._hooked = set()
+        self._hook_lock = threading.Lock()
+
+    def hook(self, module_names):
+        """Installe les hooks LoRA sur les couches ciblées qui n'en ont pas encore"""
+        with self._hook_lock:
+            modules = dict(self.encoder.named_modules())
+            for name in module_names:
+                if name in self._hooked:
+                    continue
+                if name not in modules:
+                    raise ValueError(f"Couche ciblée par l'adaptateur introuvable dans le modèle de base: {name}")
+                modules[name].register_forward_hook(self._lora_hook(name))
+                self._hooked.add(name)
+
+    def _lora_hook(self, name):
+        def hook(module, inputs, output):
+            adapter = getattr(self._active, "adapter", None)
+            weights = adapter.lora.get(name) if adapter is not None else None
+            if weights is None:
+                return None
+            lora_a, lora_b, scaling = weights
+            return output + (inputs[0] @ lora_a.t()) @ lora_b.t() * scaling
+        return hook
+
+    @contextmanager
+    def activate(self, adapter):
+        previous = getattr(self._active, "adapter", None)
+        self._active.adapter = adapter
+        try:
+            yield
+        finally:
+            self._active.adapter = previous
+
+class LoraClassifier(torch.nn.Module):
+    """Classifieur de séquences formé d'un encodeur partagé, d'un adaptateur LoRA et d'une tête propre"""
+
+    def __init__(self, base, base_key, config, lora, classifier):
+        super().__init__()
+        # Encodeur gardé hors des sous-modules : ses poids ne sont ni comptés ni copiés avec l'adaptateur
+        object.__setattr__(self, "_base", base)
+        self.registry_dependencies = (base_key,)
+        self.config = config
+        self.lora = {}
+        for i, (name, (lora_a, lora_b, scaling)) in enumerate(sorted(lora.items())):
+            self.register_buffer(f"lora_a_{i}", lora_a)
+            self.register_buffer(f"lora_b_{i}", lora_b)
+            self.lora[name] = (getattr(self, f"lora_a_{i}"), getattr(self, f"lora_b_{i}"), scaling)
+        dropout = getattr(config, "classifier_dropout", None)
+        self.dropout = torch.nn.Dropout(config.hidden_dropout_prob if dropout is None else dropout)
+        self.classifier = classifier
+        self.eval()
+        self.requires_grad_(False)
+
+    @property
+    def device(self):
+        return self.classifier.weight.device
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, **kwargs):
+        with self._base.activate(self):
+            outputs = self._base.encoder(input_ids=input_ids, attention_mask=attention_mask,
+                                         token_type_ids=token_type_ids)
+        logits = self.classifier(self.dropout(outputs[1]))
+        return SequenceClassifierOutput(logits=logits)
+
+    def share_memory(self):
+        self._base.share_memory()
+        return super().share_memory()
+
+def _read_adapter(adapter_path):
+    """Configuration et poids d'un checkpoint LoRA, ou (None, None) s'il n'y en a pas"""
+    config_path = os.path.join(adapter_path, "adapter_config.json")
+    if not os.path.exists(config_path):
+        return None, None
+    with open(config_path) as f:
+        adapter_config = json.load(f)
+    weights_path = os.path.join(adapter_path, "adapter_model.safetensors")
+    if os.path.exists(weights_path):
+        from safetensors.torch import load_file
+        return adapter_config, load_file(weights_path)
+    weights_path = os.path.join(adapter_path, "adapter_model.bin")
+    if os.path.exists(weights_path):
+        return adapter_config, torch.load(weights_path, map_location="cpu", weights_only=True)
+    return adapter_config, None
+
+def _shareable(adapter_config):
+    """Seuls les adaptateurs LoRA simples de classification de séquences sont pris en charge"""
+    return (adapter_config.get("peft_type") == "LORA" and adapter_config.get("task_type") == "SEQ_CLS"
+            and adapter_config.get("bias", "none") == "none" and not adapter_config.get("use_dora")
+            and not adapter_config.get("fan_in_fan_out") and not adapter_config.get("rank_pattern")
+            and not adapter_config.get("alpha_pattern") and not adapter_config.get("layer_replication"))
+
+def load_lora_classifier(registry, adapter_path, num_labels):
+    """Charge un checkpoint LoRA sur l'encodeur de base partagé du registre.
+
+    Renvoie None si le checkpoint ne se prête pas au partage (pas un adaptateur LoRA,
+    variante non prise en charge, architecture autre que BERT ou tête absente) : il
+    est alors chargé comme un modèle complet.
+    """
+    from transformers import AutoConfig
+
+    adapter_config, weights = _read_adapter(adapter_path)
+    if adapter_config is None or weights is None or not _shareable(adapter_config):
+        return None
+    base_name = adapter_config["base_model_name_or_path"]
+    config = AutoConfig.from_pretrained(base_name, num_labels=num_labels)
+    if config.model_type != "bert":
+        return None
+
+    rank = adapter_config["r"]
+    scaling = adapter_config["lora_alpha"] / (math.sqrt(rank) if adapter_config.get("use_rslora") else rank)
+    prefix = "base_model.model."
+    lora, head = {}, {}
+    for key, tensor in weights.items():
+        name = key[len(prefix):] if key.startswith(prefix) else key
+        if name.endswith((".lora_A.weight", ".lora_B.weight")):
+            module_name = name.rsplit(".lora_", 1)[0]
+            module_name = module_name[len("bert."):] if module_name.startswith("bert.") else module_name
+            lora.setdefault(module_name, {})[name[-len("A.weight")]] = tensor
+        elif name.startswith("classifier."):
+            head[name[len("classifier."):]] = tensor
+        else:
+            return None
+    if set(head) != {"weight", "bias"} or any(set(pair) != {"A", "B"} for pair in lora.values()):
+        return None
+
+    classifier = torch.nn.Linear(config.hidden_size, num_labels)
+    classifier.load_state_dict(head)
+    base_key = f"lora_base_{base_name}"
+    base = registry.get_or_load(base_key, lambda: SharedLoraBase(base_name))
+    base.hook(lora)
+    logger.info(f"Adaptateur LoRA {adapter_path} chargé sur l'encodeur partagé {base_name}")
+    return LoraClassifier(base, base_key, config,
+                          {name: (pair["A"], pair["B"], scaling) for name, pair in lora.items()}, classifier)
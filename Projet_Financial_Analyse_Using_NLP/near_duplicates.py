@@ -0,0 +1,178 @@
+"""
+Détection des quasi-doublons parmi les textes déjà analysés.
+Les dépêches reprises par plusieurs sources ne diffèrent souvent que par une mention
+de source, un horodatage ou la casse d'un ticker : le cache de prédictions, qui
+compare les textes à l'identique, ne les reconnaît pas. Chaque texte est normalisé,
+découpé en n-grammes de mots, puis résumé par une signature MinHash. Un index LSH
+(signature découpée en bandes) retrouve en temps constant les textes candidats, dont
+la similarité de Jaccard estimée est comparée au seuil. L'index est borné en nombre
+d'entrées et chaque entrée expire après une durée de vie fixe.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Paramètres de l'index (surchargeables par variables d'environnement)
+NEAR_DUP_ENABLED = os.environ.get("NEAR_DUP_ENABLED", "1") == "1"
+NEAR_DUP_THRESHOLD = float(os.environ.get("NEAR_DUP_THRESHOLD", 0.8))
+NEAR_DUP_MAX_ENTRIES = int(os.environ.get("NEAR_DUP_MAX_ENTRIES", 20000))
+NEAR_DUP_TTL = float(os.environ.get("NEAR_DUP_TTL", 21600))
+NEAR_DUP_SHINGLE_SIZE = int(os.environ.get("NEAR_DUP_SHINGLE_SIZE", 2))
+
+# Signature MinHash de 64 valeurs découpée en 16 bandes de 4 : deux textes de similarité 0,8
+# partagent au moins une bande avec une probabilité supérieure à 99,9 %
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(1)
+_PERMUTATION_A = _rng.randint(1, 1 << 31, NUM_PERMUTATIONS).astype(np.uint64)
+_PERMUTATION_B = _rng.randint(0, 1 << 31, NUM_PERMUTATIONS).astype(np.uint64)
+
+# Éléments qui varient d'une reprise à l'autre sans changer le contenu de la dépêche
+_URL = re.compile(r"https?://\S+|www\.\S+")
+_TAG = re.compile(r"\([^()]{0,40}\)|\[[^\[\]]{0,40}\]")
+_TIMESTAMP = re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[t ]\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?(?:z|[+-]\d{2}:?\d{2})?)?\b"
+                        r"|\b\d{1,2}[/.]\d{1,2}[/.]\d{2,4}\b"
+                        r"|\b\d{1,2}:\d{2}(?::\d{2})?\s*(?:am|pm|gmt|utc|et|cet)?\b")
+_WORD = re.compile(r"\w+")
+
+def normalize_tokens(text):
+    """Mots du texte en minuscules, sans URL, mentions entre parenthèses ou crochets, ni horodatages"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = _TAG.sub(" ", _URL.sub(" ", text))
+    return _WORD.findall(_TIMESTAMP.sub(" ", text))
+
+def shingles(tokens, size=None):
+    size = max(1, size or NEAR_DUP_SHINGLE_SIZE)
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+def signature(text):
+    """Signature MinHash d'un texte, ou None s'il ne contient aucun mot"""
+    items = shingles(normalize_tokens(text))
+    if not items:
+        return None
+    hashes = np.fromiter((int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=4).digest(), "little")
+                          for item in items), dtype=np.uint64, count=len(items))
+    # Hachages 32 bits et coefficients 31 bits : le produit tient dans un entier non signé de 64 bits
+    permuted = (np.outer(hashes, _PERMUTATION_A) + _PERMUTATION_B) % _MERSENNE_PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+def similarity(first, second):
+    """Similarité de Jaccard estimée entre deux signatures"""
+    return float(np.count_nonzero(first == second)) / len(first)
+
+def _bands(namespace, sig):
+    rows = NUM_PERMUTATIONS // NUM_BANDS
+    return [(namespace, band, sig[band * rows:(band + 1) * rows].tobytes()) for band in range(NUM_BANDS)]
+
+class _Entry:
+    __slots__ = ("namespace", "signature", "result", "source_id", "text", "created")
+
+    def __init__(self, namespace, sig, result, source_id, text):
+        self.namespace = namespace
+        self.signature = sig
+        self.result = result
+        self.source_id = source_id
+        self.text = text
+        self.created = time.monotonic()
+
+class NearDuplicateIndex:
+    """Index LSH des signatures des textes analysés, borné en taille et en durée de vie.
+
+    Les entrées sont regroupées par espace de noms (par exemple le modèle et sa révision) :
+    un résultat n'est réutilisé que pour la même prédiction. Les entrées les plus
+    anciennes sont retirées en premier, qu'elles aient expiré ou que l'index soit plein.
+    """
+
+    def __init__(self, max_entries=NEAR_DUP_MAX_ENTRIES, ttl_seconds=NEAR_DUP_TTL, threshold=NEAR_DUP_THRESHOLD):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self.threshold = float(threshold)
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._ids = 0
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "additions": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        for band in _bands(entry.namespace, entry.signature):
+            bucket = self._buckets.get(band)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band]
+
+    def _expire(self):
+        if self.ttl <= 0:
+            return
+        deadline = time.monotonic() - self.ttl
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if entry.created > deadline:
+                break
+            self._remove(entry_id)
+            self.stats["expirations"] += 1
+
+    def lookup(self, namespace, sig, count=True):
+        """Renvoie (entrée, similarité) du texte indexé le plus proche au-dessus du seuil, ou (None, 0.0)"""
+        if sig is None:
+            return None, 0.0
+        with self._lock:
+            if count:
+                self.stats["lookups"] += 1
+            self._expire()
+            candidates = set()
+            for band in _bands(namespace, sig):
+                candidates.update(self._buckets.get(band, ()))
+            best, best_similarity = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                score = similarity(sig, entry.signature)
+                if score >= self.threshold and score > best_similarity:
+                    best, best_similarity = entry, score
+            if best is not None and count:
+                self.stats["hits"] += 1
+            return best, best_similarity
+
+    def add(self, namespace, sig, result, source_id=None, text=None):
+        """Indexe le résultat d'un texte analysé"""
+        if sig is None or self.max_entries == 0:
+            return
+        with self._lock:
+            self._expire()
+            while len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+            self._ids += 1
+            self._entries[self._ids] = _Entry(namespace, sig, result, source_id, text)
+            for band in _bands(namespace, sig):
+                self._buckets.setdefault(band, set()).add(self._ids)
+            self.stats["additions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), max_entries=self.max_entries, ttl_seconds=self.ttl,
+                        threshold=self.threshold)
+
+near_duplicate_index = NearDuplicateIndex()
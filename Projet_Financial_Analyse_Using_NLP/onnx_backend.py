@@ -0,0 +1,213 @@
+"""
+Export ONNX des classifieurs et exécution par ONNX Runtime sur CPU.
+Les modèles de sentiment, de NER et d'extraction de relation (adaptateurs LoRA
+fusionnés) sont exportés en graphes ONNX à axes batch et séquence dynamiques.
+`OnnxModel` se substitue au module PyTorch dans `model_cache` : il reçoit les
+mêmes tenseurs et renvoie les mêmes sorties, si bien que le format des résultats
+des fonctions `predict_*` ne change pas.
+
+Usage :
+    python onnx_backend.py export --models sentiment ner relation
+    python onnx_backend.py check --models sentiment ner relation
+"""
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+from transformers.modeling_outputs import SequenceClassifierOutput, TokenClassifierOutput
+
+logger = logging.getLogger(__name__)
+
+# Dossier des graphes exportés et nombre de threads d'ONNX Runtime (0 : valeur par défaut)
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "./onnx_models")
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", 0))
+ONNX_OPSET = 14
+
+ONNX_MODEL_TYPES = ("sentiment", "ner", "relation")
+_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+class _LogitsOnly(torch.nn.Module):
+    """Expose uniquement les logits du modèle, seule sortie du graphe exporté"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).logits
+
+def model_dir(model_type, output_dir=None):
+    return os.path.join(output_dir or ONNX_MODEL_DIR, model_type)
+
+def export_model(model, tokenizer, model_type, source, output_dir=None):
+    """Exporte un classifieur PyTorch en graphe ONNX à axes batch et séquence dynamiques"""
+    directory = model_dir(model_type, output_dir)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "model.onnx")
+
+    token_classification = model_type == "ner"
+    sample = tokenizer(["exemple d'export", "deuxième exemple plus long pour l'export"], padding=True,
+                       return_tensors="pt")
+    inputs = tuple(sample.get(name, torch.zeros_like(sample["input_ids"])) for name in _INPUT_NAMES)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in _INPUT_NAMES}
+    dynamic_axes["logits"] = {0: "batch", 1: "sequence"} if token_classification else {0: "batch"}
+
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # Exportateur TorchScript : gère directement les axes dynamiques déclarés
+        kwargs["dynamo"] = False
+    # L'exportateur restaure ensuite le mode du module exporté : l'enveloppe doit être en mode évaluation,
+    # sinon le modèle serait laissé en mode entraînement (dropout actif)
+    wrapper = _LogitsOnly(model).eval()
+    with torch.no_grad():
+        torch.onnx.export(wrapper, inputs, path, input_names=_INPUT_NAMES, output_names=["logits"],
+                          dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET, do_constant_folding=True, **kwargs)
+    model.config.save_pretrained(directory)
+    with open(os.path.join(directory, "source.json"), "w") as f:
+        json.dump({"model_type": model_type, "source": source}, f)
+    logger.info(f"Modèle {model_type} exporté en ONNX dans {path}")
+    return path
+
+class OnnxModel(torch.nn.Module):
+    """Classifieur servi par ONNX Runtime, interchangeable avec le modèle PyTorch d'origine"""
+
+    def __init__(self, path, config, token_classification=False):
+        super().__init__()
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if ONNX_THREADS:
+            options.intra_op_num_threads = ONNX_THREADS
+        self.config = config
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self._output = TokenClassifierOutput if token_classification else SequenceClassifierOutput
+
+    def memory_bytes(self):
+        """Taille du graphe chargé, utilisée par le registre des modèles à la place des poids PyTorch"""
+        return os.path.getsize(self.path)
+
+    def forward(self, input_ids, attention_mask=None, token_type_ids=None, **kwargs):
+        tensors = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        if tensors["attention_mask"] is None:
+            tensors["attention_mask"] = torch.ones_like(input_ids)
+        if tensors["token_type_ids"] is None:
+            tensors["token_type_ids"] = torch.zeros_like(input_ids)
+        feeds = {name: np.ascontiguousarray(tensors[name].cpu().numpy(), dtype=np.int64) for name in self.input_names}
+        logits = self.session.run(["logits"], feeds)[0]
+        return self._output(logits=torch.from_numpy(logits))
+
+def load_onnx_model(model_type, source, export_from=None, output_dir=None):
+    """Charge le graphe ONNX d'un modèle, en l'exportant d'abord s'il n'existe pas.
+
+    `export_from` renvoie le couple (modèle PyTorch, tokenizer) à exporter si nécessaire.
+    """
+    from transformers import AutoConfig
+
+    directory = model_dir(model_type, output_dir)
+    path = os.path.join(directory, "model.onnx")
+    if not os.path.exists(path):
+        if export_from is None:
+            raise FileNotFoundError(f"Graphe ONNX introuvable: {path}. Lancez 'python onnx_backend.py export'")
+        logger.info(f"Graphe ONNX du modèle {model_type} absent, export en cours")
+        model, tokenizer = export_from()
+        export_model(model, tokenizer, model_type, source, output_dir)
+
+    try:
+        with open(os.path.join(directory, "source.json")) as f:
+            exported_source = json.load(f).get("source")
+        if exported_source != source:
+            logger.warning(f"Le graphe ONNX {path} a été exporté depuis {exported_source}, pas depuis {source}")
+    except (OSError, ValueError):
+        pass
+
+    logger.info(f"Chargement du graphe ONNX {path}")
+    return OnnxModel(path, AutoConfig.from_pretrained(directory), token_classification=model_type == "ner")
+
+def relation_export_source():
+    """Modèle de relation fp32 avec ses adaptateurs LoRA fusionnés, et son tokenizer"""
+    import model_bert_fine_tuned as models
+    from transformers import AutoTokenizer
+    from model_optimization import load_unmerged_model, merge_lora
+
+    model = merge_lora(load_unmerged_model(models.model_relation_extraction_path, 29))
+    return model, AutoTokenizer.from_pretrained(models.model_relation_extraction_path)
+
+def _torch_model(model_type):
+    """Modèle PyTorch d'origine d'un type de modèle, chargé sans passer par model_cache"""
+    import model_bert_fine_tuned as models
+    from transformers import AutoModelForTokenClassification, AutoModelForSequenceClassification, AutoTokenizer
+
+    if model_type == "relation":
+        return relation_export_source()
+    name = models.sentiment_model_name if model_type == "sentiment" else models.ner_model_name
+    model_class = AutoModelForTokenClassification if model_type == "ner" else AutoModelForSequenceClassification
+    return model_class.from_pretrained(name).eval(), AutoTokenizer.from_pretrained(name)
+
+def _sample_inputs(model_type, tokenizer, texts):
+    import model_bert_fine_tuned as models
+
+    if model_type == "relation":
+        texts = [models._build_relation_prompt(text) for text in texts]
+    return tokenizer(texts, padding=True, truncation=True, max_length=512, return_tensors="pt")
+
+def check_equivalence(model_type, texts=None, output_dir=None):
+    """Compare les logits du graphe ONNX à ceux du modèle PyTorch sur des phrases d'exemple"""
+    import model_bert_fine_tuned as models
+    from model_optimization import SAMPLE_TEXTS
+
+    torch_model, tokenizer = _torch_model(model_type)
+    onnx_model = load_onnx_model(model_type, models.backend_source(model_type),
+                                 export_from=lambda: (torch_model, tokenizer), output_dir=output_dir)
+    inputs = _sample_inputs(model_type, tokenizer, texts or SAMPLE_TEXTS)
+    with torch.no_grad():
+        reference = torch_model(**inputs).logits.float().numpy()
+        candidate = onnx_model(**inputs).logits.float().numpy()
+
+    # Pour la NER, seuls les tokens réels (hors padding) sont comparés
+    mask = inputs["attention_mask"].numpy().astype(bool) if model_type == "ner" else np.ones(len(reference), bool)
+    difference = np.abs(reference - candidate)[mask]
+    report = {
+        "model_type": model_type,
+        "samples": len(texts or SAMPLE_TEXTS),
+        "max_abs_diff": float(difference.max()),
+        "mean_abs_diff": float(difference.mean()),
+        "top1_agreement": float((reference.argmax(axis=-1) == candidate.argmax(axis=-1))[mask].mean())
+    }
+    logger.info(f"Équivalence ONNX / PyTorch: {report}")
+    return report
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Export ONNX et contrôle d'équivalence avec PyTorch")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--models", nargs="+", choices=ONNX_MODEL_TYPES, default=list(ONNX_MODEL_TYPES))
+    parser.add_argument("--output-dir", default=None, help=f"Dossier des graphes (défaut: {ONNX_MODEL_DIR})")
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="Écart absolu maximal toléré entre les logits")
+    args = parser.parse_args()
+
+    import model_bert_fine_tuned as models
+
+    if args.command == "export":
+        for model_type in args.models:
+            model, tokenizer = _torch_model(model_type)
+            export_model(model, tokenizer, model_type, models.backend_source(model_type), args.output_dir)
+        return 0
+
+    reports = [check_equivalence(model_type, output_dir=args.output_dir) for model_type in args.models]
+    print(json.dumps(reports, indent=2))
+    return 0 if all(r["max_abs_diff"] <= args.tolerance and r["top1_agreement"] == 1.0 for r in reports) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
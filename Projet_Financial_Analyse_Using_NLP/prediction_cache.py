@@ -0,0 +1,165 @@
+"""
+Cache des résultats de prédiction.
+Les résultats sont indexés par une empreinte de (type de modèle, révision du modèle,
+texte normalisé, instruction). Le cache combine un niveau en mémoire (LRU borné en
+taille et en durée de vie) et un niveau SQLite optionnel qui survit aux redémarrages.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Paramètres du cache (surchargeables par variables d'environnement)
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", 3600))
+PREDICTION_CACHE_DB = os.environ.get("PREDICTION_CACHE_DB", "")
+PREDICTION_CACHE_DB_MAX_ENTRIES = int(os.environ.get("PREDICTION_CACHE_DB_MAX_ENTRIES", 1000000))
+
+# Fréquence (en écritures) du nettoyage des entrées expirées du niveau disque
+_DISK_PURGE_INTERVAL = 1000
+
+def normalize_text(text, model_type):
+    """Normalise un texte avant calcul de l'empreinte.
+
+    Les résultats NER et de relation contiennent des positions de caractères : leur texte
+    est conservé tel quel. Pour le sentiment, les espaces superflus sont ignorés.
+    """
+    if model_type != "sentiment":
+        return text
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+def make_key(model_type, revision, text, instruction=None):
+    """Calcule l'empreinte d'une requête de prédiction"""
+    payload = json.dumps([model_type, revision, normalize_text(text, model_type), instruction or ""],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class PredictionCache:
+    """Cache LRU en mémoire avec durée de vie, doublé d'un niveau SQLite optionnel"""
+
+    def __init__(self, max_entries=10000, ttl_seconds=3600, db_path=None, db_max_entries=1000000):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = float(ttl_seconds)
+        self.db_max_entries = int(db_max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._disk_writes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        if db_path:
+            self._open_db(db_path)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 or self._db is not None
+
+    def _open_db(self, db_path):
+        try:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions "
+                             "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_created ON predictions (created)")
+            self._purge_disk()
+            logger.info(f"Cache de prédictions persistant ouvert: {db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Impossible d'ouvrir le cache persistant {db_path}: {str(e)}")
+            self._db = None
+
+    def _purge_disk(self):
+        """Supprime les entrées expirées ou excédentaires du niveau disque"""
+        self._db.execute("DELETE FROM predictions WHERE created < ?", (time.time() - self.ttl,))
+        self._db.execute("DELETE FROM predictions WHERE key IN (SELECT key FROM predictions "
+                         "ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.db_max_entries,))
+        self._db.commit()
+
+    def _remember(self, key, value, created):
+        """Ajoute une entrée au niveau mémoire en évinçant la moins récemment utilisée"""
+        if self.max_entries == 0:
+            return
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key):
+        """Renvoie une copie du résultat mis en cache, ou None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return json.loads(value)
+                del self._entries[key]
+                self.stats["expirations"] += 1
+
+            if self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value, created FROM predictions WHERE key = ?",
+                                           (key,)).fetchone()
+                except sqlite3.Error as e:
+                    logger.warning(f"Lecture du cache persistant impossible: {str(e)}")
+                    row = None
+                if row is not None and now - row[1] <= self.ttl:
+                    self._remember(key, row[0], row[1])
+                    self.stats["disk_hits"] += 1
+                    return json.loads(row[0])
+
+            self.stats["misses"] += 1
+            return None
+
+    def set(self, key, result):
+        """Enregistre un résultat sérialisable en JSON"""
+        self.set_many([(key, result)])
+
+    def set_many(self, items):
+        """Enregistre plusieurs résultats en une seule transaction disque"""
+        now = time.time()
+        values = [(key, json.dumps(result, ensure_ascii=False), now) for key, result in items]
+        with self._lock:
+            for key, value, created in values:
+                self._remember(key, value, created)
+            if self._db is not None and values:
+                try:
+                    self._db.executemany("INSERT OR REPLACE INTO predictions (key, value, created) VALUES (?, ?, ?)",
+                                         values)
+                    previous_writes = self._disk_writes
+                    self._disk_writes += len(values)
+                    if self._disk_writes // _DISK_PURGE_INTERVAL != previous_writes // _DISK_PURGE_INTERVAL:
+                        self._purge_disk()
+                    else:
+                        self._db.commit()
+                except sqlite3.Error as e:
+                    logger.warning(f"Écriture du cache persistant impossible: {str(e)}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM predictions")
+                self._db.commit()
+
+    def get_stats(self):
+        """Renvoie les compteurs du cache et sa taille courante"""
+        with self._lock:
+            stats = dict(self.stats, size=len(self._entries), max_entries=self.max_entries,
+                         ttl_seconds=self.ttl, persistent=self._db is not None)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL, PREDICTION_CACHE_DB,
+                                   PREDICTION_CACHE_DB_MAX_ENTRIES)
@@ -0,0 +1,116 @@
+"""
+État de chargement des modèles et préchauffage en arrière-plan.
+Ce module ne dépend ni de torch ni de transformers : ils ne sont importés que par
+le thread de préchauffage, ce qui permet à un processus qui ne sert que les pages
+statiques de démarrer sans les charger.
+"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Modèles nécessaires pour que le service soit déclaré prêt
+READY_MODELS = tuple(m for m in os.environ.get("READY_MODELS", "sentiment,ner,relation").split(",") if m)
+
+# Longueurs (en tokens) et taille des batches factices utilisés pour le préchauffage
+WARMUP_LENGTHS = tuple(int(n) for n in os.environ.get("WARMUP_LENGTHS", "16,64,256").split(",") if n)
+WARMUP_BATCH_SIZE = int(os.environ.get("WARMUP_BATCH_SIZE", 8))
+
+_states = {}
+_lock = threading.Lock()
+_warmup_thread = None
+_tracked = False
+
+def _status(model_type):
+    return _states.setdefault(model_type, {"state": "not_loaded", "load_seconds": None,
+                                           "warmup_seconds": None, "error": None})
+
+def set_state(model_type, state, **fields):
+    """Met à jour l'état d'un modèle (not_loaded, loading, warming, ready, error)"""
+    with _lock:
+        status = _status(model_type)
+        status["state"] = state
+        status.update(fields)
+
+def record_load(model_type, seconds):
+    """Enregistre la durée de chargement d'un modèle chargé à la demande"""
+    with _lock:
+        status = _status(model_type)
+        status["load_seconds"] = round(seconds, 3)
+        if status["state"] in ("not_loaded", "loading"):
+            status["state"] = "loaded"
+
+def snapshot():
+    """Renvoie une copie de l'état de chaque modèle"""
+    with _lock:
+        return {model_type: dict(_status(model_type)) for model_type in READY_MODELS}
+
+def is_ready():
+    """Indique si le service peut recevoir du trafic.
+
+    Sans préchauffage, les modèles sont chargés à la première requête et le service
+    est toujours considéré comme prêt.
+    """
+    if _warmup_thread is None and not _tracked:
+        return True
+    states = snapshot()
+    return all(states[model_type]["state"] == "ready" for model_type in READY_MODELS)
+
+def track_models():
+    """Active le suivi de disponibilité lorsque les modèles sont préparés hors de ce module"""
+    global _tracked
+    _tracked = True
+
+def _warmup_text(tokens):
+    # « market » correspond à un seul token dans le vocabulaire bert-base-uncased
+    return " ".join(["market"] * max(1, tokens - 2))
+
+def _load_and_warm(model_type):
+    """Charge un modèle dans le cache puis l'exécute sur des batches factices"""
+    import model_bert_fine_tuned as models
+
+    loaders = {
+        "sentiment": models.get_sentiment_pipeline,
+        "ner": models.get_ner_pipeline,
+        "relation": lambda: models.load_model_bert_base_uncased(models.model_relation_extraction_path, num_labels=29)
+    }
+    warmers = {
+        "sentiment": models.predict_sentiment_batch,
+        "ner": models.predict_ner_batch,
+        "relation": models.predict_relation_batch
+    }
+
+    set_state(model_type, "loading")
+    start = time.perf_counter()
+    loaders[model_type]()
+    load_seconds = time.perf_counter() - start
+
+    set_state(model_type, "warming", load_seconds=round(load_seconds, 3))
+    start = time.perf_counter()
+    for tokens in WARMUP_LENGTHS:
+        warmers[model_type]([_warmup_text(tokens)] * WARMUP_BATCH_SIZE)
+    set_state(model_type, "ready", warmup_seconds=round(time.perf_counter() - start, 3))
+    logger.info(f"Modèle {model_type} prêt (chargement {load_seconds:.1f} s)")
+
+def _warmup(model_types):
+    for model_type in model_types:
+        try:
+            _load_and_warm(model_type)
+        except Exception as e:
+            logger.error(f"Erreur lors du préchauffage du modèle {model_type}: {str(e)}")
+            set_state(model_type, "error", error=str(e))
+
+def start_background_warmup(model_types=None):
+    """Lance le chargement et le préchauffage des modèles dans un thread d'arrière-plan"""
+    global _warmup_thread
+    with _lock:
+        if _warmup_thread is not None:
+            return _warmup_thread
+        _warmup_thread = threading.Thread(target=_warmup, args=(tuple(model_types or READY_MODELS),),
+                                          name="model-warmup", daemon=True)
+    _warmup_thread.start()
+    logger.info("Préchauffage des modèles lancé en arrière-plan")
+    return _warmup_thread
@@ -0,0 +1,358 @@
+"""
+Base des résultats d'analyse accumulés.
+Les résultats servis par l'API et par l'analyse continue (sentiment, entités, relation,
+triplets de relation entre paires d'entités) sont enregistrés avec leur horodatage de
+publication dans une base SQLite optionnelle (`RESULT_STORE_DB`). Les écritures sont
+confiées à un thread dédié qui les regroupe en transactions : l'enregistrement ne fait
+que déposer le résultat dans une file bornée et ne ralentit pas l'inférence. Les
+entités sont indexées par nom normalisé et par type, ce qui permet de répondre en
+quelques millisecondes, sans exécuter de modèle, à des questions comme « quel était le
+sentiment sur Tesla la semaine dernière ? » ou « quelles entreprises X possède-t-elle ? ».
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from batch_io import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Paramètres de la base (surchargeables par variables d'environnement)
+RESULT_STORE_DB = os.environ.get("RESULT_STORE_DB", "")
+RESULT_STORE_BATCH_SIZE = int(os.environ.get("RESULT_STORE_BATCH_SIZE", 500))
+RESULT_STORE_FLUSH_SECONDS = float(os.environ.get("RESULT_STORE_FLUSH_SECONDS", 1.0))
+RESULT_STORE_QUEUE_SIZE = int(os.environ.get("RESULT_STORE_QUEUE_SIZE", 10000))
+
+# Intervalle de vérification que le thread d'écriture est toujours actif pendant flush()
+_FLUSH_POLL_SECONDS = 0.1
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS documents (doc_key TEXT PRIMARY KEY, source_id TEXT, text TEXT NOT NULL, "
+    "published REAL NOT NULL, recorded REAL NOT NULL, sentiment_label TEXT, sentiment_score REAL, "
+    "relation_label TEXT, relation_score REAL)",
+    "CREATE INDEX IF NOT EXISTS documents_published ON documents (published)",
+    "CREATE TABLE IF NOT EXISTS entities (doc_key TEXT NOT NULL, type TEXT NOT NULL, name TEXT NOT NULL, "
+    "norm TEXT NOT NULL, start_char INTEGER, end_char INTEGER, score REAL, "
+    "UNIQUE (doc_key, type, start_char, end_char))",
+    "CREATE INDEX IF NOT EXISTS entities_norm ON entities (norm, type)",
+    "CREATE INDEX IF NOT EXISTS entities_type ON entities (type, norm)",
+    "CREATE TABLE IF NOT EXISTS triples (doc_key TEXT NOT NULL, head TEXT NOT NULL, head_norm TEXT NOT NULL, "
+    "head_type TEXT, tail TEXT NOT NULL, tail_norm TEXT NOT NULL, tail_type TEXT, label TEXT NOT NULL, "
+    "score REAL, UNIQUE (doc_key, head_norm, head_type, tail_norm, tail_type))",
+    "CREATE INDEX IF NOT EXISTS triples_head ON triples (head_norm, label)",
+    "CREATE INDEX IF NOT EXISTS triples_tail ON triples (tail_norm, label)",
+)
+
+# Un résultat déjà enregistré pour le même document complète la ligne sans l'écraser
+_UPSERT_DOCUMENT = (
+    "INSERT INTO documents (doc_key, source_id, text, published, recorded, sentiment_label, sentiment_score, "
+    "relation_label, relation_score) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (doc_key) DO UPDATE SET "
+    "sentiment_label = COALESCE(excluded.sentiment_label, sentiment_label), "
+    "sentiment_score = COALESCE(excluded.sentiment_score, sentiment_score), "
+    "relation_label = COALESCE(excluded.relation_label, relation_label), "
+    "relation_score = COALESCE(excluded.relation_score, relation_score)"
+)
+_INSERT_ENTITY = ("INSERT OR IGNORE INTO entities (doc_key, type, name, norm, start_char, end_char, score) "
+                  "VALUES (?, ?, ?, ?, ?, ?, ?)")
+_INSERT_TRIPLE = ("INSERT OR REPLACE INTO triples (doc_key, head, head_norm, head_type, tail, tail_norm, tail_type, "
+                  "label, score) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+# Regroupements temporels des séries de sentiment (format strftime de SQLite)
+INTERVALS = {"hour": "%Y-%m-%dT%H:00", "day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+_RELATIVE_BOUND = re.compile(r"^(\d+(?:\.\d+)?)\s*([mhdw])$")
+_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+def normalize_entity(name):
+    """Forme normalisée d'un nom d'entité : casse, espaces et variantes Unicode ignorés"""
+    return " ".join(unicodedata.normalize("NFKC", str(name)).lower().split())
+
+def parse_bound(value, now=None):
+    """Convertit une borne de requête (durée relative « 7d », « 12h », horodatage ou date ISO) en secondes epoch"""
+    if value is None or value == "":
+        return None
+    match = _RELATIVE_BOUND.match(str(value).strip().lower())
+    if match:
+        return (now or time.time()) - float(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+    try:
+        value = float(value)
+    except ValueError:
+        pass
+    bound = parse_timestamp(value)
+    if bound is None:
+        raise ValueError(f"Borne temporelle non valide: {value}")
+    return bound
+
+def document_key(text, source_id=None):
+    """Empreinte d'un document : un même texte soumis plusieurs fois sans identifiant n'est compté qu'une fois"""
+    payload = json.dumps(["" if source_id is None else str(source_id), text], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _sentiment_fields(sentiment):
+    if not isinstance(sentiment, dict) or "label" not in sentiment:
+        return None, None
+    from streaming import sentiment_score
+    return sentiment["label"], sentiment_score(sentiment)
+
+def _relation_fields(relation):
+    if not isinstance(relation, dict) or "label" not in relation:
+        return None, None
+    probabilities = relation.get("probabilities") or []
+    index = relation.get("class")
+    score = probabilities[index] if isinstance(index, int) and 0 <= index < len(probabilities) else None
+    return relation["label"], score
+
+def _entity_row(doc_key, entity):
+    # Entités de la NER (entity_group, word) ou de l'extraction de relation (type, text)
+    entity_type = entity.get("entity_group") or entity.get("type")
+    name = " ".join(str(entity.get("word") or entity.get("text") or "").split())
+    if not entity_type or not name:
+        return None
+    return (doc_key, entity_type, name, normalize_entity(name), entity.get("start"), entity.get("end"),
+            entity.get("score"))
+
+def _triple_row(doc_key, triple):
+    head, tail = triple.get("head") or {}, triple.get("tail") or {}
+    if not head.get("text") or not tail.get("text") or not triple.get("label"):
+        return None
+    return (doc_key, head["text"], normalize_entity(head["text"]), head.get("type"), tail["text"],
+            normalize_entity(tail["text"]), tail.get("type"), triple["label"], triple.get("score"))
+
+def extract_rows(model_type, text, result, source_id, published, recorded):
+    """Décompose un résultat en lignes (document, entités, triplets) selon la forme propre à chaque type de modèle"""
+    doc_key = document_key(text, source_id)
+    if model_type == "analyze":
+        sentiment, relation = result.get("sentiment"), result.get("relation")
+        entities = (result.get("ner") or {}).get("entities") or []
+    else:
+        sentiment = result if model_type == "sentiment" else None
+        relation = result if model_type == "relation" else None
+        entities = result.get("entities") or []
+    document = (doc_key, None if source_id is None else str(source_id), text, published, recorded,
+                *_sentiment_fields(sentiment), *_relation_fields(relation))
+    entity_rows = [row for row in (_entity_row(doc_key, e) for e in entities if isinstance(e, dict)) if row]
+    triple_rows = [row for row in (_triple_row(doc_key, t) for t in result.get("triples") or []
+                                   if isinstance(t, dict)) if row]
+    return document, entity_rows, triple_rows
+
+class ResultStore:
+    """Base SQLite des résultats, alimentée par un thread d'écriture qui regroupe les enregistrements"""
+
+    def __init__(self, db_path=None, batch_size=RESULT_STORE_BATCH_SIZE, flush_seconds=RESULT_STORE_FLUSH_SECONDS,
+                 queue_size=RESULT_STORE_QUEUE_SIZE):
+        self.db_path = db_path or None
+        self.batch_size = max(1, int(batch_size))
+        self.flush_seconds = max(0.0, float(flush_seconds))
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"recorded": 0, "dropped": 0, "written": 0, "transactions": 0, "errors": 0}
+        if self.db_path:
+            self._open_db()
+
+    @property
+    def enabled(self):
+        return self.db_path is not None
+
+    def _open_db(self):
+        try:
+            db = sqlite3.connect(self.db_path)
+            db.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                db.execute(statement)
+            db.commit()
+            db.close()
+            logger.info(f"Base des résultats ouverte: {self.db_path}")
+        except sqlite3.Error as e:
+            logger.error(f"Impossible d'ouvrir la base des résultats {self.db_path}: {str(e)}")
+            self.db_path = None
+
+    def record(self, model_type, text, result, source_id=None, timestamp=None):
+        """Dépose un résultat dans la file d'écriture, sans attendre ; il est ignoré si la file est pleine"""
+        if self.db_path is None or not text or not isinstance(result, dict):
+            return
+        recorded = time.time()
+        try:
+            self._queue.put_nowait((model_type, text, result, source_id,
+                                    recorded if timestamp is None else timestamp, recorded))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            logger.debug("File d'écriture de la base des résultats pleine, résultat ignoré (%d)", self.stats["dropped"])
+            return
+        self.stats["recorded"] += 1
+        if self._writer is None:
+            self._start_writer()
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="result-store-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        db = None
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    items.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # Connexion ouverte (ou rouverte) dans la boucle : un échec ne concerne que ce batch
+                if db is None:
+                    db = sqlite3.connect(self.db_path)
+                self._write(db, items)
+            except Exception as e:
+                # Le thread d'écriture ne doit jamais s'arrêter : flush() attend qu'il vide la file
+                self.stats["errors"] += 1
+                logger.error(f"Écriture de {len(items)} résultat(s) dans la base impossible: {str(e)}")
+            finally:
+                for _ in items:
+                    self._queue.task_done()
+
+    def _write(self, db, items):
+        documents, entities, triples = [], [], []
+        for model_type, text, result, source_id, published, recorded in items:
+            try:
+                document, entity_rows, triple_rows = extract_rows(model_type, text, result, source_id, published,
+                                                                  recorded)
+            except (AttributeError, TypeError, KeyError, ValueError) as e:
+                logger.warning(f"Résultat {model_type} non enregistré, forme inattendue: {str(e)}")
+                continue
+            documents.append(document)
+            entities.extend(entity_rows)
+            triples.extend(triple_rows)
+        try:
+            with db:
+                db.executemany(_UPSERT_DOCUMENT, documents)
+                db.executemany(_INSERT_ENTITY, entities)
+                db.executemany(_INSERT_TRIPLE, triples)
+            self.stats["written"] += len(documents)
+            self.stats["transactions"] += 1
+            logger.debug("Base des résultats: %d document(s) écrit(s) en une transaction", len(documents))
+        except sqlite3.Error as e:
+            self.stats["errors"] += 1
+            logger.error(f"Écriture de {len(documents)} résultat(s) dans la base impossible: {str(e)}")
+
+    def flush(self):
+        """Attend que les résultats déposés soient écrits, tant que le thread d'écriture est actif"""
+        if self._writer is None:
+            return
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks and self._writer.is_alive():
+                self._queue.all_tasks_done.wait(_FLUSH_POLL_SECONDS)
+
+    def _connection(self):
+        # Une connexion en lecture seule par thread : les lectures ne bloquent pas l'écriture (WAL)
+        db = getattr(self._local, "db", None)
+        if db is None:
+            if self.db_path is None:
+                raise ValueError("Base des résultats désactivée : définissez RESULT_STORE_DB")
+            db = self._local.db = sqlite3.connect(self.db_path)
+            db.execute("PRAGMA query_only = ON")
+        return db
+
+    @staticmethod
+    def _window(since, until):
+        return (float("-inf") if since is None else since), (float("inf") if until is None else until)
+
+    def entity_sentiment(self, name, entity_type=None, since=None, until=None, interval="day"):
+        """Sentiment des documents citant une entité, au total et par période"""
+        if interval not in INTERVALS:
+            raise ValueError(f"Intervalle non valide: {interval}. Choisissez parmi {', '.join(INTERVALS)}")
+        since, until = self._window(since, until)
+        norm = normalize_entity(name)
+        rows = self._connection().execute(
+            "SELECT strftime(?, d.published, 'unixepoch') AS period, d.sentiment_label, COUNT(*), "
+            "SUM(d.sentiment_score) FROM (SELECT DISTINCT doc_key FROM entities WHERE norm = ? AND "
+            "(? IS NULL OR type = ?)) e JOIN documents d ON d.doc_key = e.doc_key "
+            "WHERE d.published >= ? AND d.published < ? AND d.sentiment_label IS NOT NULL "
+            "GROUP BY period, d.sentiment_label ORDER BY period",
+            (INTERVALS[interval], norm, entity_type, entity_type, since, until)).fetchall()
+        labels, series = {}, {}
+        for period, label, count, score_sum in rows:
+            labels[label] = labels.get(label, 0) + count
+            point = series.setdefault(period, [0, 0.0])
+            point[0] += count
+            point[1] += score_sum or 0.0
+        count = sum(labels.values())
+        return {
+            "entity": norm,
+            "type": entity_type,
+            "documents": count,
+            "mean_score": sum(point[1] for point in series.values()) / count if count else None,
+            "labels": labels,
+            "series": [{"period": period, "documents": point[0], "mean_score": point[1] / point[0]}
+                       for period, point in series.items()]
+        }
+
+    def top_entities(self, entity_type=None, since=None, until=None, limit=20):
+        """Entités les plus citées sur la période, avec le sentiment moyen des documents qui les citent"""
+        since, until = self._window(since, until)
+        # Une entité citée plusieurs fois dans un document n'est comptée qu'une fois
+        rows = self._connection().execute(
+            "SELECT norm, type, MAX(name), COUNT(*), AVG(score) FROM (SELECT e.norm, e.type, MAX(e.name) AS name, "
+            "d.sentiment_score AS score FROM documents d JOIN entities e ON e.doc_key = d.doc_key "
+            "WHERE d.published >= ? AND d.published < ? AND (? IS NULL OR e.type = ?) "
+            "GROUP BY d.doc_key, e.norm, e.type) GROUP BY norm, type ORDER BY COUNT(*) DESC LIMIT ?",
+            (since, until, entity_type, entity_type, max(1, int(limit)))).fetchall()
+        return [{"entity": norm, "type": entity_type, "name": name, "documents": count, "mean_score": mean_score}
+                for norm, entity_type, name, count, mean_score in rows]
+
+    def relations(self, name, label=None, since=None, until=None, limit=50):
+        """Relations d'une entité : triplets extraits par paire d'entités, et entités citées avec elle
+        dans les documents dont la relation a été classée au niveau de la phrase"""
+        since, until = self._window(since, until)
+        norm = normalize_entity(name)
+        db = self._connection()
+        triples = db.execute(
+            "SELECT MAX(t.head), t.head_type, t.label, MAX(t.tail), t.tail_type, COUNT(*), AVG(t.score) "
+            "FROM (SELECT * FROM triples WHERE head_norm = ? UNION ALL "
+            "SELECT * FROM triples WHERE tail_norm = ? AND head_norm != ?) t "
+            "JOIN documents d ON d.doc_key = t.doc_key "
+            "WHERE (? IS NULL OR t.label = ?) AND d.published >= ? AND d.published < ? "
+            "GROUP BY t.head_norm, t.head_type, t.label, t.tail_norm, t.tail_type ORDER BY COUNT(*) DESC LIMIT ?",
+            (norm, norm, norm, label, label, since, until, max(1, int(limit)))).fetchall()
+        co_mentions = db.execute(
+            "SELECT d.relation_label, MAX(o.name), o.type, COUNT(DISTINCT d.doc_key), AVG(d.relation_score) "
+            "FROM (SELECT DISTINCT doc_key FROM entities WHERE norm = ?) e "
+            "JOIN documents d ON d.doc_key = e.doc_key JOIN entities o ON o.doc_key = d.doc_key AND o.norm != ? "
+            "WHERE d.relation_label IS NOT NULL AND (? IS NULL OR d.relation_label = ?) "
+            "AND d.published >= ? AND d.published < ? "
+            "GROUP BY d.relation_label, o.norm, o.type ORDER BY COUNT(DISTINCT d.doc_key) DESC LIMIT ?",
+            (norm, norm, label, label, since, until, max(1, int(limit)))).fetchall()
+        return {
+            "entity": norm,
+            "triples": [{"head": head, "head_type": head_type, "label": label, "tail": tail, "tail_type": tail_type,
+                         "documents": count, "mean_score": mean_score}
+                        for head, head_type, label, tail, tail_type, count, mean_score in triples],
+            "co_mentions": [{"label": label, "entity": other, "type": other_type, "documents": count,
+                             "mean_score": mean_score}
+                            for label, other, other_type, count, mean_score in co_mentions]
+        }
+
+    def get_stats(self):
+        """Renvoie les compteurs d'écriture et le nombre de lignes de chaque table"""
+        stats = dict(self.stats, enabled=self.enabled, pending=self._queue.qsize())
+        if self.db_path is not None:
+            db = self._connection()
+            for table in ("documents", "entities", "triples"):
+                stats[table] = db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return stats
+
+result_store = ResultStore(RESULT_STORE_DB)
+# Écrire les derniers résultats déposés avant l'arrêt du processus
+atexit.register(result_store.flush)
@@ -0,0 +1,63 @@
+"""
+Sérialisation JSON des résultats de prédiction.
+Ce module ne dépend que de NumPy, afin que le serveur web puisse l'importer sans
+charger torch ni transformers. Si orjson est installé, il est utilisé pour encoder
+les réponses (désactivable avec FAST_JSON=0).
+"""
+
+import json
+import os
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FAST_JSON = os.environ.get("FAST_JSON", "1") == "1" and orjson is not None
+
+# Classe pour rendre les objets NumPy sérialisables en JSON
+class NumpyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        return super(NumpyEncoder, self).default(obj)
+
+def convert_to_serializable(obj):
+    """Convertit les types NumPy en types Python standards pour la sérialisation JSON"""
+    if isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return [convert_to_serializable(x) for x in obj]
+    elif isinstance(obj, list):
+        return [convert_to_serializable(x) for x in obj]
+    elif isinstance(obj, dict):
+        return {k: convert_to_serializable(v) for k, v in obj.items()}
+    elif hasattr(obj, 'item') and callable(getattr(obj, 'item')):
+        # Pour les types torch qui ont une méthode item()
+        return obj.item()
+    else:
+        return obj
+
+def _default(obj):
+    # Types non gérés nativement par orjson (ex. scalaires torch)
+    if hasattr(obj, 'item') and callable(getattr(obj, 'item')):
+        return obj.item()
+    raise TypeError(f"Type non sérialisable en JSON: {type(obj).__name__}")
+
+def dumps_bytes(obj):
+    """Encode un objet en JSON (UTF-8) en un seul passage, sans conversion préalable"""
+    if FAST_JSON:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, cls=NumpyEncoder, ensure_ascii=False).encode("utf-8")
+
+def dumps(obj):
+    """Encode un objet en chaîne JSON"""
+    return dumps_bytes(obj).decode("utf-8")
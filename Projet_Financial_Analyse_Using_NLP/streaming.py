@@ -0,0 +1,564 @@
+"""
+Ingestion continue d'un flux de titres financiers.
+Les textes sont lus depuis un fichier JSONL suivi en continu, un dossier dans lequel
+des fichiers sont déposés ou l'entrée standard, puis traversent une chaîne de
+générateurs : lecture → file bornée → batches → analyse complète (sentiment, NER,
+relation) → agrégation. Les agrégats de sentiment par entreprise (CORP), par
+crypto-monnaie (CW) et par date sont tenus à jour sur des fenêtres de temps
+glissantes. Les positions de lecture et les agrégats sont enregistrés dans un point
+de reprise : un redémarrage reprend la lecture sans réanalyser les textes déjà traités.
+
+Usage :
+    python streaming.py --source flux.jsonl --follow
+    python streaming.py --source ./depot --follow --snapshot agregats.json
+    tail -F flux.jsonl | python streaming.py --source -
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from batch_io import _normalize_record
+from result_store import result_store
+from serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Paramètres du pipeline (surchargeables par variables d'environnement)
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 32))
+STREAM_MAX_WAIT_MS = float(os.environ.get("STREAM_MAX_WAIT_MS", 500))
+# Nombre maximal de textes lus en attente d'analyse : la lecture se suspend au-delà
+STREAM_BUFFER_SIZE = int(os.environ.get("STREAM_BUFFER_SIZE", 1024))
+STREAM_POLL_SECONDS = float(os.environ.get("STREAM_POLL_SECONDS", 1.0))
+STREAM_MAX_RETRIES = int(os.environ.get("STREAM_MAX_RETRIES", 3))
+
+# Fenêtres glissantes (secondes), résolution des créneaux et bornes mémoire des agrégats
+STREAM_WINDOWS = tuple(int(n) for n in os.environ.get("STREAM_WINDOWS", "900,3600,86400").split(",") if n)
+STREAM_WINDOW_RESOLUTION = int(os.environ.get("STREAM_WINDOW_RESOLUTION", 60))
+STREAM_MAX_ENTITIES = int(os.environ.get("STREAM_MAX_ENTITIES", 10000))
+STREAM_MAX_DAYS = int(os.environ.get("STREAM_MAX_DAYS", 30))
+STREAM_SNAPSHOT_TOP = int(os.environ.get("STREAM_SNAPSHOT_TOP", 100))
+
+# Point de reprise : fichier et intervalle minimal entre deux écritures
+STREAM_CHECKPOINT_PATH = os.environ.get("STREAM_CHECKPOINT_PATH", "stream_checkpoint.json")
+STREAM_CHECKPOINT_SECONDS = float(os.environ.get("STREAM_CHECKPOINT_SECONDS", 5))
+
+# Extensions des fichiers lus dans un dossier de dépôt
+STREAM_FILE_EXTENSIONS = (".jsonl", ".ndjson", ".txt")
+
+# Types d'entités pour lesquels le sentiment est agrégé
+AGGREGATED_ENTITY_TYPES = ("CORP", "CW")
+
+_END = object()
+
+class ScoringUnavailableError(RuntimeError):
+    """Levée lorsqu'un batch relisible échoue encore après tous les essais : le pipeline s'arrête sans
+    enregistrer la position de ses textes, qui seront réanalysés au redémarrage"""
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+def parse_line(line):
+    """Convertit une ligne lue (objet JSON ou titre brut) en enregistrement horodaté"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return _normalize_record(json.loads(line) if line.startswith("{") else line)
+    except ValueError as e:
+        return {"id": None, "text": "", "instruction": None, "input_ids": None, "timestamp": None,
+                "error": f"Ligne JSON non valide: {str(e)}"}
+
+def _iter_new_lines(path, state):
+    """Lit les lignes complètes ajoutées à un fichier depuis la position enregistrée.
+
+    Produit des couples (ligne, nouvelle position). Une ligne sans retour à la ligne
+    final est en cours d'écriture et sera lue au passage suivant. Un fichier remplacé
+    (autre inode) ou tronqué est relu depuis le début.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return
+    offset = state["offset"] if state else 0
+    if state and (state.get("inode") != stat.st_ino or stat.st_size < offset):
+        logger.info(f"Fichier {path} remplacé ou tronqué, lecture depuis le début")
+        offset = 0
+    if stat.st_size == offset:
+        return
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            yield line.decode("utf-8", errors="replace"), {"offset": offset, "inode": stat.st_ino}
+
+def iter_file_lines(path, positions, follow=False, stop=None):
+    """Lit un fichier depuis sa position enregistrée puis, avec `follow`, les lignes qui y sont ajoutées"""
+    stop = stop or threading.Event()
+    path = os.path.abspath(path)
+    while not stop.is_set():
+        for line, state in _iter_new_lines(path, positions.get(path)):
+            positions[path] = state
+            yield line, (path, state)
+        if not follow:
+            return
+        stop.wait(STREAM_POLL_SECONDS)
+
+def _directory_files(directory):
+    paths = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.lower().endswith(STREAM_FILE_EXTENSIONS):
+            try:
+                paths.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue
+    return [os.path.abspath(path) for _, path in sorted(paths)]
+
+def iter_directory_lines(directory, positions, follow=False, stop=None):
+    """Lit les fichiers d'un dossier par date de modification, puis les fichiers déposés ou complétés ensuite"""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        paths = _directory_files(directory)
+        for path in paths:
+            for line, state in _iter_new_lines(path, positions.get(path)):
+                positions[path] = state
+                yield line, (path, state)
+                if stop.is_set():
+                    return
+        # Oublier les fichiers supprimés du dossier
+        for path in set(positions) - set(paths):
+            del positions[path]
+        if not follow:
+            return
+        stop.wait(STREAM_POLL_SECONDS)
+
+def iter_stdin_lines(stream=None):
+    """Lit l'entrée standard ; sa position n'est pas enregistrée dans le point de reprise"""
+    for line in stream or sys.stdin:
+        yield line, None
+
+def open_source(source, positions, follow=False, stop=None):
+    """Choisit le lecteur adapté : « - » pour l'entrée standard, un dossier ou un fichier"""
+    if source == "-":
+        return iter_stdin_lines()
+    if os.path.isdir(source):
+        return iter_directory_lines(source, positions, follow, stop)
+    if not follow and not os.path.exists(source):
+        raise FileNotFoundError(f"Source introuvable: {source}")
+    return iter_file_lines(source, positions, follow, stop)
+
+def _put(buffer, item, stop):
+    """Place un élément dans la file bornée en attendant qu'une place se libère"""
+    while not stop.is_set():
+        try:
+            buffer.put(item, timeout=STREAM_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def fill_buffer(lines, buffer, stop):
+    """Lit la source dans un thread et remplit la file bornée, puis y place le marqueur de fin"""
+    error = None
+    try:
+        for line, position in lines:
+            record = parse_line(line)
+            if record is not None and not _put(buffer, (record, position), stop):
+                return
+    except Exception as e:
+        logger.error(f"Erreur pendant la lecture de la source: {str(e)}")
+        error = e
+    _put(buffer, (_END, error), stop)
+
+def iter_batches(buffer, batch_size=STREAM_BATCH_SIZE, max_wait_ms=STREAM_MAX_WAIT_MS, stop=None):
+    """Regroupe les enregistrements de la file : au plus `batch_size` textes ou `max_wait_ms` d'attente"""
+    stop = stop or threading.Event()
+    max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+    while not stop.is_set():
+        try:
+            item = buffer.get(timeout=STREAM_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item[0] is _END:
+            end = item
+            batch = []
+        else:
+            end = None
+            batch = [item]
+            deadline = time.monotonic() + max_wait
+            while len(batch) < batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = buffer.get(timeout=remaining) if remaining > 0 else buffer.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] is _END:
+                    end = item
+                    break
+                batch.append(item)
+        if batch:
+            yield batch
+        if end is not None:
+            if end[1] is not None:
+                raise end[1]
+            return
+
+def _predict_with_retries(texts, instructions, model_type, ids=None, force=False):
+    """Prédit un batch en réessayant avec un délai croissant ; renvoie (résultats, erreur).
+
+    Les reprises d'une dépêche déjà analysée reçoivent le sentiment de celle-ci (voir
+    near_duplicates.py), sauf si `force` est vrai ; leurs entités et leur relation sont calculées.
+    """
+    from model_bert_fine_tuned import predict_batch
+
+    for attempt in range(STREAM_MAX_RETRIES + 1):
+        try:
+            return predict_batch(texts, instructions, model_type, ids=ids, near_duplicates=True, force=force), None
+        except Exception as e:
+            if attempt == STREAM_MAX_RETRIES:
+                return None, str(e)
+            delay = 0.5 * 2 ** attempt
+            logger.warning(f"Échec de l'analyse d'un batch de {len(texts)} texte(s), nouvel essai dans {delay:.1f} s: "
+                           f"{str(e)}")
+            time.sleep(delay)
+
+def score_batches(batches, model_type="analyze", force=False):
+    """Analyse chaque batch et produit, dans l'ordre de lecture, les triplets (enregistrement, position, sortie).
+
+    Un batch qui échoue après tous les essais produit une ligne d'erreur par texte s'il n'a pas
+    de position de lecture (entrée standard) ; sinon ScoringUnavailableError est levée.
+    """
+    for batch in batches:
+        outputs = [{"error": record.get("error", "Texte manquant")} for record, _ in batch]
+        valid = [i for i, (record, _) in enumerate(batch) if record["text"] and "error" not in record]
+        if valid:
+            results, error = _predict_with_retries([batch[i][0]["text"] for i in valid],
+                                                   [batch[i][0]["instruction"] for i in valid], model_type,
+                                                   [batch[i][0]["id"] for i in valid], force)
+            if results is None and any(position is not None for _, position in batch):
+                raise ScoringUnavailableError(f"Analyse impossible après {STREAM_MAX_RETRIES} nouvel(s) essai(s): "
+                                              f"{error}")
+            for n, i in enumerate(valid):
+                outputs[i] = {"error": error} if results is None else {"result": results[n]}
+        for (record, position), output in zip(batch, outputs):
+            yield record, position, output
+
+def sentiment_score(sentiment):
+    """Score signé d'un résultat de sentiment : P(positif) - P(négatif), entre -1 et 1"""
+    scores = {p["label"].lower(): p["score"] for p in sentiment.get("predictions", [])}
+    return scores.get("positive", 0.0) - scores.get("negative", 0.0)
+
+def _new_stats():
+    return [0, 0.0, {}]
+
+def _accumulate(stats, score, label):
+    stats[0] += 1
+    stats[1] += score
+    if label is not None:
+        stats[2][label] = stats[2].get(label, 0) + 1
+
+def _merge_stats(total, stats):
+    total[0] += stats[0]
+    total[1] += stats[1]
+    for label, count in stats[2].items():
+        total[2][label] = total[2].get(label, 0) + count
+
+def _format_stats(stats):
+    count, score_sum, labels = stats
+    return {"count": count, "mean_score": score_sum / count if count else None, "labels": dict(labels)}
+
+def _window_label(seconds):
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+class SlidingWindowAggregator:
+    """Sentiment agrégé par entité (CORP, CW) et par date, sur des fenêtres de temps glissantes.
+
+    Le temps de référence est l'horodatage le plus récent reçu, ce qui rend les agrégats
+    identiques que le flux soit lu en direct ou rejoué. Les textes sont regroupés en
+    créneaux de `resolution` secondes : la mémoire par entité est bornée par la plus
+    longue fenêtre, et seules les `max_entities` entités mises à jour le plus récemment
+    sont conservées.
+    """
+
+    def __init__(self, windows=STREAM_WINDOWS, resolution=STREAM_WINDOW_RESOLUTION,
+                 max_entities=STREAM_MAX_ENTITIES, max_days=STREAM_MAX_DAYS,
+                 entity_types=AGGREGATED_ENTITY_TYPES):
+        self.windows = tuple(sorted(int(w) for w in windows))
+        self.resolution = max(1, int(resolution))
+        self.max_entities = max(1, int(max_entities))
+        self.max_days = max(1, int(max_days))
+        self.entity_types = tuple(entity_types)
+        self.watermark = None
+        self.records = 0
+        # (type, nom normalisé) -> [nom affiché, deque de [début du créneau, effectif, somme des scores, labels]]
+        self._entities = OrderedDict()
+        # "AAAA-MM-JJ" -> [effectif, somme des scores, labels]
+        self._dates = {}
+
+    def add(self, result, timestamp):
+        """Intègre le résultat d'analyse complète d'un texte publié à l'instant `timestamp`"""
+        sentiment = result.get("sentiment") or {}
+        score, label = sentiment_score(sentiment), sentiment.get("label")
+        self.records += 1
+        self.watermark = timestamp if self.watermark is None else max(self.watermark, timestamp)
+
+        # Une entité citée plusieurs fois dans un même texte n'est comptée qu'une fois
+        mentioned = {}
+        for entity in (result.get("ner") or {}).get("entities", []):
+            entity_type = entity.get("entity_group")
+            name = " ".join(str(entity.get("word", "")).split())
+            if entity_type in self.entity_types and name:
+                mentioned.setdefault((entity_type, name.lower()), name)
+
+        slot_start = timestamp - timestamp % self.resolution
+        for key, name in mentioned.items():
+            self._add_to_entity(key, name, slot_start, score, label)
+
+        day = datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+        _accumulate(self._dates.setdefault(day, _new_stats()), score, label)
+        if len(self._dates) > self.max_days:
+            for old_day in sorted(self._dates)[:len(self._dates) - self.max_days]:
+                del self._dates[old_day]
+
+    def _add_to_entity(self, key, name, slot_start, score, label):
+        horizon = self.watermark - self.windows[-1]
+        if slot_start + self.resolution <= horizon:
+            return
+        entry = self._entities.get(key)
+        if entry is None:
+            entry = self._entities[key] = [name, deque()]
+            if len(self._entities) > self.max_entities:
+                self._entities.popitem(last=False)
+        else:
+            self._entities.move_to_end(key)
+        slots = entry[1]
+
+        # Les textes arrivent presque toujours dans l'ordre : le créneau est cherché depuis la fin
+        position = len(slots)
+        while position > 0 and slots[position - 1][0] > slot_start:
+            position -= 1
+        if position > 0 and slots[position - 1][0] == slot_start:
+            slot = slots[position - 1]
+        else:
+            slot = [slot_start, 0, 0.0, {}]
+            slots.insert(position, slot)
+        slot[1] += 1
+        slot[2] += score
+        if label is not None:
+            slot[3][label] = slot[3].get(label, 0) + 1
+
+        while slots and slots[0][0] + self.resolution <= horizon:
+            slots.popleft()
+
+    def _window_stats(self, slots):
+        stats = {window: _new_stats() for window in self.windows}
+        for slot_start, count, score_sum, labels in slots:
+            age = self.watermark - slot_start
+            for window in self.windows:
+                if age < window + self.resolution:
+                    _merge_stats(stats[window], [count, score_sum, labels])
+        return stats
+
+    def snapshot(self, top=STREAM_SNAPSHOT_TOP):
+        """Renvoie les agrégats courants ; les entités sont triées par nombre de mentions sur la plus longue fenêtre"""
+        entities = {entity_type: [] for entity_type in self.entity_types}
+        if self.watermark is not None:
+            for (entity_type, _), (name, slots) in self._entities.items():
+                stats = self._window_stats(slots)
+                if stats[self.windows[-1]][0]:
+                    entities[entity_type].append((name, stats))
+        for entity_type, items in entities.items():
+            items.sort(key=lambda item: item[1][self.windows[-1]][0], reverse=True)
+            entities[entity_type] = [
+                {"name": name, "windows": {_window_label(w): _format_stats(s) for w, s in stats.items()}}
+                for name, stats in items[:top]
+            ]
+        return {
+            "watermark": _isoformat(self.watermark) if self.watermark is not None else None,
+            "records": self.records,
+            "windows": [_window_label(window) for window in self.windows],
+            "entities": entities,
+            "dates": {day: _format_stats(stats) for day, stats in sorted(self._dates.items())}
+        }
+
+    def state(self):
+        """État complet, enregistré dans le point de reprise"""
+        return {
+            "watermark": self.watermark,
+            "records": self.records,
+            "entities": [[entity_type, key, name, list(slots)]
+                         for (entity_type, key), (name, slots) in self._entities.items()],
+            "dates": self._dates
+        }
+
+    def restore(self, state):
+        """Restaure l'état enregistré par `state()`"""
+        self.watermark = state.get("watermark")
+        self.records = state.get("records", 0)
+        self._entities = OrderedDict(((entity_type, key), [name, deque(slots)])
+                                     for entity_type, key, name, slots in state.get("entities", []))
+        self._dates = dict(state.get("dates", {}))
+
+def _write_json_atomic(path, payload):
+    """Écrit un fichier JSON via un fichier temporaire renommé, pour ne jamais laisser de fichier partiel"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        f.write(dumps(payload))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+class Checkpoint:
+    """Point de reprise : positions de lecture des textes déjà analysés et état des agrégats"""
+
+    def __init__(self, path=STREAM_CHECKPOINT_PATH, interval=STREAM_CHECKPOINT_SECONDS):
+        self.path = path
+        self.interval = max(0.0, float(interval))
+        self._last_save = time.monotonic()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return {"positions": {}, "aggregates": None}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+            logger.info(f"Reprise depuis le point de reprise {self.path} ({len(state.get('positions', {}))} fichier(s))")
+            return {"positions": state.get("positions", {}), "aggregates": state.get("aggregates")}
+        except (OSError, ValueError) as e:
+            logger.error(f"Point de reprise {self.path} illisible, lecture depuis le début: {str(e)}")
+            return {"positions": {}, "aggregates": None}
+
+    def due(self):
+        return time.monotonic() - self._last_save >= self.interval
+
+    def save(self, positions, aggregator):
+        self._last_save = time.monotonic()
+        if not self.path:
+            return
+        positions = {path: state for path, state in positions.items() if os.path.exists(path)}
+        _write_json_atomic(self.path, {"positions": positions, "aggregates": aggregator.state(),
+                                       "saved_at": _isoformat(time.time())})
+
+def run_pipeline(source, follow=False, checkpoint=None, output=None, snapshot_path=None,
+                 batch_size=STREAM_BATCH_SIZE, max_wait_ms=STREAM_MAX_WAIT_MS, aggregator=None, stop=None,
+                 force=False):
+    """Lit la source, analyse les textes par batches et tient les agrégats à jour jusqu'à la fin de la source.
+
+    `output` reçoit une ligne NDJSON par texte. Les résultats et le point de reprise sont
+    écrits dans cet ordre : après un arrêt brutal, les textes lus depuis le dernier point
+    de reprise sont réanalysés, mais jamais comptés deux fois dans les agrégats. Avec
+    `force`, les quasi-doublons de textes déjà analysés sont eux aussi analysés. Si les
+    modèles restent indisponibles, ScoringUnavailableError est levée après l'enregistrement
+    des positions des textes déjà analysés.
+    """
+    checkpoint = checkpoint or Checkpoint(None)
+    aggregator = aggregator or SlidingWindowAggregator()
+    stop = stop or threading.Event()
+
+    state = checkpoint.load()
+    if state["aggregates"]:
+        aggregator.restore(state["aggregates"])
+    committed = dict(state["positions"])
+    buffer = queue.Queue(maxsize=max(1, STREAM_BUFFER_SIZE))
+    lines = open_source(source, dict(committed), follow, stop)
+    threading.Thread(target=fill_buffer, args=(lines, buffer, stop), name="stream-reader", daemon=True).start()
+
+    def save():
+        if output is not None:
+            output.flush()
+        checkpoint.save(committed, aggregator)
+        if snapshot_path:
+            _write_json_atomic(snapshot_path, aggregator.snapshot())
+
+    processed = 0
+    try:
+        for record, position, result in score_batches(iter_batches(buffer, batch_size, max_wait_ms, stop),
+                                                         force=force):
+            timestamp = record["timestamp"] if record["timestamp"] is not None else time.time()
+            if "result" in result:
+                aggregator.add(result["result"], timestamp)
+                result_store.record("analyze", record["text"], result["result"], record["id"], timestamp)
+            if output is not None:
+                line = {"id": record["id"], "timestamp": _isoformat(timestamp)}
+                line.update(result)
+                output.write(dumps(line) + "\n")
+            if position is not None:
+                committed[position[0]] = position[1]
+            processed += 1
+            if checkpoint.due():
+                save()
+    finally:
+        stop.set()
+        save()
+        logger.info(f"Pipeline arrêté après {processed} texte(s) analysé(s)")
+    return aggregator
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Analyse continue d'un flux de titres financiers")
+    parser.add_argument("--source", required=True,
+                        help="Fichier JSONL à suivre, dossier de dépôt, ou « - » pour l'entrée standard")
+    parser.add_argument("--follow", action="store_true",
+                        help="Continuer à lire les lignes et fichiers ajoutés au lieu de s'arrêter à la fin")
+    parser.add_argument("--checkpoint", default=None,
+                        help=f"Fichier du point de reprise (défaut: {STREAM_CHECKPOINT_PATH}, sauf pour l'entrée "
+                             f"standard ; chaîne vide pour le désactiver)")
+    parser.add_argument("--output", default="-",
+                        help="Fichier NDJSON des résultats (« - » : sortie standard, chaîne vide : aucun)")
+    parser.add_argument("--snapshot", default=None, help="Fichier JSON des agrégats, réécrit à chaque point de reprise")
+    parser.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=STREAM_MAX_WAIT_MS)
+    parser.add_argument("--windows", type=int, nargs="+", default=list(STREAM_WINDOWS),
+                        help="Durées des fenêtres glissantes en secondes")
+    parser.add_argument("--force-rescore", action="store_true",
+                        help="Analyser aussi les reprises quasi identiques d'une dépêche déjà analysée")
+    args = parser.parse_args()
+
+    # L'entrée standard n'a pas de position : une ligne relue après un redémarrage (tail -F) serait
+    # comptée une seconde fois dans les agrégats restaurés, sauf point de reprise demandé explicitement
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None:
+        checkpoint_path = "" if args.source == "-" else STREAM_CHECKPOINT_PATH
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    output = None
+    if args.output == "-":
+        output = sys.stdout
+    elif args.output:
+        output = open(args.output, "a", encoding="utf-8")
+    try:
+        aggregator = run_pipeline(args.source, args.follow, Checkpoint(checkpoint_path), output, args.snapshot,
+                                  args.batch_size, args.max_wait_ms, SlidingWindowAggregator(args.windows), stop,
+                                  args.force_rescore)
+    except ScoringUnavailableError as e:
+        logger.error(f"Pipeline arrêté, les textes non analysés seront repris au redémarrage: {str(e)}")
+        return 1
+    finally:
+        if output is not None and output is not sys.stdout:
+            output.close()
+    if args.snapshot is None:
+        print(json.dumps(aggregator.snapshot(), indent=2, ensure_ascii=False), file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
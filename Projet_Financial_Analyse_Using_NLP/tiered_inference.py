@@ -0,0 +1,393 @@
+"""
+Inférence du sentiment à deux niveaux : un modèle élève distillé répond d'abord, le
+modèle complet ne traite que les textes sur lesquels l'élève hésite.
+L'élève est un BERT de quelques couches initialisé à partir de couches du modèle
+complet (plongements, couches régulièrement espacées, pooler et tête), puis entraîné à
+reproduire ses probabilités. Il partage le tokenizer du modèle complet : les textes ne
+sont tokenisés qu'une fois pour les deux niveaux. Une fraction des textes tranchés par
+l'élève est aussi soumise au modèle complet pour mesurer leur taux d'accord.
+
+Usage :
+    python tiered_inference.py distill --predictions scores/ --output ./student_models/sentiment
+    python tiered_inference.py distill --texts titres.jsonl --layers 4 --epochs 3
+    python tiered_inference.py evaluate --texts echantillon.jsonl
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+import metrics
+import model_bert_fine_tuned as models
+
+logger = logging.getLogger(__name__)
+
+# Probabilité minimale de la classe prédite par l'élève pour qu'il réponde seul
+TIERED_CONFIDENCE_THRESHOLD = float(os.environ.get("TIERED_CONFIDENCE_THRESHOLD", 0.9))
+# Fraction des textes tranchés par l'élève également soumis au modèle complet pour mesurer l'accord
+TIERED_AUDIT_RATE = float(os.environ.get("TIERED_AUDIT_RATE", 0.05))
+STUDENT_MODEL_DIR = os.environ.get("STUDENT_MODEL_DIR", "./student_models/sentiment")
+# Délai avant de rechercher de nouveau un élève absent ou incompatible (ex. distillé après le démarrage)
+TIERED_STUDENT_RETRY_SECONDS = float(os.environ.get("TIERED_STUDENT_RETRY_SECONDS", 300))
+
+# Paramètres par défaut de la distillation
+STUDENT_LAYERS = int(os.environ.get("STUDENT_LAYERS", 4))
+DISTILL_TEMPERATURE = 2.0
+DISTILL_HOLDOUT = 0.1
+DISTILL_MAX_LENGTH = 128
+CALIBRATION_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99)
+DISTILLATION_FILE = "distillation.json"
+
+_STUDENT_KEY = "sentiment_student"
+
+def student_revision():
+    """Suffixe de révision du sentiment (clé du cache) lorsque l'élève répond à la place du modèle complet"""
+    return f"-tiered{TIERED_CONFIDENCE_THRESHOLD}@{models.checkpoint_digest(STUDENT_MODEL_DIR)}"
+
+class TierStats:
+    """Compteurs des textes servis par chaque niveau et de l'accord entre l'élève et le modèle complet"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.served = {"student": 0, "full": 0}
+            self.audited = 0
+            self.agreed = 0
+
+    def record(self, student, full, audited, agreed):
+        with self._lock:
+            self.served["student"] += student
+            self.served["full"] += full
+            self.audited += audited
+            self.agreed += agreed
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.served.values())
+            return {
+                "enabled": models.TIERED_SENTIMENT,
+                "threshold": TIERED_CONFIDENCE_THRESHOLD,
+                "audit_rate": TIERED_AUDIT_RATE,
+                "served": dict(self.served),
+                "fraction": {tier: count / total if total else 0.0 for tier, count in self.served.items()},
+                "audited": self.audited,
+                # Accord mesuré sur les textes tranchés par l'élève puis soumis au modèle complet
+                "agreement_rate": self.agreed / self.audited if self.audited else None
+            }
+
+stats = TierStats()
+_random = random.Random()
+# Échéance (horloge time.monotonic) avant laquelle l'élève absent ou incompatible n'est pas recherché à nouveau
+_student_retry_at = 0.0
+
+def _load_student():
+    from transformers import AutoModelForSequenceClassification
+
+    logger.info(f"Chargement du modèle élève de sentiment depuis {STUDENT_MODEL_DIR}")
+    with open(os.path.join(STUDENT_MODEL_DIR, DISTILLATION_FILE)) as f:
+        distillation = json.load(f)
+    student = AutoModelForSequenceClassification.from_pretrained(STUDENT_MODEL_DIR)
+    # Empreinte du tokenizer du modèle complet au moment de la distillation, conservée avec le modèle
+    student.distilled_tokenizer = distillation.get("tokenizer")
+    student.validated_for = None
+    return student
+
+def _student_unavailable(message):
+    global _student_retry_at
+    logger.warning(f"{message}, le modèle complet traite tous les textes "
+                   f"(nouvel essai dans {TIERED_STUDENT_RETRY_SECONDS:.0f} s)")
+    _student_retry_at = time.monotonic() + TIERED_STUDENT_RETRY_SECONDS
+    return None
+
+def get_student(teacher_config, tokenizer):
+    """Renvoie le modèle élève, ou None s'il est absent ou incompatible avec le modèle complet.
+
+    L'élève est chargé et validé une fois, avec son entrée du registre des modèles. S'il est
+    absent ou incompatible, il est recherché de nouveau après TIERED_STUDENT_RETRY_SECONDS.
+    """
+    if time.monotonic() < _student_retry_at:
+        return None
+    try:
+        student = models.session.model(_STUDENT_KEY, _load_student)
+    except (OSError, ValueError) as e:
+        return _student_unavailable(f"Modèle élève indisponible: {str(e)}")
+    fingerprint = models.tokenizer_fingerprint(tokenizer)
+    if student.validated_for != fingerprint:
+        if student.distilled_tokenizer != fingerprint or student.config.id2label != teacher_config.id2label:
+            # Retiré du registre : un élève distillé de nouveau sera chargé au prochain essai
+            models.model_cache.pop(_STUDENT_KEY, None)
+            return _student_unavailable(f"Le modèle élève {STUDENT_MODEL_DIR} n'a pas été distillé depuis le "
+                                        "modèle de sentiment actuel (vocabulaire ou labels différents)")
+        student.validated_for = fingerprint
+    return student
+
+def _subset(encodings, indices):
+    return {key: [values[i] for i in indices] for key, values in encodings.items()}
+
+def classify(encodings, tokenizer, teacher_config, batch_size, full_classify):
+    """Probabilités de sentiment d'un batch : l'élève d'abord, le modèle complet pour les textes incertains.
+
+    `full_classify(encodings)` exécute le modèle complet sur un sous-ensemble des encodages.
+    """
+    student = get_student(teacher_config, tokenizer)
+    if student is None:
+        probabilities = full_classify(encodings)
+        stats.record(0, len(probabilities), 0, 0)
+        return probabilities
+
+    with models.model_cache.lease(_STUDENT_KEY), metrics.span("student"):
+        probabilities = models._classify_batches(student, tokenizer, encodings, batch_size)
+    confident = probabilities.max(axis=1) >= TIERED_CONFIDENCE_THRESHOLD
+    uncertain = np.flatnonzero(~confident).tolist()
+    audited = [i for i in np.flatnonzero(confident).tolist() if _random.random() < TIERED_AUDIT_RATE]
+    escalated = sorted(uncertain + audited)
+
+    agreed = 0
+    if escalated:
+        full = full_classify(_subset(encodings, escalated))
+        rows = {i: row for row, i in enumerate(escalated)}
+        for i in audited:
+            agreed += int(full[rows[i]].argmax() == probabilities[i].argmax())
+        # Les textes audités gardent la réponse de l'élève : l'audit mesure l'accord sans changer le résultat
+        if uncertain:
+            probabilities[uncertain] = full[[rows[i] for i in uncertain]]
+    stats.record(len(probabilities) - len(uncertain), len(uncertain), len(audited), agreed)
+    logger.debug("Sentiment à deux niveaux: %d texte(s) tranché(s) par l'élève, %d par le modèle complet",
+                 len(probabilities) - len(uncertain), len(uncertain))
+    return probabilities
+
+def _tier_counts():
+    snapshot = stats.snapshot()
+    for tier, count in snapshot["served"].items():
+        yield {"tier": tier}, count
+
+def _agreement_rate():
+    rate = stats.snapshot()["agreement_rate"]
+    if rate is not None:
+        yield {}, rate
+
+metrics.register_gauge("inference_tier_texts", "Textes de sentiment servis par chaque niveau", _tier_counts)
+metrics.register_gauge("inference_tier_agreement_rate",
+                       "Taux d'accord entre l'élève et le modèle complet sur les textes audités", _agreement_rate)
+
+def build_student(teacher, num_layers):
+    """Crée un BERT de `num_layers` couches initialisé à partir des couches régulièrement espacées du modèle complet"""
+    from transformers import AutoModelForSequenceClassification
+
+    teacher_layers = teacher.config.num_hidden_layers
+    num_layers = max(1, min(num_layers, teacher_layers))
+    config = copy.deepcopy(teacher.config)
+    config.num_hidden_layers = num_layers
+    student = AutoModelForSequenceClassification.from_config(config)
+
+    # Couche i de l'élève ← couche kept[i] du modèle complet, la dernière couche étant toujours conservée
+    kept = [round((i + 1) * teacher_layers / num_layers) - 1 for i in range(num_layers)]
+    mapping = {teacher_index: student_index for student_index, teacher_index in enumerate(kept)}
+    state = {}
+    for key, value in teacher.state_dict().items():
+        match = re.search(r"\.layer\.(\d+)\.", key)
+        if match is None:
+            state[key] = value
+        elif int(match.group(1)) in mapping:
+            state[key.replace(match.group(0), f".layer.{mapping[int(match.group(1))]}.", 1)] = value
+    student.load_state_dict(state)
+    logger.info(f"Élève de {num_layers} couche(s) initialisé depuis les couches {kept} du modèle complet")
+    return student
+
+def _encode(tokenizer, texts, max_length=DISTILL_MAX_LENGTH):
+    text_ids = models._text_token_ids(tokenizer, texts)
+    return {"input_ids": [models._join_token_ids(tokenizer, ids, max_length=max_length) for ids in text_ids]}
+
+def load_predictions(path, labels, inputs=None):
+    """Lit des prédictions de sentiment existantes : textes et probabilités dans l'ordre de `labels`.
+
+    Accepte un dossier ou un fichier Parquet écrit par bulk_score.py (avec --keep-text), ou un
+    fichier JSONL de résultats : lignes NDJSON de /api/predict/batch ou de streaming.py
+    (`result`), ou résultats bruts (`predictions` ou `sentiment.predictions`). Un résultat de
+    sentiment ne contenant pas son texte, celui-ci est pris dans le fichier d'entrée `inputs`
+    (.jsonl ou .csv envoyé à l'API), par identifiant ou à défaut par position.
+    """
+    texts, targets = [], []
+    if os.path.isdir(path) or path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=["text", "sentiment_probabilities"])
+        stored_labels = json.loads(table.schema.metadata[b"sentiment_labels"])
+        order = [stored_labels.index(label) for label in labels]
+        for text, row in zip(table.column("text").to_pylist(), table.column("sentiment_probabilities").to_pylist()):
+            if text and row is not None:
+                texts.append(text)
+                targets.append([row[i] for i in order])
+    else:
+        input_texts, input_ids = [], {}
+        if inputs:
+            from batch_io import iter_records
+
+            with open(inputs, "rb") as f:
+                for record in iter_records(f, os.path.basename(inputs)):
+                    input_texts.append(record["text"])
+                    if record["id"] is not None:
+                        input_ids[str(record["id"])] = record["text"]
+        with open(path, encoding="utf-8") as f:
+            for position, line in enumerate(line for line in f if line.strip()):
+                record = json.loads(line)
+                result = record.get("result", record)
+                if not isinstance(result, dict):
+                    continue
+                sentiment = result.get("sentiment", result)
+                text = record.get("text") or result.get("text")
+                if not text and record.get("id") is not None:
+                    text = input_ids.get(str(record["id"]))
+                if not text:
+                    index = record.get("index", position)
+                    text = input_texts[index] if isinstance(index, int) and index < len(input_texts) else None
+                if not text or "predictions" not in sentiment:
+                    continue
+                scores = {p["label"]: p["score"] for p in sentiment["predictions"]}
+                texts.append(text)
+                targets.append([scores[label] for label in labels])
+    if not texts:
+        raise ValueError(f"Aucune prédiction de sentiment avec son texte dans {path}"
+                         + ("" if inputs else " : indiquez le fichier envoyé à l'API avec --texts"))
+    return texts, np.asarray(targets, dtype=np.float32)
+
+def calibration(student_probabilities, teacher_probabilities, thresholds=CALIBRATION_THRESHOLDS):
+    """Fraction tranchée par l'élève et accord avec le modèle complet pour chaque seuil de confiance"""
+    confidence = student_probabilities.max(axis=1)
+    agree = student_probabilities.argmax(axis=1) == teacher_probabilities.argmax(axis=1)
+    report = []
+    for threshold in thresholds:
+        served = confidence >= threshold
+        report.append({
+            "threshold": threshold,
+            "student_fraction": float(served.mean()) if len(served) else 0.0,
+            "agreement_rate": float(agree[served].mean()) if served.any() else None,
+            # Accord du résultat final : réponse de l'élève si confiant, du modèle complet sinon
+            "overall_agreement": float((agree | ~served).mean()) if len(served) else None
+        })
+    return report
+
+def distill(texts, teacher_probabilities, teacher, tokenizer, output_dir=STUDENT_MODEL_DIR, num_layers=STUDENT_LAYERS,
+            epochs=3, batch_size=32, learning_rate=5e-5, temperature=DISTILL_TEMPERATURE, seed=0):
+    """Entraîne l'élève à reproduire les probabilités du modèle complet et l'enregistre dans `output_dir`"""
+    torch.manual_seed(seed)
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(texts))
+    holdout_size = int(len(texts) * DISTILL_HOLDOUT) if len(texts) >= 10 else 0
+    holdout, train = order[:holdout_size].tolist(), order[holdout_size:].tolist()
+
+    student = build_student(teacher, num_layers)
+    encodings = _encode(tokenizer, texts)
+    targets = torch.from_numpy(teacher_probabilities)
+    optimizer = torch.optim.AdamW(student.parameters(), lr=learning_rate)
+    pad_token_id = tokenizer.pad_token_id or 0
+    for epoch in range(epochs):
+        student.train()
+        start, total_loss = time.perf_counter(), 0.0
+        train = rng.permutation(train).tolist()
+        for begin in range(0, len(train), batch_size):
+            indices = train[begin:begin + batch_size]
+            inputs = models._pad_encodings(encodings, indices, pad_token_id)
+            logits = student(**inputs).logits
+            # Divergence de Kullback-Leibler entre les distributions adoucies par la température
+            soft_targets = torch.softmax(torch.log(targets[indices].clamp_min(1e-8)) / temperature, dim=-1)
+            loss = torch.nn.functional.kl_div(torch.log_softmax(logits / temperature, dim=-1), soft_targets,
+                                              reduction="batchmean") * temperature ** 2
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.item() * len(indices)
+        logger.info(f"Époque {epoch + 1}/{epochs}: perte {total_loss / max(1, len(train)):.4f} "
+                    f"en {time.perf_counter() - start:.1f} s")
+    student.eval()
+
+    evaluation = holdout or train
+    student_probabilities = models._classify_batches(student, tokenizer, _subset(encodings, evaluation), batch_size)
+    report = {
+        "teacher": models.sentiment_model_name,
+        "tokenizer": models.tokenizer_fingerprint(tokenizer),
+        "layers": student.config.num_hidden_layers,
+        "samples": len(texts),
+        "holdout": len(holdout),
+        "calibration": calibration(student_probabilities, teacher_probabilities[evaluation])
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    student.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, DISTILLATION_FILE), "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Modèle élève enregistré dans {output_dir}")
+    return report
+
+def _teacher():
+    """Modèle de sentiment complet en PyTorch, chargé sans passer par model_cache"""
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    return (AutoModelForSequenceClassification.from_pretrained(models.sentiment_model_name).eval(),
+            AutoTokenizer.from_pretrained(models.sentiment_model_name))
+
+def _read_texts(path):
+    from batch_io import iter_records
+
+    with open(path, "rb") as f:
+        return [record["text"] for record in iter_records(f, os.path.basename(path)) if record.get("text")]
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Distillation et évaluation du modèle élève de sentiment")
+    parser.add_argument("command", choices=["distill", "evaluate"])
+    parser.add_argument("--predictions", default=None,
+                        help="Prédictions existantes : sortie de bulk_score.py (--keep-text) ou JSONL de résultats")
+    parser.add_argument("--texts", default=None,
+                        help="Fichier .jsonl ou .csv de textes, analysés par le modèle complet ; avec --predictions, "
+                             "fichier envoyé à l'API dont les résultats ne contiennent pas les textes")
+    parser.add_argument("--output", default=STUDENT_MODEL_DIR)
+    parser.add_argument("--layers", type=int, default=STUDENT_LAYERS)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--learning-rate", type=float, default=5e-5)
+    args = parser.parse_args()
+    if not args.predictions and not args.texts:
+        parser.error("--predictions ou --texts est requis")
+
+    teacher, tokenizer = _teacher()
+    labels = [teacher.config.id2label[i] for i in range(teacher.config.num_labels)]
+    if args.predictions:
+        try:
+            texts, teacher_probabilities = load_predictions(args.predictions, labels, args.texts)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        texts = _read_texts(args.texts)
+        teacher_probabilities = models._classify_batches(teacher, tokenizer, _encode(tokenizer, texts), args.batch_size)
+    logger.info(f"{len(texts)} texte(s) avec les probabilités du modèle complet")
+
+    if args.command == "distill":
+        report = distill(texts, teacher_probabilities, teacher, tokenizer, args.output, args.layers, args.epochs,
+                         args.batch_size, args.learning_rate)
+    else:
+        from transformers import AutoModelForSequenceClassification
+
+        student = AutoModelForSequenceClassification.from_pretrained(args.output).eval()
+        student_probabilities = models._classify_batches(student, tokenizer, _encode(tokenizer, texts), args.batch_size)
+        report = {"samples": len(texts), "calibration": calibration(student_probabilities, teacher_probabilities)}
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+Processus d'inférence multiples pour exploiter tous les cœurs.
+Les modèles sont chargés une seule fois dans le processus principal, leurs poids
+sont placés en mémoire partagée, puis N processus sont créés par fork : chacun lit
+les mêmes poids sans les copier, est épinglé sur son propre ensemble de cœurs et
+utilise un nombre de threads torch adapté. Un répartiteur envoie chaque requête au
+processus le moins chargé parmi ceux qui servent le type de modèle demandé, en
+regroupant les requêtes concurrentes en micro-batches.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future
+
+import model_bert_fine_tuned as models
+import readiness
+
+logger = logging.getLogger(__name__)
+
+# Paramètres du pool (surchargeables par variables d'environnement)
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 0))
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 0))
+# Types de modèles servis par chaque processus, séparés par « ; » (ex. « sentiment,ner;relation »)
+WORKER_MODEL_TYPES = os.environ.get("WORKER_MODEL_TYPES", "")
+
+# Délai d'attente des réponses avant de vérifier que le processus est toujours en vie
+_RESPONSE_POLL_SECONDS = 1.0
+
+class WorkerCrashedError(RuntimeError):
+    """Levée lorsqu'un processus d'inférence s'arrête pendant le traitement d'un batch"""
+
+# Modèles exécutés par chaque type de prédiction (la relation s'appuie sur les entités de la NER)
+_REQUIRED_MODELS = {
+    "sentiment": ("sentiment",),
+    "ner": ("ner",),
+    "relation": ("ner", "relation"),
+    "relation_pairs": ("ner", "relation"),
+    "analyze": ("sentiment", "ner", "relation")
+}
+
+def _share_model_weights(model_types):
+    """Charge dans le processus principal les modèles servis et place leurs poids en mémoire partagée"""
+    required = {name for model_type in model_types for name in _REQUIRED_MODELS[model_type]}
+    loaders = {
+        "sentiment": lambda: models.get_sentiment_pipeline().model,
+        "ner": lambda: models.get_ner_pipeline().model,
+        "relation": lambda: models.load_model_bert_base_uncased(models.model_relation_extraction_path,
+                                                                num_labels=29)[0]
+    }
+    modules = [loader() for name, loader in loaders.items() if name in required]
+    for module in modules:
+        module.eval()
+        module.requires_grad_(False)
+        try:
+            module.share_memory()
+        except Exception as e:
+            # Les poids quantifiés empaquetés ne peuvent pas toujours être déplacés ; le fork
+            # les partage tout de même en copie sur écriture
+            logger.warning(f"Impossible de placer les poids en mémoire partagée: {str(e)}")
+
+def _core_sets(num_workers):
+    """Répartit les cœurs disponibles en ensembles contigus, un par processus"""
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    size = max(1, len(cores) // num_workers)
+    return [cores[i * size:(i + 1) * size] or cores for i in range(num_workers)]
+
+def _warmup_model_types(model_types):
+    """Types de modèles à préchauffer : l'analyse complète exécute déjà le sentiment, la NER et la relation"""
+    if "analyze" not in model_types:
+        return list(model_types)
+    return [t for t in model_types if t not in ("sentiment", "ner", "relation")]
+
+def _worker_main(index, cores, threads, model_types, requests, responses):
+    """Boucle d'un processus d'inférence : exécute les batches reçus et renvoie les résultats"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Un seul créneau d'exécution : le processus traite ses batches un par un, avec tous ses cœurs
+    models.session.configure(slots=1, threads=threads)
+
+    # Les micro-batchers du processus parent n'ont pas de thread dans ce processus
+    for key in [key for key in models.model_cache if key.startswith("batcher_")]:
+        del models.model_cache[key]
+
+    # Seuls les modèles servis par ce processus sont chargés et préchauffés
+    try:
+        for model_type in _warmup_model_types(model_types):
+            for tokens in readiness.WARMUP_LENGTHS:
+                models._predict_batch_uncached([readiness._warmup_text(tokens)] * readiness.WARMUP_BATCH_SIZE,
+                                               None, model_type, None)
+    except Exception as e:
+        logger.error(f"Erreur lors du préchauffage du processus d'inférence {index}: {str(e)}")
+    responses.put((None, True, index))
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, model_type, texts, instructions, token_ids, sentiments = message
+        try:
+            responses.put((request_id, True, models._predict_batch_uncached(texts, instructions, model_type, None,
+                                                                            token_ids, sentiments)))
+        except Exception as e:
+            responses.put((request_id, False, f"{type(e).__name__}: {str(e)}"))
+
+class _Worker:
+    """Côté parent d'un processus d'inférence : envoi des batches et réception des résultats"""
+
+    def __init__(self, index, cores, threads, model_types, context, on_ready):
+        self.index = index
+        self.model_types = model_types
+        self.ready = False
+        self.in_flight = 0
+        self._requests = context.Queue()
+        self._responses = context.Queue()
+        self._process = context.Process(target=_worker_main, name=f"inference-worker-{index}", daemon=True,
+                                        args=(index, cores, threads, tuple(model_types), self._requests,
+                                              self._responses))
+        self._futures = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._on_ready = on_ready
+        self.batchers = {
+            model_type: models.MicroBatcher(f"{model_type}-{index}", self._batch_function(model_type),
+                                            **models.BATCHING_CONFIG[model_type])
+            for model_type in model_types
+        }
+
+    def start_process(self):
+        self._process.start()
+
+    def start_reader(self):
+        threading.Thread(target=self._read_responses, name=f"worker-reader-{self.index}", daemon=True).start()
+
+    def depth(self, model_type):
+        """Nombre de textes en attente ou en cours de traitement pour ce processus"""
+        return self.batchers[model_type].qsize() + self.in_flight
+
+    @property
+    def alive(self):
+        return self._process.is_alive()
+
+    def run_batch(self, model_type, texts, instructions=None, token_ids=None, sentiments=None):
+        if not self.alive:
+            raise WorkerCrashedError(f"Processus d'inférence {self.index} arrêté (code {self._process.exitcode})")
+        future = Future()
+        with self._lock:
+            request_id = next(self._ids)
+            self._futures[request_id] = future
+            self.in_flight += len(texts)
+        try:
+            self._requests.put((request_id, model_type, list(texts), instructions, token_ids, sentiments))
+            return models.await_result(future)
+        finally:
+            with self._lock:
+                self.in_flight -= len(texts)
+
+    def _batch_function(self, model_type):
+        return lambda payloads: self.run_batch(model_type, [p[0] for p in payloads], [p[1] for p in payloads])
+
+    def _read_responses(self):
+        while True:
+            try:
+                request_id, ok, value = self._responses.get(timeout=_RESPONSE_POLL_SECONDS)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self._fail_all(WorkerCrashedError(f"Processus d'inférence {self.index} arrêté "
+                                                      f"(code {self._process.exitcode})"))
+                    return
+                continue
+            if request_id is None:
+                self.ready = True
+                self._on_ready()
+                continue
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            # Requête abandonnée par son appelant pendant le traitement
+            if future is None or future.cancelled():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def _fail_all(self, error):
+        with self._lock:
+            futures, self._futures = list(self._futures.values()), {}
+        for future in futures:
+            if not future.cancelled():
+                future.set_exception(error)
+
+    def stop(self):
+        self._requests.put(None)
+        self._process.join(timeout=5)
+
+class WorkerPool:
+    """Ensemble de processus d'inférence et répartiteur de requêtes"""
+
+    def __init__(self, num_workers, threads_per_worker=0, worker_model_types=None):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.worker_model_types = worker_model_types or [models.MODEL_TYPES] * num_workers
+        self.workers = []
+
+    def start(self):
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+        # fork : les processus héritent des poids déjà chargés au lieu de les recharger. Un fork
+        # copie les verrous tenus par les autres threads sans ces threads : tous les processus
+        # sont donc créés avant le démarrage des threads de lecture et du thread de déchargement
+        context = multiprocessing.get_context("fork")
+        readiness.track_models()
+        for model_type in models.MODEL_TYPES:
+            readiness.set_state(model_type, "warming")
+        with models.model_cache.sweeper_deferred():
+            _share_model_weights({t for model_types in self.worker_model_types for t in model_types})
+            others = [thread.name for thread in threading.enumerate() if thread is not threading.current_thread()]
+            if others:
+                logger.warning(f"Création des processus d'inférence alors que d'autres threads sont actifs: "
+                               f"{', '.join(others)}")
+            for index, cores in enumerate(_core_sets(self.num_workers)):
+                threads = self.threads_per_worker or len(cores)
+                model_types = self.worker_model_types[index % len(self.worker_model_types)]
+                worker = _Worker(index, cores, threads, model_types, context, self._on_worker_ready)
+                worker.start_process()
+                self.workers.append(worker)
+                logger.info(f"Processus d'inférence {index} démarré: cœurs={cores}, threads={threads}, "
+                            f"modèles={','.join(model_types)}")
+        for worker in self.workers:
+            worker.start_reader()
+        return self
+
+    def _on_worker_ready(self):
+        if all(worker.ready for worker in self.workers):
+            for model_type in models.MODEL_TYPES:
+                readiness.set_state(model_type, "ready")
+            logger.info(f"{len(self.workers)} processus d'inférence prêts")
+
+    def _pick(self, model_type):
+        """Choisit le processus le moins chargé parmi ceux qui servent ce type de modèle"""
+        candidates = [worker for worker in self.workers if model_type in worker.model_types and worker.alive]
+        if not candidates:
+            raise ValueError(f"Aucun processus d'inférence ne sert le type de modèle {model_type}")
+        return min(candidates, key=lambda worker: worker.depth(model_type))
+
+    def submit(self, model_type, text, instruction=None):
+        """Envoie une requête au micro-batcher du processus le moins chargé"""
+        return self._pick(model_type).batchers[model_type].submit(text, instruction)
+
+    def run_batch(self, model_type, texts, instructions=None, token_ids=None, sentiments=None):
+        """Exécute directement un lot de textes sur le processus le moins chargé"""
+        return self._pick(model_type).run_batch(model_type, texts, instructions, token_ids, sentiments)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+def start_worker_pool(num_workers=None):
+    """Démarre le pool de processus et y redirige les prédictions du module de modèles"""
+    num_workers = WORKER_PROCESSES if num_workers is None else num_workers
+    worker_model_types = None
+    if WORKER_MODEL_TYPES:
+        worker_model_types = [tuple(t for t in group.split(",") if t) for group in WORKER_MODEL_TYPES.split(";")]
+    pool = WorkerPool(num_workers, WORKER_THREADS, worker_model_types).start()
+    models.worker_pool = pool
+    return pool